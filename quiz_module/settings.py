@@ -51,6 +51,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'quizzes.middleware.UtorAuthMiddleware.UtorAuthMiddleware',
+    'quizzes.middleware.ReplicaMiddleware.ReplicaMiddleware',
 ]
 
 AUTHENTICATION_BACKENDS = [
@@ -91,9 +92,46 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Tests use a file rather than SQLite's shared in-memory database,
+        # whose table locks fail immediately instead of waiting, so that
+        # tests with concurrent connections behave like a real database
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
+# The cache must be shared by every process serving the site: it holds the
+# outcomes of answer submissions and which users are pinned to 'default'
+# (see below). The database table works anywhere; migrate creates it (see
+# quizzes/migrations/0016_create_cache_table.py). Memcached or redis can be
+# configured in local_settings instead, but not a per-process cache such as
+# LocMemCache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'quizzes_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# Reporting views read from the database REPLICA_DATABASE names, a read-only
+# copy of 'default', or from 'default' if it is None (see quizzes/routers.py).
+# A user's requests read from 'default' for REPLICA_PIN_TIMEOUT seconds after
+# they write, which should be longer than the replica's lag. To try it with
+# SQLite, add to DATABASES
+#     'replica': {
+#         'ENGINE': 'django.db.backends.sqlite3',
+#         'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+#         'TEST': {'MIRROR': 'default'},
+#     },
+# set REPLICA_DATABASE = 'replica', and run the sync_replica command.
+DATABASE_ROUTERS = ['quizzes.routers.ReplicaRouter']
+REPLICA_DATABASE = None
+REPLICA_PIN_TIMEOUT = 30
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -144,6 +182,56 @@ LATEX_ROOT = '/home/tholden/djangotest/latex'
 LOG_ROOT = '/tmp'
 MARKS_LOG = "/".join([LOG_ROOT, 'marks_log.log'])
 
+# Number of pre-generated variants kept per MarkedQuestion by the
+# fill_variant_pools command. Questions are only taken from the pools if
+# QUESTION_VARIANT_POOLS is on; turn it on when that command is run, since
+# otherwise every generated question looks for a variant in vain.
+QUESTION_VARIANT_POOL_SIZE = 100
+QUESTION_VARIANT_POOLS = False
+
+# Number of worker processes which evaluate answers with the instructor's
+# functions. 0 evaluates them in the request process. Times are in seconds.
+# The workers only limit time and memory; they are not a sandbox (see
+# quizzes.workers).
+EVALUATION_WORKERS = 0
+EVALUATION_TIMEOUT = 2
+EVALUATION_BATCH_TIMEOUT = 30
+EVALUATION_QUEUE_WAIT = 5
+# Address space limit (bytes) for each worker, or None
+EVALUATION_MEMORY_LIMIT = None
+
+# Limits on the work done evaluating a single expression (including student
+# answers): its length, the number of nodes evaluated and the largest integer
+# built, in bits
+EVALUATION_MAX_LENGTH = 10000
+EVALUATION_MAX_OPERATIONS = 10000
+EVALUATION_MAX_BITS = 10000
+
+# Path of the control file of the shared, memory mapped question bank, which
+# is written by the build_question_bank command. None disables the bank.
+QUESTION_BANK_PATH = None
+
+# Module used to encode and decode the JSON fields of question results. Any
+# module with loads and dumps will do, such as 'ujson' or 'orjson'.
+RESULT_JSON_CODEC = 'json'
+
+# Store only a seed for each generated question, regenerating its inputs,
+# answer and multiple choice options when needed (see quizzes/attempts.py).
+# Questions whose functions use the random module are always stored in full.
+# Regenerated values are cached for SEEDED_RESULT_TIMEOUT seconds.
+SEEDED_QUESTION_RESULTS = False
+SEEDED_RESULT_TIMEOUT = 3600
+
+# The outcome of each answer submission is cached under its submission token
+# for this many seconds, so that retried submissions are answered without
+# reading the attempt. Once it expires, the token stored with the answer
+# still keeps them from being marked (see quizzes.views.submit_answer)
+SUBMISSION_OUTCOME_TIMEOUT = 600
+
+# An uploaded roster is kept as a CSVFile for this many seconds while its
+# preview is confirmed (see quizzes.views.sync_roster)
+ROSTER_PREVIEW_TIMEOUT = 3600
+
 # For websockets we need to define the CHANNEL_LAYERS setting
 
 CHANNEL_LAYERS = {
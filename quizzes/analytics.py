@@ -0,0 +1,433 @@
+""" Columnar snapshots of a course's quiz results, for item analysis.
+
+    build_snapshot streams every StudentQuizResult of a course, and every
+    StudentQuestionResult within them, together with the attempts archived
+    in ArchivedQuizResult, out of the database once, into one NumPy array
+    per column saved as a .npy file. load_snapshot maps those
+    files into memory read-only, and the reports below are vectorized over
+    them, so analyses can be rerun as often as needed without touching the
+    production database or decoding any JSON.
+
+    A snapshot is a directory holding:
+        meta.json           - the course, when the snapshot was taken, and
+                              the number of rows
+        attempts.<col>.npy  - one row per StudentQuizResult, ordered by pk
+        answers.<col>.npy   - one row per StudentQuestionResult, ordered by
+                              attempt and number
+    The columns are listed in ATTEMPT_COLUMNS and ANSWER_COLUMNS. Each file is
+    written under a temporary name and renamed into place, and meta.json is
+    removed first and written last, so an interrupted rebuild does not leave
+    something which loads as a snapshot.
+
+    For multiple choice answers, option is the position of the chosen option
+    in the question's options before they were shuffled: the
+    MarkedQuestion.mc_choices in order, followed by the correct answer. It
+    is recovered by evaluating the options again for the stored inputs, so it
+    is -1 if the question has since been edited so that the choice no longer
+    matches, or if the options could no longer be evaluated; meta.json counts
+    the latter as unrecovered_options.
+
+    NumPy is required.
+"""
+
+from django.utils import timezone
+
+from . import attempts
+from . import workers
+
+import heapq
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SNAPSHOT_VERSION = 1
+
+# (name, dtype) of each column
+ATTEMPT_COLUMNS = (
+    ('pk', '<i8'),
+    ('student', '<i8'),
+    ('quiz', '<i8'),
+    ('attempt', '<i4'),
+    ('score', '<i4'),
+    ('finished', '?'),
+)
+ANSWER_COLUMNS = (
+    ('attempt', '<i8'),  # StudentQuizResult pk
+    ('number', '<i4'),   # the question number, which is the category
+    ('question', '<i8'), # MarkedQuestion pk, or NO_VALUE if deleted
+    ('score', '<i1'),
+    ('answered', '?'),
+    ('option', '<i2'),   # the unshuffled option chosen, or NO_VALUE
+    ('options', '<i2'),  # how many options there were, or 0
+)
+
+# Stands in for a missing question or option
+NO_VALUE = -1
+
+# Rows are converted to arrays this many at a time
+CHUNK_SIZE = 10000
+
+# Most distinct (question, inputs) whose options are remembered at once
+MAX_REMEMBERED_OPTIONS = 10000
+
+class ColumnWriter(object):
+    """ Accumulates rows into compact arrays, a chunk at a time, and saves
+        each column as a .npy file.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.rows = []
+        self.chunks = dict((name, []) for name, dtype in columns)
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        for position, (name, dtype) in enumerate(self.columns):
+            self.chunks[name].append(
+                np.array([row[position] for row in self.rows], dtype=dtype))
+        self.rows = []
+
+    def save(self, directory, prefix):
+        """ Writes the columns, and returns the number of rows """
+        self.flush()
+        size = 0
+        for name, dtype in self.columns:
+            chunks = self.chunks[name]
+            column = np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+            path = os.path.join(directory, '{}.{}.npy'.format(prefix, name))
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, column)
+            os.replace(path + '.tmp', path)
+            size = len(column)
+        return size
+
+
+# The StudentQuestionResult fields build_snapshot reads for each answer
+ANSWER_FIELDS = ('attempt_id', 'number', 'question_id', 'score', 'guess_string',
+                 'inputs', 'answer', 'seed', 'version')
+
+def archived_answers(archived, questions):
+    """ Generates the answers of archived attempts as rows of ANSWER_FIELDS,
+        ordered by attempt and number, decompressing one attempt at a time.
+        <<INPUT>>
+        archived (QuerySet) of ArchivedQuizResults
+        questions (set) of the pks of the MarkedQuestions which still exist.
+            The answers to others have their question_id set to None, as a
+            StudentQuestionResult's would be.
+    """
+    positions = [attempts.COLUMNS.index(field) for field in ANSWER_FIELDS[1:]]
+    question = attempts.COLUMNS.index('question_id')
+    for pk, data in archived.order_by('pk').values_list('pk', 'questions').iterator():
+        # Archived in order of number
+        for row in attempts.decompress_rows(data):
+            if row[question] not in questions:
+                row[question] = None
+            yield (pk,) + tuple(row[position] for position in positions)
+
+
+class OptionFinder(object):
+    """ Finds which unshuffled option a multiple choice answer chose """
+    def __init__(self, questions):
+        self.questions = questions
+        self.remembered = {}
+        # Answers whose options could not be evaluated
+        self.failed = 0
+
+    def options(self, question, inputs, answer):
+        key = (question.pk, inputs)
+        options = self.remembered.get(key)
+        if options is None:
+            if len(self.remembered) >= MAX_REMEMBERED_OPTIONS:
+                self.remembered.clear()
+            options = self.remembered[key] = workers.get_mc_options(question, inputs)
+        return options + [str(answer)]
+
+    def find(self, question_id, inputs, answer, seed, version, guess_string):
+        """ Returns (option, number of options) for an answer """
+        question = self.questions.get(question_id)
+        if question is None or question.q_type != "MC" or guess_string is None:
+            return NO_VALUE, 0
+        if inputs is None and (seed is None or version != question.version):
+            # Seeded, so it can only be regenerated by the same version
+            return NO_VALUE, 0
+        if inputs is not None:
+            answer = attempts.loads(answer)
+        try:
+            if inputs is None:
+                inputs, answer, mc_choices = workers.generate(question, seed)
+            options = self.options(question, inputs, answer)
+        except Exception:
+            # The instructor's functions may raise anything, or no longer
+            # accept inputs drawn for an earlier version
+            self.failed += 1
+            return NO_VALUE, 0
+
+        if guess_string == options[-1]:
+            return len(options) - 1, len(options)
+        if guess_string in options:
+            return options.index(guess_string), len(options)
+        return NO_VALUE, len(options)
+
+
+def build_snapshot(course, directory):
+    """ Writes a snapshot of every attempt at the quizzes of course, including
+        archived attempts, which are merged in by primary key.
+        <<INPUT>>
+        course (Course) the course
+        directory (String) where to write the snapshot. It is created if
+            needed, and any snapshot already there is replaced.
+        <<OUTPUT>>
+        (dict) the snapshot's meta data, as saved in meta.json
+    """
+    from .models import (MarkedQuestion, StudentQuizResult, StudentQuestionResult,
+                         ArchivedQuizResult)
+
+    os.makedirs(directory, exist_ok=True)
+    taken = timezone.now()
+    # Until meta.json is written again, the directory is not a snapshot
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    live = StudentQuizResult.objects.filter(quiz__course=course)
+    archived = ArchivedQuizResult.objects.filter(quiz__course=course)
+    # Later attempts are left out, so both tables describe the same moment
+    last = max(queryset.order_by('-pk').values_list('pk', flat=True).first() or 0
+               for queryset in (live, archived))
+    live, archived = live.filter(pk__lte=last), archived.filter(pk__lte=last)
+
+    writer = ColumnWriter(ATTEMPT_COLUMNS)
+    fields = ('pk', 'student_id', 'quiz_id', 'attempt', 'score', 'cur_quest')
+    rows = heapq.merge(live.order_by('pk').values_list(*fields).iterator(),
+                       archived.order_by('pk').values_list(*fields).iterator(),
+                       key=lambda row: row[0])
+    for pk, student_id, quiz_id, attempt, score, cur_quest in rows:
+        writer.append((pk, student_id, quiz_id, attempt or 1, score or 0, cur_quest == 0))
+    attempt_count = writer.save(directory, 'attempts')
+
+    questions = set(MarkedQuestion.objects.filter(quiz__course=course).values_list(
+        'pk', flat=True))
+    finder = OptionFinder(dict(
+        (question.pk, question)
+        for question in MarkedQuestion.objects.filter(quiz__course=course, q_type="MC")))
+    writer = ColumnWriter(ANSWER_COLUMNS)
+    rows = heapq.merge(
+        StudentQuestionResult.objects.filter(attempt__in=live).order_by(
+            'attempt', 'number').values_list(*ANSWER_FIELDS).iterator(),
+        archived_answers(archived, questions), key=lambda row: row[:2])
+    for attempt_id, number, question_id, score, guess_string, inputs, answer, seed, version \
+            in rows:
+        option, options = finder.find(question_id, inputs, answer, seed, version, guess_string)
+        writer.append((attempt_id, number,
+                       NO_VALUE if question_id is None else question_id,
+                       score, guess_string is not None, option, options))
+    answer_count = writer.save(directory, 'answers')
+
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'course': course.pk,
+        'course_name': course.name,
+        'taken': taken.isoformat(),
+        'attempts': attempt_count,
+        'answers': answer_count,
+        'unrecovered_options': finder.failed,
+    }
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    return meta
+
+
+class Snapshot(object):
+    """ A snapshot mapped into memory. attempts and answers are dicts of
+        read-only arrays, by column name.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("{} is not a version {} snapshot".format(
+                directory, SNAPSHOT_VERSION))
+
+        def load(prefix, columns):
+            return dict(
+                (name, np.load(os.path.join(directory, '{}.{}.npy'.format(prefix, name)),
+                               mmap_mode='r'))
+                for name, dtype in columns)
+        self.attempts = load('attempts', ATTEMPT_COLUMNS)
+        self.answers = load('answers', ANSWER_COLUMNS)
+
+    def answer_attempts(self):
+        """ The row of attempts which each answer belongs to """
+        return np.searchsorted(self.attempts['pk'], self.answers['attempt'])
+
+def load_snapshot(directory):
+    """ Maps the snapshot in directory. Raises ValueError if it is not a
+        snapshot this version can read.
+    """
+    return Snapshot(directory)
+
+
+# ---------- Item analysis ---------- #
+
+def _answered(snapshot, finished_only=False):
+    """ The mask of answers to analyse, and the attempt row of each answer """
+    rows = snapshot.answer_attempts()
+    mask = snapshot.answers['answered'] & (snapshot.answers['question'] != NO_VALUE)
+    if finished_only:
+        mask &= snapshot.attempts['finished'][rows]
+    return mask, rows
+
+def question_difficulty(snapshot):
+    """ How often each question was answered correctly.
+        <<OUTPUT>>
+        (list) of dicts with the question pk, quiz pk, category, the number
+            of answers and the proportion correct (the item difficulty, p),
+            ordered by quiz, category and question
+    """
+    mask, rows = _answered(snapshot)
+    questions, first, codes = np.unique(snapshot.answers['question'][mask],
+                                        return_index=True, return_inverse=True)
+    answered = np.bincount(codes, minlength=len(questions))
+    correct = np.bincount(codes, weights=snapshot.answers['score'][mask],
+                          minlength=len(questions))
+
+    # Any answer locates a question's quiz and category
+    quizzes = snapshot.attempts['quiz'][rows[mask]][first]
+    numbers = snapshot.answers['number'][mask][first]
+
+    report = [{
+        'question': int(questions[k]),
+        'quiz': int(quizzes[k]),
+        'category': int(numbers[k]),
+        'answered': int(answered[k]),
+        'difficulty': float(correct[k]/answered[k]),
+    } for k in range(len(questions))]
+    return sorted(report, key=lambda row: (row['quiz'], row['category'], row['question']))
+
+def question_discrimination(snapshot):
+    """ How well each question separates strong and weak students: the
+        point-biserial correlation between its score and the rest of the
+        attempt's score (the corrected item-total correlation), over finished
+        attempts.
+        <<OUTPUT>>
+        (list) of dicts with the question pk, the number of answers, and the
+            correlation, which is None if either score never varies
+    """
+    mask, rows = _answered(snapshot, finished_only=True)
+    questions, codes = np.unique(snapshot.answers['question'][mask], return_inverse=True)
+    x = snapshot.answers['score'][mask].astype(np.float64)
+    y = snapshot.attempts['score'][rows[mask]].astype(np.float64) - x
+
+    def total(weights=None):
+        return np.bincount(codes, weights=weights, minlength=len(questions))
+    n, sx, sy = total(), total(x), total(y)
+    sxy, sxx, syy = total(x*y), total(x*x), total(y*y)
+
+    numerator = n*sxy - sx*sy
+    denominator = np.sqrt(np.clip(n*sxx - sx*sx, 0, None)*np.clip(n*syy - sy*sy, 0, None))
+    defined = denominator > 0
+    correlation = np.zeros(len(questions))
+    correlation[defined] = numerator[defined]/denominator[defined]
+
+    return [{
+        'question': int(questions[k]),
+        'answered': int(n[k]),
+        'discrimination': float(correlation[k]) if defined[k] else None,
+    } for k in range(len(questions))]
+
+def variant_fairness(snapshot):
+    """ Whether the questions of a category, which students are given at
+        random, are equally hard: for each quiz and category, the proportion
+        correct of each question against that of the whole pool, and the
+        chi-squared statistic for the questions being equally hard.
+        <<OUTPUT>>
+        (list) of dicts with the quiz pk, category, number of answers,
+            proportion correct, the chi-squared statistic and its degrees of
+            freedom, and a list of the questions with their answers and
+            proportion correct. Pools with a single question are left out.
+    """
+    mask, rows = _answered(snapshot)
+    quizzes = snapshot.attempts['quiz'][rows[mask]]
+    numbers = snapshot.answers['number'][mask]
+    questions = snapshot.answers['question'][mask]
+    scores = snapshot.answers['score'][mask]
+
+    keys = np.stack([quizzes, numbers.astype(np.int64), questions], axis=1)
+    variants, codes = np.unique(keys, axis=0, return_inverse=True)
+    codes = codes.ravel()
+    answered = np.bincount(codes, minlength=len(variants))
+    correct = np.bincount(codes, weights=scores, minlength=len(variants))
+
+    # Variants are sorted by quiz and category, so each pool is contiguous
+    pools, starts = np.unique(variants[:, :2], axis=0, return_index=True)
+    ends = np.append(starts[1:], len(variants))
+
+    report = []
+    for (quiz, number), start, end in zip(pools, starts, ends):
+        if end - start < 2:
+            continue
+        n, c = answered[start:end], correct[start:end]
+        p = c.sum()/n.sum()
+        expected_correct, expected_wrong = n*p, n*(1 - p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chi2 = np.nansum((c - expected_correct)**2/expected_correct) \
+                 + np.nansum(((n - c) - expected_wrong)**2/expected_wrong)
+        report.append({
+            'quiz': int(quiz),
+            'category': int(number),
+            'answered': int(n.sum()),
+            'difficulty': float(p),
+            'chi2': float(chi2),
+            'dof': int(end - start - 1),
+            'questions': [{
+                'question': int(variants[k, 2]),
+                'answered': int(answered[k]),
+                'difficulty': float(correct[k]/answered[k]),
+            } for k in range(start, end)],
+        })
+    return report
+
+def distractor_usage(snapshot):
+    """ How often each option of each multiple choice question was chosen.
+        <<OUTPUT>>
+        (list) of dicts with the question pk, the number of answers whose
+            option could be recovered, and counts, a list with the number of
+            times each unshuffled option was chosen. The last option is the
+            correct answer.
+    """
+    mask, rows = _answered(snapshot)
+    mask &= snapshot.answers['option'] != NO_VALUE
+    options = snapshot.answers['option'][mask].astype(np.int64)
+    counts = snapshot.answers['options'][mask].astype(np.int64)
+    questions, codes = np.unique(snapshot.answers['question'][mask], return_inverse=True)
+    if not len(questions):
+        return []
+
+    width = int(counts.max())
+    table = np.bincount(codes*width + options, minlength=len(questions)*width).reshape(
+        len(questions), width)
+    sizes = np.zeros(len(questions), dtype=np.int64)
+    np.maximum.at(sizes, codes, counts)
+
+    return [{
+        'question': int(questions[k]),
+        'answered': int(table[k].sum()),
+        'counts': [int(count) for count in table[k, :sizes[k]]],
+    } for k in range(len(questions))]
+
+REPORTS = {
+    'difficulty': question_difficulty,
+    'discrimination': question_discrimination,
+    'fairness': variant_fairness,
+    'distractors': distractor_usage,
+}
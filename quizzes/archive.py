@@ -0,0 +1,123 @@
+""" The archive of past attempts.
+
+    Every attempt ever made stays in StudentQuizResult and
+    StudentQuestionResult, which are queried per student across all courses.
+    archive_attempts moves finished attempts out of them, chunk by chunk,
+    into ArchivedQuizResult, which keeps the attempt's own fields and a zlib
+    compressed blob of its questions (see attempts.compress_rows). The
+    archived attempt keeps its primary key, and get_attempt reads through to
+    the archive, so quiz_details can still open it.
+
+    Seeded questions are stored in full when archived, since they might not
+    be regenerated once the question is edited. Archived attempts still
+    count towards StudentQuizState.
+"""
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import attempts
+
+import datetime
+
+CHUNK_SIZE = 500
+
+def archivable(inactive=False, older_than=None, now=None):
+    """ Returns the finished StudentQuizResults which may be archived.
+        <<INPUT>>
+        inactive (Boolean) include those of courses whose status is off, at
+            quizzes which have expired
+        older_than (Integer) include those at quizzes which expired more than
+            this many days ago
+        <<OUTPUT>>
+        (QuerySet) which is empty if neither is given
+    """
+    from .models import StudentQuizResult
+
+    now = now or timezone.now()
+    condition = Q(pk__in=[])
+    if inactive:
+        condition |= Q(quiz__course__status=False, quiz__expires__lte=now)
+    if older_than is not None:
+        condition |= Q(quiz__expires__lte=now - datetime.timedelta(days=older_than))
+    return StudentQuizResult.objects.filter(condition, cur_quest=0)
+
+def archive_rows(result, rows):
+    """ The rows of COLUMNS to archive for a StudentQuizResult, with seeded
+        questions regenerated where they still can be
+    """
+    archived = []
+    for row in rows:
+        state = attempts.QuestionState(*row, quiz=result.quiz)
+        if state.is_seeded:
+            try:
+                row = list(row)
+                row[attempts.COLUMNS.index('inputs')] = state.inputs
+                row[attempts.COLUMNS.index('answer')] = attempts.dumps(state.answer)
+                row[attempts.COLUMNS.index('mc_choices')] = (
+                    None if state.mc_choices is None else attempts.dumps(state.mc_choices))
+            except LookupError: # Only the seed can be kept
+                pass
+        archived.append(row)
+    return archived
+
+def archive_attempts(results, chunk_size=CHUNK_SIZE):
+    """ Moves the finished attempts among results into the archive. Each
+        chunk is read, and its questions compressed, outside of any
+        transaction, then written to the archive and deleted from the quiz
+        result tables in one transaction.
+        <<INPUT>>
+        results (QuerySet) of StudentQuizResults, such as archivable returns
+        chunk_size (Integer) how many attempts to move in each transaction
+        <<OUTPUT>>
+        (Integer) the number of attempts archived
+    """
+    from .models import StudentQuizResult, StudentQuestionResult, ArchivedQuizResult
+
+    results = results.filter(cur_quest=0).select_related('quiz').order_by('pk')
+    archived = 0
+    while True:
+        chunk = list(results[:chunk_size])
+        if not chunk:
+            return archived
+
+        questions = {}
+        rows = StudentQuestionResult.objects.filter(attempt__in=chunk).order_by(
+            'attempt', 'number').values_list('attempt_id', *attempts.COLUMNS)
+        for row in rows:
+            questions.setdefault(row[0], []).append(row[1:])
+
+        records = [ArchivedQuizResult(
+            id=result.pk,
+            student_id=result.student_id,
+            quiz_id=result.quiz_id,
+            attempt=result.attempt,
+            cur_quest=result.cur_quest,
+            score=result.score,
+            finalized=result.finalized,
+            questions=attempts.compress_rows(archive_rows(result, questions.get(result.pk, []))),
+        ) for result in chunk]
+
+        pks = [result.pk for result in chunk]
+        with transaction.atomic():
+            ArchivedQuizResult.objects.bulk_create(records)
+            StudentQuestionResult.objects.filter(attempt__in=pks).delete()
+            StudentQuizResult.objects.filter(pk__in=pks).delete()
+        archived += len(records)
+
+def get_attempt(pk):
+    """ Returns the StudentQuizResult with primary key pk, with its quiz,
+        from the archive if it has been archived (see
+        ArchivedQuizResult.as_result). Raises StudentQuizResult.DoesNotExist
+        if it is in neither.
+    """
+    from .models import StudentQuizResult, ArchivedQuizResult
+
+    try:
+        return StudentQuizResult.objects.select_related('quiz').get(pk=pk)
+    except StudentQuizResult.DoesNotExist:
+        archived = ArchivedQuizResult.objects.select_related('quiz').filter(pk=pk).first()
+        if archived is None:
+            raise
+        return archived.as_result()
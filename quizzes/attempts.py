@@ -0,0 +1,383 @@
+""" A typed, lazily loaded view of the questions of a quiz attempt.
+
+    Views used to rebuild the legacy dict-of-dicts for an attempt, with
+    string keys and string scores, and decode its JSON on every access.
+    AttemptState wraps a StudentQuizResult instead. Its StudentQuestionResult
+    rows are read with a single values_list query the first time they are
+    needed (or just the one row, if only a single question is asked for),
+    into compact QuestionState records whose JSON fields are decoded at most
+    once, on first use. Changes are tracked, and save() writes only the
+    questions which were added or marked.
+
+    The JSON codec is pluggable: settings.RESULT_JSON_CODEC names any module
+    with loads and dumps, such as 'json' (the default), 'ujson' or 'orjson'.
+    Values the codec cannot handle, such as integers too large for it, fall
+    back to the json module, whose output every codec can read.
+
+    With settings.SEEDED_QUESTION_RESULTS, new questions are stored as just
+    (MarkedQuestion pk, version, seed); their inputs, answer and multiple
+    choice options are left null and regenerated on demand with
+    QuestionProgram.generate(seed). Seeds are drawn from a generator private
+    to the attempt. Regenerated values are kept in the Django cache. Before a
+    MarkedQuestion is edited or deleted, materialize_seeded writes out the
+    values of its seeded questions, since the old version can no longer be
+    regenerated afterwards.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from collections import OrderedDict
+import importlib
+import json
+import random
+import zlib
+
+_codec = None
+
+def get_codec():
+    """ Returns the module configured as settings.RESULT_JSON_CODEC """
+    global _codec
+    name = getattr(settings, 'RESULT_JSON_CODEC', 'json')
+    if _codec is None or _codec.__name__ != name:
+        _codec = importlib.import_module(name)
+    return _codec
+
+def dumps(value):
+    """ Serializes value with the configured codec, as a string """
+    try:
+        text = get_codec().dumps(value)
+    except (TypeError, ValueError, OverflowError):
+        return json.dumps(value)
+    return text.decode('utf-8') if isinstance(text, bytes) else text
+
+def loads(text):
+    """ Deserializes text with the configured codec. None stays None. """
+    if text is None:
+        return None
+    try:
+        return get_codec().loads(text)
+    except (TypeError, ValueError, OverflowError):
+        return json.loads(text)
+
+# Marks a JSON field which has not been decoded yet
+UNDECODED = object()
+
+# Columns of StudentQuestionResult, in the order QuestionState takes them
+COLUMNS = ('number', 'question_id', 'inputs', 'q_type', 'score',
+           'guess_string', 'answer', 'guess', 'mc_choices', 'seed', 'version')
+
+# Seeds fit in a signed 64 bit column
+SEED_BITS = 63
+
+def compress_rows(rows):
+    """ Compresses a list of rows of COLUMNS (JSON fields still serialized)
+        with zlib, for ArchivedQuizResult.questions
+    """
+    return zlib.compress(json.dumps([list(row) for row in rows]).encode('utf-8'), 9)
+
+def decompress_rows(data):
+    """ The rows compressed by compress_rows """
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+def regenerate(quiz, question_id, version, seed):
+    """ Regenerates a seeded question.
+        <<INPUT>>
+        quiz (Quiz) the quiz of the attempt
+        question_id (Integer), version (Integer), seed (Integer) as stored
+        <<OUTPUT>>
+        (tuple) of the inputs, answer and multiple choice options, as
+            QuestionProgram.generate returns them
+    """
+    from . import workers
+
+    key = 'question-seed:{}:{}:{}'.format(question_id, version, seed)
+    value = cache.get(key)
+    if value is None:
+        question = quiz.get_question(question_id) if question_id is not None else None
+        if question is None or question.version != version:
+            raise LookupError("Question {} version {} can no longer be regenerated".format(
+                question_id, version))
+        value = workers.generate(question, seed)
+        cache.set(key, value, getattr(settings, 'SEEDED_RESULT_TIMEOUT', 3600))
+    return value
+
+def materialize_seeded(question):
+    """ Stores the inputs, answer and multiple choice options of every seeded
+        question generated from question, which should be the saved version
+        of the MarkedQuestion. The seeds are kept.
+    """
+    from .models import StudentQuestionResult
+    from . import workers
+
+    rows = StudentQuestionResult.objects.filter(
+        question_id=question.pk, seed__isnull=False, inputs__isnull=True
+    ).values_list('pk', 'seed')
+    for pk, seed in rows.iterator():
+        inputs, answer, mc_choices = workers.generate(question, seed)
+        StudentQuestionResult.objects.filter(pk=pk).update(
+            inputs=inputs,
+            answer=dumps(answer),
+            mc_choices=None if mc_choices is None else dumps(mc_choices))
+
+def score_guess(q_type, correct, guess, accuracy=10e-5):
+    """ Marks a guess against the correct answer.
+        <<INPUT>>
+        q_type (String) the question type
+        correct the correct answer
+        guess for multiple choice questions, the option chosen, which is
+            compared as a string. Otherwise the number the student's answer
+            evaluated to.
+        accuracy (float) how close a number must be
+        <<OUTPUT>>
+        (Integer) 1 if the guess is correct, otherwise 0
+    """
+    if q_type == "MC":
+        return 1 if str(correct) == guess else 0
+    return 1 if abs(float(correct) - guess) < accuracy else 0
+
+class QuestionState(object):
+    """ One question of an attempt.
+        answer, guess and mc_choices are decoded from their JSON the first
+        time they are read. score is an integer. guess_string is None until
+        the question is answered.
+    """
+    __slots__ = ('number', 'question_id', '_inputs', 'q_type', 'score',
+                 'guess_string', '_answer', '_guess', '_mc_choices',
+                 '_raw', 'seed', 'version', 'token', 'quiz', 'is_new', 'dirty')
+
+    def __init__(self, number, question_id, inputs, q_type, score,
+                 guess_string, answer, guess, mc_choices, seed=None,
+                 version=None, quiz=None):
+        self.number = number
+        self.question_id = question_id
+        self._inputs = inputs
+        self.q_type = q_type
+        self.score = score
+        self.guess_string = guess_string
+        self._raw = (answer, guess, mc_choices)
+        self._answer = self._guess = self._mc_choices = UNDECODED
+        self.seed = seed
+        self.version = version
+        self.token = None
+        self.quiz = quiz
+        self.is_new = False
+        self.dirty = False
+
+    @classmethod
+    def new(cls, number, question, inputs, answer, mc_choices=None, seed=None):
+        """ A question which has just been generated, and not yet saved. If
+            seed is given, only the seed is saved.
+        """
+        state = cls(number, question.pk, inputs, question.q_type, 0, None,
+                    None, None, None, seed, question.version)
+        state._answer, state._guess, state._mc_choices = answer, None, mc_choices
+        state.is_new = state.dirty = True
+        return state
+
+    @property
+    def is_seeded(self):
+        """ Whether the inputs, answer and options are not stored """
+        return self.seed is not None and self._raw[0] is None
+
+    def _regenerate(self):
+        self._inputs, self._answer, self._mc_choices = regenerate(
+            self.quiz, self.question_id, self.version, self.seed)
+
+    @property
+    def inputs(self):
+        if self._inputs is None and self.is_seeded:
+            self._regenerate()
+        return self._inputs
+
+    @property
+    def answer(self):
+        if self._answer is UNDECODED:
+            if self.is_seeded:
+                self._regenerate()
+            else:
+                self._answer = loads(self._raw[0])
+        return self._answer
+
+    @property
+    def guess(self):
+        if self._guess is UNDECODED:
+            self._guess = loads(self._raw[1])
+        return self._guess
+
+    @property
+    def mc_choices(self):
+        if self._mc_choices is UNDECODED:
+            if self.is_seeded:
+                self._regenerate()
+            else:
+                self._mc_choices = loads(self._raw[2])
+        return self._mc_choices
+
+    @property
+    def is_answered(self):
+        return self.guess_string is not None
+
+    def mark(self, guess, guess_string, score, token=None):
+        """ Records the student's answer, and the submission token it came
+            with, if any
+        """
+        self._guess = guess
+        self.guess_string = guess_string
+        self.score = score
+        self.token = token
+        self.dirty = True
+
+    def as_dict(self):
+        """ The question in the format of the legacy result column """
+        ret = {
+            'pk': str(self.question_id),
+            'inputs': self.inputs,
+            'score': str(self.score),
+            'answer': self.answer,
+            'guess': self.guess,
+            'type': self.q_type,
+        }
+        if self.guess_string is not None:
+            ret['guess_string'] = self.guess_string
+        if self.mc_choices is not None:
+            ret['mc_choices'] = self.mc_choices
+        return ret
+
+
+class AttemptState(object):
+    """ The questions of a StudentQuizResult. Use
+        StudentQuizResult.get_state() rather than creating one directly, so
+        that the rows are read at most once per instance.
+    """
+    __slots__ = ('sqr', '_questions', '_loaded', '_rng')
+
+    def __init__(self, sqr):
+        self.sqr = sqr
+        self._questions = OrderedDict()
+        self._loaded = False
+        self._rng = None
+
+    def _rows(self):
+        return self.sqr.questions.order_by('number').values_list(*COLUMNS)
+
+    def _state(self, row):
+        return QuestionState(*row, quiz=self.sqr.quiz)
+
+    def new_seed(self):
+        """ Draws a seed for a new question from the attempt's generator """
+        if self._rng is None:
+            self._rng = random.Random()
+        return self._rng.getrandbits(SEED_BITS)
+
+    def questions(self):
+        """ Returns every QuestionState, ordered by number """
+        if not self._loaded:
+            loaded = OrderedDict(
+                (row[0], self._state(row)) for row in self._rows())
+            # Keep anything changed or added before loading
+            loaded.update(self._questions)
+            self._questions = OrderedDict(sorted(loaded.items()))
+            self._loaded = True
+        return list(self._questions.values())
+
+    def restore(self, rows):
+        """ Fills the state from rows of COLUMNS, such as those of an
+            archived attempt, instead of reading them
+        """
+        self._questions = OrderedDict(
+            (row[0], self._state(row)) for row in sorted(rows, key=lambda row: row[0]))
+        self._loaded = True
+
+    def get(self, number=None):
+        """ Returns the QuestionState of question number, by default the
+            current question. Raises KeyError if there is no such question.
+        """
+        if number is None:
+            number = self.sqr.cur_quest
+        self.load([number])
+        return self._questions[number]
+
+    def load(self, numbers):
+        """ Reads whichever of the given questions have not been read, in a
+            single query
+        """
+        missing = [number for number in numbers if number not in self._questions]
+        if missing and not self._loaded:
+            for row in self._rows().filter(number__in=missing):
+                self._questions[row[0]] = self._state(row)
+
+    def peek(self, number):
+        """ Returns the QuestionState of question number if it has been read
+            or added, otherwise None. Never queries.
+        """
+        return self._questions.get(number)
+
+    def answered(self):
+        """ Returns the questions which have been answered, in order """
+        return [state for state in self.questions() if state.is_answered]
+
+    def add(self, question, inputs, answer, mc_choices=None, seed=None, number=None):
+        """ Adds a newly generated question as question number, by default
+            the current question. It is written by the next save(). If seed is
+            given, the question must have been generated by
+            QuestionProgram.generate(seed), and only the seed is written.
+        """
+        if number is None:
+            number = self.sqr.cur_quest
+        state = QuestionState.new(number, question, inputs, answer, mc_choices, seed)
+        state.quiz = self.sqr.quiz
+        self._questions[state.number] = state
+        return state
+
+    def save(self):
+        """ Inserts the added questions and updates the marked ones """
+        from .models import StudentQuestionResult
+
+        created = []
+        for state in self._questions.values():
+            if not state.dirty:
+                continue
+            if state.is_new:
+                created.append(state)
+            else:
+                # (attempt, number) is unique, and found through its index
+                self.sqr.questions.filter(number=state.number).update(
+                    guess=None if state.guess is None else dumps(state.guess),
+                    guess_string=state.guess_string,
+                    score=state.score,
+                    token=state.token)
+                state.dirty = False
+
+        if created:
+            StudentQuestionResult.objects.bulk_create([
+                self._record(state) for state in created])
+            for state in created:
+                state.is_new = state.dirty = False
+
+    def _record(self, state):
+        """ The StudentQuestionResult to insert for a new question """
+        from .models import StudentQuestionResult
+
+        record = StudentQuestionResult(
+            attempt_id=self.sqr.pk,
+            number=state.number,
+            question_id=state.question_id,
+            guess=None if state.guess is None else dumps(state.guess),
+            guess_string=state.guess_string,
+            score=state.score,
+            q_type=state.q_type,
+            seed=state.seed,
+            version=state.version,
+            token=state.token,
+        )
+        if state.seed is None:
+            record.inputs = state.inputs
+            record.answer = dumps(state.answer)
+            record.mc_choices = None if state.mc_choices is None else dumps(state.mc_choices)
+        return record
+
+    def as_dict(self):
+        """ The attempt in the format of the legacy result column """
+        return OrderedDict(
+            (str(state.number), state.as_dict()) for state in self.questions())
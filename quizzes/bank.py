@@ -0,0 +1,283 @@
+""" A read-only question bank shared between processes through mmap.
+
+    Every web worker would otherwise hold its own QuizSnapshots of every live
+    quiz. When settings.QUESTION_BANK_PATH is set, the build_question_bank
+    command writes the definitions of all unexpired quizzes into a single
+    binary file which every worker maps into memory, so the pages are shared
+    and each worker only decodes the questions it actually uses.
+
+    Two files are used:
+        <path>            - the control file, holding the current version
+        <path>.<version>  - the bank itself, which is never modified
+    The builder writes a new bank file and then updates the version in the
+    control file. Workers compare that version on each lookup, and re-attach
+    when it changes. Workers still using an old bank keep it mapped after it
+    has been unlinked.
+
+    The bank records the version of each quiz, so a quiz edited since the
+    bank was built is looked up in the database instead (see
+    snapshots.get_snapshot).
+
+    Layout of a bank file (little endian):
+        header, then QUIZ records sorted by pk, then CATEGORY records, then
+        QUESTION records grouped by quiz and category, then the text of every
+        question as utf-8, referenced by (offset, length) pairs.
+"""
+
+from django.conf import settings
+
+import mmap
+import os
+import random
+import struct
+import threading
+
+MAGIC = b'QBANK001'
+CONTROL = struct.Struct('<8sQ') # magic, version
+# magic, version, quiz count, category count, question count
+HEADER = struct.Struct('<8sQQQQ')
+# pk, version, out_of, first category, category count
+QUIZ = struct.Struct('<qqqQQ')
+# category, first question, question count
+CATEGORY = struct.Struct('<qQQ')
+# pk, quiz pk, category, version, num_vars, q_type, then (offset, length)
+# for each of TEXT_FIELDS. A length of -1 stands for None.
+TEXT_FIELDS = ('problem_str', 'choices', 'answer', 'functions', 'mc_choices')
+QUESTION = struct.Struct('<qqqqq2s' + 'Qq'*len(TEXT_FIELDS))
+
+# Stands in for a num_vars of None
+NO_VALUE = -1
+
+class BankSnapshot(object):
+    """ A view of one quiz in the bank, with the same interface as
+        snapshots.QuizSnapshot. Nothing is decoded until it is used.
+    """
+    __slots__ = ('data', 'pk', 'version', 'out_of', 'first_category', 'category_count')
+
+    def __init__(self, data, record):
+        self.data = data
+        self.pk, self.version, self.out_of, self.first_category, self.category_count = record
+
+    def _categories(self):
+        offset = HEADER.size + self.data.quiz_count*QUIZ.size
+        for index in range(self.first_category, self.first_category + self.category_count):
+            yield CATEGORY.unpack_from(self.data.buffer, offset + index*CATEGORY.size)
+
+    def _question(self, index):
+        """ Decodes the question record with the given index """
+        from .models import MarkedQuestion
+
+        buffer = self.data.buffer
+        record = QUESTION.unpack_from(buffer, self.data.questions_offset + index*QUESTION.size)
+        pk, quiz_id, category, version, num_vars, q_type = record[:6]
+        fields = {
+            'pk': pk,
+            'quiz_id': quiz_id,
+            'category': category,
+            'version': version,
+            'num_vars': None if num_vars == NO_VALUE else num_vars,
+            'q_type': q_type.rstrip(b'\x00').decode(),
+        }
+        for position, field in enumerate(TEXT_FIELDS):
+            offset, length = record[6 + 2*position: 8 + 2*position]
+            fields[field] = None if length < 0 else buffer[offset:offset+length].decode('utf-8')
+        return MarkedQuestion(**fields)
+
+    def get_question(self, pk):
+        """ Returns the MarkedQuestion with primary key pk, or None if it is
+            not part of the quiz
+        """
+        pk = int(pk)
+        for category, first, count in self._categories():
+            for index in range(first, first + count):
+                offset = self.data.questions_offset + index*QUESTION.size
+                if struct.unpack_from('<q', self.data.buffer, offset)[0] == pk:
+                    return self._question(index)
+        return None
+
+    def random_question(self, category, rng=random):
+        """ Returns a random MarkedQuestion from the given category. Raises
+            IndexError if the category is empty.
+        """
+        for number, first, count in self._categories():
+            if number == category:
+                return self._question(first + rng.randrange(count))
+        raise IndexError("No questions in category {}".format(category))
+
+
+class BankFile(object):
+    """ A mapped bank file """
+    def __init__(self, path, version):
+        with open('{}.{}'.format(path, version), 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.quiz_count, self.category_count, self.question_count = \
+            HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or self.version != version:
+            raise ValueError("{}.{} is not a question bank".format(path, version))
+        self.questions_offset = (HEADER.size + self.quiz_count*QUIZ.size
+                                 + self.category_count*CATEGORY.size)
+
+    def find_quiz(self, pk):
+        """ Binary search for the QUIZ record of quiz pk """
+        low, high = 0, self.quiz_count
+        while low < high:
+            middle = (low + high)//2
+            record = QUIZ.unpack_from(self.buffer, HEADER.size + middle*QUIZ.size)
+            if record[0] == pk:
+                return record
+            if record[0] < pk:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+
+class QuestionBank(object):
+    """ The process's attachment to the shared bank. Re-attaches whenever
+        the version in the control file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        with open(path, 'rb') as f:
+            self.control = mmap.mmap(f.fileno(), CONTROL.size, access=mmap.ACCESS_READ)
+        self.lock = threading.Lock()
+
+    def current(self):
+        """ Returns the current BankFile, or None if no bank has been built """
+        magic, version = CONTROL.unpack_from(self.control, 0)
+        if magic != MAGIC or not version:
+            return None
+        data = self.data
+        if data is None or data.version != version:
+            with self.lock:
+                if self.data is None or self.data.version != version:
+                    self.data = BankFile(self.path, version)
+                data = self.data
+        return data
+
+    def get_snapshot(self, pk, version):
+        """ Returns a BankSnapshot of quiz pk, or None if the bank does not
+            hold that version of the quiz.
+        """
+        try:
+            data = self.current()
+        except (OSError, ValueError): # Replaced again before we attached
+            return None
+        if data is None:
+            return None
+        record = data.find_quiz(int(pk))
+        if record is None or record[1] != version:
+            return None
+        return BankSnapshot(data, record)
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+def get_bank():
+    """ Returns the shared question bank, or None if it is not configured or
+        has not been built.
+    """
+    global _bank
+    path = getattr(settings, 'QUESTION_BANK_PATH', None)
+    if not path:
+        return None
+    with _bank_lock:
+        if _bank is None or _bank.path != path:
+            try:
+                _bank = QuestionBank(path)
+            except (OSError, ValueError):
+                return None
+        return _bank
+
+def build_bank(path, quizzes):
+    """ Writes a new version of the bank and makes it current.
+        <<INPUT>>
+        path (String) The path of the control file
+        quizzes (iterable) of Quiz objects to include
+        <<OUTPUT>>
+        (Integer) The version of the new bank
+    """
+    from .models import MarkedQuestion
+    from .snapshots import QUESTION_FIELDS
+
+    quizzes = sorted(quizzes, key=lambda quiz: quiz.pk)
+    rows = MarkedQuestion.objects.filter(quiz__in=quizzes).order_by(
+        'quiz', 'category', 'pk').values_list(*QUESTION_FIELDS)
+    by_quiz = {}
+    for row in rows:
+        by_quiz.setdefault(row[QUESTION_FIELDS.index('quiz_id')], []).append(
+            dict(zip(QUESTION_FIELDS, row)))
+
+    try:
+        with open(path, 'rb') as f:
+            magic, version = CONTROL.unpack(f.read(CONTROL.size))
+        version = version + 1 if magic == MAGIC else 1
+    except (OSError, struct.error):
+        version = 1
+
+    quiz_records = []
+    category_records = []
+    questions = []
+    for quiz in quizzes:
+        first_category = len(category_records)
+        for question in by_quiz.get(quiz.pk, []):
+            if category_records[first_category:] and \
+                    category_records[-1][0] == question['category']:
+                category_records[-1][2] += 1
+            else:
+                category_records.append([question['category'], len(questions), 1])
+            questions.append(question)
+        quiz_records.append((quiz.pk, quiz.version, quiz.out_of, first_category,
+                             len(category_records) - first_category))
+
+    text_offset = (HEADER.size + len(quiz_records)*QUIZ.size
+                   + len(category_records)*CATEGORY.size + len(questions)*QUESTION.size)
+    text = bytearray()
+    question_records = []
+    for question in questions:
+        references = []
+        for field in TEXT_FIELDS:
+            if question[field] is None:
+                references.extend([0, -1])
+                continue
+            encoded = question[field].encode('utf-8')
+            references.extend([text_offset + len(text), len(encoded)])
+            text += encoded
+        num_vars = question['num_vars']
+        question_records.append(QUESTION.pack(
+            question['pk'], question['quiz_id'], question['category'], question['version'],
+            NO_VALUE if num_vars is None else num_vars,
+            question['q_type'].encode(), *references))
+
+    data_path = '{}.{}'.format(path, version)
+    with open(data_path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, version, len(quiz_records), len(category_records),
+                            len(questions)))
+        for record in quiz_records:
+            f.write(QUIZ.pack(*record))
+        for record in category_records:
+            f.write(CATEGORY.pack(*record))
+        for record in question_records:
+            f.write(record)
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(data_path + '.tmp', data_path)
+
+    # Publishing the version in place lets attached workers see it
+    mode = 'r+b' if os.path.exists(path) else 'wb'
+    with open(path, mode) as f:
+        f.seek(0)
+        f.write(CONTROL.pack(MAGIC, version))
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Workers which still map older banks keep them until they re-attach
+    directory, name = os.path.split(os.path.abspath(path))
+    for entry in os.listdir(directory):
+        suffix = entry[len(name)+1:]
+        if entry.startswith(name + '.') and suffix.isdigit() and int(suffix) < version:
+            os.remove(os.path.join(directory, entry))
+    return version
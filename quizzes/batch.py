@@ -0,0 +1,295 @@
+""" Batch evaluation of MarkedQuestion answers over many inputs.
+
+    Testing a question, or pre-generating variants of it, evaluates the same
+    answer and multiple choice expressions for thousands of input tuples.
+    Rather than calling simple_eval once per tuple, the compiled expression
+    trees of a QuestionProgram are evaluated once over NumPy arrays holding
+    every input tuple.
+
+    Only arithmetic, the universal constants and the predefined sin, cos, tan
+    and ln are vectorized. Anything else (instructor functions, randomizers,
+    strings, sub-expressions) falls back to the per-row evaluation in
+    QuestionProgram, as do individual rows which would raise an error or whose
+    result cannot be guaranteed to match it (non-finite values, integers too
+    large to represent exactly, and so on). Results are rounded by python's
+    round, so they are identical to those of get_answer.
+"""
+
+from django.conf import settings
+from simpleeval import MAX_POWER
+
+from .programs import SubExpression, to_number
+
+import ast
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Largest magnitude for which every integer is exactly representable
+MAX_EXACT_INT = 2.0**53
+
+# Predefined functions which have a vectorized equivalent
+VECTOR_FUNCTIONS = {
+    'sin': 'sin',
+    'cos': 'cos',
+    'tan': 'tan',
+    'ln': 'log',
+}
+
+class NotVectorizable(Exception):
+    """ Raised when an expression cannot be evaluated over arrays """
+    pass
+
+
+class Vectorizer(object):
+    """ Evaluates an expression tree over arrays. Each value is a pair
+        (float64 array, is_int), where is_int records whether python would
+        have produced an int. Rows which must be evaluated by python instead
+        are flagged in self.bad.
+    """
+    def __init__(self, columns, size, names, functions, sign_sensitive=()):
+        self.columns = columns
+        self.sign_sensitive = sign_sensitive
+        self.size = size
+        self.names = names
+        self.functions = functions
+        self.bad = np.zeros(size, dtype=bool)
+        self.transcendental = False
+
+    def check_int(self, value):
+        """ Flags integer rows which are no longer exactly representable, and
+            clears the sign of zeros (python ints have no -0)
+        """
+        array, is_int = value
+        if is_int:
+            self.bad |= ~(np.abs(array) < MAX_EXACT_INT)
+            array = array + 0.0
+        return array, is_int
+
+    def eval(self, node):
+        handler = getattr(self, '_eval_' + type(node).__name__.lower(), None)
+        if handler is None:
+            raise NotVectorizable(type(node).__name__)
+        return handler(node)
+
+    def _constant(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise NotVectorizable(repr(value))
+        if isinstance(value, int) and abs(value) >= MAX_EXACT_INT:
+            raise NotVectorizable(repr(value))
+        return np.full(self.size, float(value)), isinstance(value, int)
+
+    def _eval_num(self, node):
+        return self._constant(node.n)
+
+    def _eval_constant(self, node):
+        return self._constant(node.value)
+
+    def _eval_name(self, node):
+        if node.id in self.columns:
+            return self.columns[node.id]
+        if node.id in self.names:
+            return self._constant(self.names[node.id])
+        raise NotVectorizable(node.id)
+
+    def _eval_unaryop(self, node):
+        array, is_int = self.eval(node.operand)
+        if isinstance(node.op, ast.USub):
+            return self.check_int((-array, is_int))
+        if isinstance(node.op, ast.UAdd):
+            return array, is_int
+        raise NotVectorizable(type(node.op).__name__)
+
+    def _eval_binop(self, node):
+        left, left_int = self.eval(node.left)
+        right, right_int = self.eval(node.right)
+        both_int = left_int and right_int
+        op = node.op
+
+        if isinstance(op, ast.Add):
+            return self.check_int((left + right, both_int))
+        if isinstance(op, ast.Sub):
+            return self.check_int((left - right, both_int))
+        if isinstance(op, ast.Mult):
+            return self.check_int((left * right, both_int))
+        if isinstance(op, ast.Div):
+            self.bad |= right == 0
+            return left / right, False
+        if isinstance(op, ast.FloorDiv):
+            self.bad |= right == 0
+            return self.check_int((np.floor_divide(left, right), both_int))
+        if isinstance(op, ast.Mod):
+            self.bad |= right == 0
+            return self.check_int((np.remainder(left, right), both_int))
+        if isinstance(op, ast.Pow):
+            # simple_eval refuses large operands
+            self.bad |= (np.abs(left) > MAX_POWER) | (np.abs(right) > MAX_POWER)
+            if both_int:
+                # int ** negative int is a float in python
+                self.bad |= right < 0
+            if isinstance(node.left, ast.Name) and node.left.id in self.sign_sensitive:
+                # The tree does not say whether the text was '{v[0]}**2',
+                # where -3 gives -(3**2), or '({v[0]})**2', so negative
+                # values are left to the text path, as Expression.bind does
+                self.bad |= np.signbit(left)
+            return self.check_int((np.power(left, right), both_int))
+        raise NotVectorizable(type(op).__name__)
+
+    def _eval_call(self, node):
+        if (not isinstance(node.func, ast.Name) or node.keywords
+                or len(node.args) != 1):
+            raise NotVectorizable('call')
+
+        name = node.func.id
+        # Only vectorize the predefined functions, and only if they have not
+        # been replaced
+        if (name not in VECTOR_FUNCTIONS or
+                self.functions.get(name) is not settings.PREDEFINED_FUNCTIONS.get(name)):
+            raise NotVectorizable(name)
+
+        array, _ = self.eval(node.args[0])
+        self.transcendental = True
+        return getattr(np, VECTOR_FUNCTIONS[name])(array), False
+
+
+def is_constant(part):
+    """ Whether a compiled (template, expression) pair evaluates to the same
+        thing for every input: no variables, and no function calls which may
+        be random.
+    """
+    template, expression = part
+    if template.substitute:
+        return False
+    if expression is None or expression.tree is None:
+        return expression is not None and expression.unparseable
+    return not any(isinstance(node, ast.Call) for node in ast.walk(expression.tree))
+
+def split_inputs(inputs):
+    return [choices.split(';') for choices in inputs]
+
+def vector_evaluate(expression, rows, names, functions):
+    """ Evaluates a compiled Expression over many rows of values.
+        <<INPUT>>
+        expression (programs.Expression) The compiled expression
+        rows (list) of lists of input strings
+        names, functions (dict) The namespaces for simple_eval
+        <<OUTPUT>>
+        (list) containing, for each row, the rounded result or None if the
+            row must be evaluated by python
+        Raises NotVectorizable if the expression cannot be vectorized at all.
+    """
+    if np is None or expression is None or expression.tree is None:
+        raise NotVectorizable('not compiled')
+    if any(isinstance(part, SubExpression) for part in expression.parts):
+        raise NotVectorizable('sub-expression')
+
+    indices = sorted(set(part for part in expression.parts if isinstance(part, int)))
+    size = len(rows)
+    results = [None]*size
+
+    # Inputs repeat a lot, so conversions are memoized
+    converted = {}
+    def convert(value):
+        try:
+            return converted[value]
+        except KeyError:
+            number = to_number(value)
+            if isinstance(number, int) and abs(number) >= MAX_EXACT_INT:
+                number = None
+            converted[value] = number
+            return number
+
+    valid = np.ones(size, dtype=bool)
+    signature = np.zeros(size, dtype=np.int64)
+    arrays = []
+    for position, index in enumerate(indices):
+        numbers = [
+            convert(values[index]) if index < len(values) else None
+            for values in rows
+        ]
+        valid &= np.fromiter((number is not None for number in numbers), bool, size)
+        is_int = np.fromiter((type(number) is int for number in numbers), bool, size)
+        signature |= is_int.astype(np.int64) << position
+        arrays.append(np.array(
+            [0 if number is None else number for number in numbers], dtype=float))
+
+    # Rows are grouped by which inputs are ints, since that decides whether
+    # python produces an int or a float.
+    for code in np.unique(signature[valid]).tolist():
+        members = np.nonzero(valid & (signature == code))[0]
+        columns = {}
+        for position, index in enumerate(indices):
+            columns['_v{}_'.format(index)] = (
+                arrays[position][members], bool(code >> position & 1))
+
+        vectorizer = Vectorizer(columns, len(members), names, functions,
+                                expression.sign_sensitive)
+        with np.errstate(all='ignore'):
+            array, is_int = vectorizer.eval(expression.tree)
+            bad = vectorizer.bad | ~np.isfinite(array)
+            if vectorizer.transcendental and not is_int:
+                # The vectorized functions may differ from libm in the last
+                # place, so leave values next to a rounding boundary to python
+                scaled = np.abs(array)*1e4
+                distance = np.abs(scaled - np.floor(scaled) - 0.5)
+                bad |= distance < scaled*1e-12 + 1e-9
+
+        convert_result = int if is_int else float
+        for row_index, value, is_bad in zip(members.tolist(), array.tolist(), bad.tolist()):
+            if not is_bad:
+                results[row_index] = round(convert_result(value), 4)
+
+    return results
+
+def evaluate_batch(question, inputs):
+    """ Computes the answers (and multiple choice options) of a question for
+        many concrete inputs at once.
+        <<INPUT>>
+        question (MarkedQuestion)
+        inputs (list) of concrete choice strings, such as ["3;-2", "1;5"]
+        <<OUTPUT>>
+        answers (list) The answer for each input, exactly as get_answer
+            would return it
+        mc_options (list) For MC questions, the unshuffled options for each
+            input, as QuestionProgram.get_mc_options would return them.
+            Otherwise None.
+    """
+    program = question.get_program()
+    rows = split_inputs(inputs)
+
+    try:
+        functions = program.functions
+        answers = vector_evaluate(
+            program.answer[1], rows, settings.UNIVERSAL_CONSTANTS, functions)
+    except Exception:
+        # Includes errors in the instructor's functions, which get_answer
+        # handles (or raises) itself
+        answers = [None]*len(rows)
+
+    answers = [
+        program.get_answer(choices) if answer is None else answer
+        for choices, answer in zip(inputs, answers)
+    ]
+
+    if question.q_type != "MC":
+        return answers, None
+
+    columns = []
+    for part in program.mc_choices:
+        if rows and is_constant(part):
+            columns.append([program.get_mc_option(part, rows[0])]*len(rows))
+            continue
+        try:
+            values = vector_evaluate(
+                part[1], rows, settings.UNIVERSAL_CONSTANTS, settings.PREDEFINED_FUNCTIONS)
+        except NotVectorizable:
+            values = [None]*len(rows)
+        columns.append([
+            program.get_mc_option(part, row) if value is None else str(value)
+            for row, value in zip(rows, values)
+        ])
+
+    mc_options = [list(options) for options in zip(*columns)] if columns else [[] for _ in rows]
+    return answers, mc_options
@@ -0,0 +1,89 @@
+""" Limits on the cost of evaluating a single expression.
+
+    simple_eval refuses exponents above MAX_POWER, but 99**4000000 is still
+    allowed and takes seconds to compute. Every expression (answers, multiple
+    choice options, sub-expressions, randomized choices and student answers)
+    is therefore evaluated by a BudgetedEval, which
+        - refuses expressions longer than EVALUATION_MAX_LENGTH characters,
+        - evaluates at most EVALUATION_MAX_OPERATIONS nodes, and
+        - refuses to build integers of more than EVALUATION_MAX_BITS bits,
+          checking powers and products before computing them.
+    BudgetExceeded is a NumberTooHigh, so it is handled like simple_eval's own
+    limits.
+"""
+
+from django.conf import settings
+from simpleeval import SimpleEval, NumberTooHigh, DEFAULT_OPERATORS
+
+import ast
+import math
+
+class BudgetExceeded(NumberTooHigh):
+    """ Raised when an expression exceeds its evaluation budget """
+    pass
+
+def max_bits():
+    return getattr(settings, 'EVALUATION_MAX_BITS', 10000)
+
+def int_bits(value):
+    """ The number of bits in value if it is an integer, otherwise 0 """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value.bit_length()
+    return 0
+
+def budgeted_power(a, b):
+    if int_bits(a) > 1 and int_bits(b) and b > 0:
+        if math.log2(abs(a))*b > max_bits():
+            raise BudgetExceeded("Sorry! {} ** {} is too large".format(a, b))
+    return DEFAULT_OPERATORS[ast.Pow](a, b)
+
+def budgeted_mult(a, b):
+    if int_bits(a) + int_bits(b) > max_bits() + 1:
+        raise BudgetExceeded("Sorry! {} * {} is too large".format(a, b))
+    return DEFAULT_OPERATORS[ast.Mult](a, b)
+
+def budgeted_lshift(a, b):
+    if int_bits(a) and int_bits(b) and int_bits(a) + b > max_bits():
+        raise BudgetExceeded("Sorry! {} << {} is too large".format(a, b))
+    return DEFAULT_OPERATORS[ast.LShift](a, b)
+
+BUDGETED_OPERATORS = dict(DEFAULT_OPERATORS)
+BUDGETED_OPERATORS.update({
+    ast.Pow: budgeted_power,
+    ast.Mult: budgeted_mult,
+    ast.LShift: budgeted_lshift,
+})
+
+
+class BudgetedEval(SimpleEval):
+    """ A SimpleEval with limits on the work done by each evaluation. Call
+        reset() before reusing an instance for a new expression (eval does
+        this itself).
+    """
+    def __init__(self, operators=None, functions=None, names=None):
+        if operators is None:
+            operators = BUDGETED_OPERATORS.copy()
+        super(BudgetedEval, self).__init__(operators, functions, names)
+        self.reset()
+
+    def reset(self):
+        self.operations = 0
+        self.max_operations = getattr(settings, 'EVALUATION_MAX_OPERATIONS', 10000)
+        self.max_bits = max_bits()
+
+    def eval(self, expr, previously_parsed=None):
+        if len(expr) > getattr(settings, 'EVALUATION_MAX_LENGTH', 10000):
+            raise BudgetExceeded("Sorry! That expression is too long")
+        self.reset()
+        return super(BudgetedEval, self).eval(expr, previously_parsed)
+
+    def _eval(self, node):
+        self.operations += 1
+        if self.operations > self.max_operations:
+            raise BudgetExceeded("Sorry! That expression takes too many steps")
+
+        value = super(BudgetedEval, self)._eval(node)
+        # Catches large integers returned by functions
+        if int_bits(value) > self.max_bits:
+            raise BudgetExceeded("Sorry! That expression produces a number which is too large")
+        return value
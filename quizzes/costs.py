@@ -0,0 +1,213 @@
+""" Static estimates of the cost of evaluating a MarkedQuestion.
+
+    The expensive part of evaluating an answer is building very large
+    integers, as in {v[0]}**{v[1]}**9. Given the ranges declared in the
+    question's choices, we bound the size (in bits) of every integer that the
+    answer, multiple choice options and sub-expressions can produce, without
+    evaluating anything. Expressions whose worst case exceeds
+    EVALUATION_MAX_BITS are reported, since budget.BudgetedEval would refuse
+    to evaluate them for some inputs.
+
+    Bounds are only computed where they can be guaranteed. Calls to the
+    instructor's functions, strings and the like give unknown bounds, which
+    are never reported; those are left to the runtime budget.
+"""
+
+from simpleeval import MAX_POWER
+
+from .budget import max_bits
+from .programs import QuestionProgram, SubExpression
+from . import samplers
+
+import ast
+import math
+import sys
+
+# Predefined functions which always return floats
+FLOAT_FUNCTIONS = ('sin', 'cos', 'tan', 'ln')
+
+class Bound(object):
+    """ An upper bound on the magnitude of a value.
+        bits - (Float) log2 of the largest possible absolute value (at least
+            0), or None if unknown
+        is_int - (Boolean) whether the value may be an integer
+    """
+    __slots__ = ('bits', 'is_int')
+
+    def __init__(self, bits, is_int):
+        self.bits = bits
+        self.is_int = is_int
+
+    @classmethod
+    def of(cls, value):
+        return cls(math.log2(max(abs(value), 1)), isinstance(value, int))
+
+    def union(self, other):
+        if self.bits is None or other.bits is None:
+            return UNKNOWN
+        return Bound(max(self.bits, other.bits), self.is_int or other.is_int)
+
+UNKNOWN = Bound(None, True)
+# Floats are never larger than this, and overflow rather than grow
+FLOAT = Bound(sys.float_info.max_exp, False)
+
+def sampler_bound(sampler):
+    """ The bound on the values drawn by a single sampler """
+    if isinstance(sampler, samplers.Literal):
+        try:
+            return Bound.of(samplers.to_number(sampler.text))
+        except ValueError:
+            return Bound.of(float(sampler.text))
+    if isinstance(sampler, samplers.IntegerRange):
+        return Bound.of(max(abs(sampler.lower), abs(sampler.upper)))
+    if isinstance(sampler, samplers.Uniform):
+        return Bound.of(float(max(abs(sampler.lower), abs(sampler.upper))))
+    return UNKNOWN
+
+def input_bounds(choices):
+    """ The bound on each variable over every choice. Choices which could not
+        be compiled are ignored.
+        <<INPUT>>
+        choices (list) of lists of samplers, as compile_choices returns
+        <<OUTPUT>>
+        (dict) mapping the index of a variable to its Bound
+    """
+    bounds = {}
+    for row in choices:
+        if isinstance(row, Exception):
+            continue
+        for index, sampler in enumerate(row):
+            bound = sampler_bound(sampler)
+            bounds[index] = bound if index not in bounds else bounds[index].union(bound)
+    return bounds
+
+
+class Estimator(object):
+    """ Walks an expression tree, recording the largest integer (in bits)
+        that any node can produce.
+        names (dict) maps names in the tree to their Bound
+    """
+    def __init__(self, names):
+        self.names = names
+        self.worst = 0
+
+    def estimate(self, node):
+        handler = getattr(self, '_' + type(node).__name__.lower(), None)
+        bound = UNKNOWN if handler is None else handler(node)
+        if bound.bits is not None and bound.is_int:
+            self.worst = max(self.worst, bound.bits)
+        return bound
+
+    def _num(self, node):
+        return self._value(node.n)
+
+    def _constant(self, node):
+        return self._value(node.value)
+
+    def _nameconstant(self, node):
+        return self._value(node.value)
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool) or value is None:
+            return Bound(0, True)
+        if isinstance(value, (int, float)):
+            return Bound.of(value)
+        return UNKNOWN
+
+    def _name(self, node):
+        return self.names.get(node.id, UNKNOWN)
+
+    def _unaryop(self, node):
+        return self.estimate(node.operand)
+
+    def _binop(self, node):
+        left = self.estimate(node.left)
+        right = self.estimate(node.right)
+        if left.bits is None or right.bits is None:
+            return UNKNOWN
+
+        is_int = left.is_int and right.is_int
+        op = node.op
+        if isinstance(op, (ast.Add, ast.Sub)):
+            return Bound(max(left.bits, right.bits) + 1, is_int)
+        if isinstance(op, ast.Mult):
+            return Bound(left.bits + right.bits, is_int)
+        if isinstance(op, ast.FloorDiv):
+            return Bound(left.bits, is_int)
+        if isinstance(op, ast.Mod):
+            return Bound(right.bits, is_int)
+        if isinstance(op, ast.Pow):
+            if not is_int:
+                return FLOAT
+            # simple_eval refuses larger exponents itself
+            exponent = MAX_POWER if right.bits > math.log2(MAX_POWER) else 2**right.bits
+            return Bound(exponent*left.bits, True)
+        if isinstance(op, ast.Div):
+            return FLOAT
+        return UNKNOWN
+
+    def _call(self, node):
+        for arg in node.args:
+            self.estimate(arg)
+        if isinstance(node.func, ast.Name) and node.func.id in FLOAT_FUNCTIONS:
+            return FLOAT
+        return UNKNOWN
+
+    def _compare(self, node):
+        self.estimate(node.left)
+        for comparator in node.comparators:
+            self.estimate(comparator)
+        return Bound(0, True)
+
+    def _ifexp(self, node):
+        self.estimate(node.test)
+        return self.estimate(node.body).union(self.estimate(node.orelse))
+
+
+def expression_bits(expression, bounds):
+    """ The worst case size, in bits, of the integers produced while
+        evaluating a compiled programs.Expression.
+    """
+    if expression is None or expression.tree is None:
+        return 0
+    names = {'_v{}_'.format(index): bound for index, bound in bounds.items()}
+    names.update({'pi': Bound.of(math.pi), 'e': Bound.of(math.e)})
+    estimator = Estimator(names)
+    estimator.estimate(expression.tree)
+    return estimator.worst
+
+def template_expressions(template, expression=None):
+    """ The compiled expressions of a template and its sub-expressions """
+    expressions = [expression] if expression is not None else []
+    for part in template.parts or []:
+        if isinstance(part, SubExpression):
+            expressions.append(part.expression)
+    return expressions
+
+def check_question(question):
+    """ Estimates the worst case cost of every expression in a question.
+        <<INPUT>>
+        question (MarkedQuestion) possibly unsaved
+        <<OUTPUT>>
+        (list) of error messages, one for each expression which exceeds
+            EVALUATION_MAX_BITS for some inputs. Empty if there are none.
+    """
+    program = QuestionProgram(question)
+    bounds = input_bounds(program.choices)
+
+    parts = [("problem", template_expressions(program.problem))]
+    parts.append(("answer", template_expressions(*program.answer)))
+    if question.q_type == "MC":
+        for index, part in enumerate(program.mc_choices):
+            parts.append(("multiple choice option {}".format(index+1),
+                          template_expressions(*part)))
+
+    messages = []
+    for name, expressions in parts:
+        worst = max([expression_bits(e, bounds) for e in expressions] + [0])
+        if worst > max_bits():
+            messages.append(("The {} can produce numbers with about {:.0f} digits,"
+                " which is more than the limit of {:.0f}.").format(
+                    name, worst*math.log10(2), max_bits()*math.log10(2)))
+    return messages
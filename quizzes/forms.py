@@ -4,6 +4,7 @@ from django.db.models import F
 from django.contrib.admin import widgets
 
 from .models import *
+from .costs import check_question
 
 class CourseForm(forms.ModelForm):
     """ Used for creating a course, with the option of adding an administrator
@@ -28,8 +29,10 @@ class StaffForm(forms.Form):
         super(StaffForm, self).__init__(*args, **kwargs)
         self.fields['course'].queryset = queryset
 
-class AddStudentsForm(forms.ModelForm):
-    """ Used for adding students to a course"""
+class AddStudentsForm(forms.Form):
+    """ Used for adding students to a course. The file is read straight from
+    the upload, rather than saved.
+    """
 
     course   = forms.ModelChoiceField(queryset=None)
     doc_file = forms.FileField()
@@ -39,16 +42,12 @@ class AddStudentsForm(forms.ModelForm):
         super(AddStudentsForm, self).__init__(*args, **kwargs)
         self.fields['course'].queryset = queryset
 
-    class Meta:
-        model = CSVFile
-        fields = ('doc_file',)
-
 
 class QuizForm(forms.ModelForm):
     """ Simple model form for creating/editing quizzes"""
     class Meta:
         model = Quiz
-        exclude = ['out_of']
+        exclude = ['out_of', 'version']
 
 
 class MarkedQuestionForm(forms.ModelForm):
@@ -86,3 +85,16 @@ class MarkedQuestionForm(forms.ModelForm):
         field_classes = {
             'category': forms.IntegerField
         }
+
+    def clean(self):
+        """ Rejects questions whose expressions can be too expensive to
+            evaluate for the currently declared choices.
+        """
+        cleaned_data = super(MarkedQuestionForm, self).clean()
+        if self.errors:
+            return cleaned_data
+
+        question = MarkedQuestion(choices=self.instance.choices, **cleaned_data)
+        for message in check_question(question):
+            self.add_error(None, message)
+        return cleaned_data
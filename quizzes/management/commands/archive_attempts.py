@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quizzes import archive
+
+class Command(BaseCommand):
+    """ Moves finished attempts at quizzes which are over into the archive.
+        See quizzes.archive. Course status defaults to off and is only used
+        for the "(Currently Live)" label, so nothing is archived unless asked
+        for, and attempts at quizzes which have not expired are never
+        archived.
+    """
+    help = "Archives finished attempts at inactive courses or long expired quizzes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inactive', action='store_true',
+            help="Archive attempts at expired quizzes of courses whose status is off")
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+            help="Archive attempts at quizzes which expired more than DAYS days ago")
+        parser.add_argument('--chunk-size', type=int, default=archive.CHUNK_SIZE,
+            help="Attempts to archive in each transaction (default {})".format(archive.CHUNK_SIZE))
+        parser.add_argument('--dry-run', action='store_true',
+            help="Only count the attempts which would be archived")
+
+    def handle(self, *args, **options):
+        if not options['inactive'] and options['older_than'] is None:
+            raise CommandError("Give --inactive and/or --older-than")
+
+        results = archive.archivable(options['inactive'], options['older_than'])
+        if options['dry_run']:
+            self.stdout.write("Would archive {} attempts".format(results.count()))
+            return
+        archived = archive.archive_attempts(results, options['chunk_size'])
+        self.stdout.write("Archived {} attempts".format(archived))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quizzes.models import Course
+from quizzes import analytics
+
+class Command(BaseCommand):
+    """ Writes a columnar snapshot of every attempt at a course's quizzes, for
+        the item_analysis command. See quizzes/analytics.py.
+    """
+    help = "Snapshots a course's quiz results as NumPy arrays for item analysis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('course', type=int, help="The primary key of the course")
+        parser.add_argument('directory', help="Where to write the snapshot")
+
+    def handle(self, *args, **options):
+        if analytics.np is None:
+            raise CommandError("NumPy is required for analytics snapshots")
+        try:
+            course = Course.objects.get(pk=options['course'])
+        except Course.DoesNotExist:
+            raise CommandError("There is no course {}".format(options['course']))
+
+        meta = analytics.build_snapshot(course, options['directory'])
+        self.stdout.write("Wrote {} attempts and {} answers of {} to {}".format(
+            meta['attempts'], meta['answers'], course.name, options['directory']))
+        if meta['unrecovered_options']:
+            self.stderr.write("The options of {} multiple choice answers could not be "
+                              "evaluated".format(meta['unrecovered_options']))
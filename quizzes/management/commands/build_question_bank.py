@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.utils import timezone
+
+from quizzes.models import Quiz
+from quizzes.bank import build_bank
+
+import time
+
+class Command(BaseCommand):
+    """ Builds the shared question bank from every quiz which has not yet
+        expired. With --interval the command keeps running as the loader
+        process, rebuilding the bank whenever a quiz changes.
+    """
+    help = "Builds the shared, memory mapped question bank"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.QUESTION_BANK_PATH,
+            help="Path of the control file (default QUESTION_BANK_PATH)")
+        parser.add_argument('--interval', type=float, default=0,
+            help="Keep running, checking for changes every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError("No path given and QUESTION_BANK_PATH is not set")
+
+        built = None
+        while True:
+            quizzes = list(Quiz.objects.filter(expires__gt=timezone.now()).order_by('pk'))
+            # Quiz versions change whenever a quiz or its questions are edited
+            signature = [(quiz.pk, quiz.version) for quiz in quizzes]
+            if signature != built:
+                version = build_bank(path, quizzes)
+                built = signature
+                self.stdout.write("Built version {} with {} quizzes".format(
+                    version, len(quizzes)))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
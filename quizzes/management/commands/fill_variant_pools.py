@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+
+from quizzes.models import MarkedQuestion
+
+import time
+
+class Command(BaseCommand):
+    """ Refills the pools of pre-generated QuestionVariants, so that
+        generate_next_question does not have to evaluate questions while the
+        student waits. By default only quizzes which have not yet expired are
+        filled. With --interval the command keeps running as a worker. The
+        pools are only used if QUESTION_VARIANT_POOLS is on.
+    """
+    help = "Refills the pre-generated question variant pools"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int,
+            default=settings.QUESTION_VARIANT_POOL_SIZE,
+            help="Number of variants to keep for each question")
+        parser.add_argument('--quiz', type=int, action='append', dest='quizzes',
+            help="Only fill the pools of this quiz (may be repeated)")
+        parser.add_argument('--interval', type=float, default=0,
+            help="Keep running, refilling every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'QUESTION_VARIANT_POOLS', False):
+            self.stderr.write("QUESTION_VARIANT_POOLS is off, so the pools will not be used")
+        while True:
+            self.fill(options['size'], options['quizzes'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def fill(self, size, quizzes):
+        questions = MarkedQuestion.objects.exclude(choices__isnull=True).exclude(choices='')
+        if quizzes:
+            questions = questions.filter(quiz__pk__in=quizzes)
+        else:
+            questions = questions.filter(quiz__expires__gt=timezone.now())
+
+        created = 0
+        for question in questions.iterator():
+            try:
+                created += question.refill_variants(size)
+            except Exception as e:
+                # A broken question should not stop the other pools filling
+                self.stderr.write("MarkedQuestion {}: {}".format(question.pk, e))
+
+        self.stdout.write("Created {} variants".format(created))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from quizzes.models import StudentQuizResult
+
+import time
+
+class Command(BaseCommand):
+    """ Closes the attempts left in progress at quizzes which have expired.
+        Meant to be run periodically, for example from cron, or kept running
+        with --interval. See StudentQuizResult.finalize_expired.
+    """
+    help = "Finalizes the in-progress attempts at expired quizzes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help="Attempts to finalize in each transaction (default 1000)")
+        parser.add_argument('--interval', type=float, default=0,
+            help="Keep running, finalizing every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            finalized = StudentQuizResult.finalize_expired(chunk_size=options['chunk_size'])
+            self.stdout.write("Finalized {} attempts".format(finalized))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quizzes import analytics
+
+import json
+
+class Command(BaseCommand):
+    """ Runs the item analysis reports over a snapshot written by
+        build_analytics_snapshot. The database is not used.
+    """
+    help = "Reports question difficulty, discrimination, variant fairness and distractor usage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="The snapshot to analyse")
+        parser.add_argument('--report', action='append', dest='reports',
+            choices=sorted(analytics.REPORTS),
+            help="Only run this report (may be repeated)")
+        parser.add_argument('--json', action='store_true',
+            help="Write the reports as JSON")
+
+    def handle(self, *args, **options):
+        if analytics.np is None:
+            raise CommandError("NumPy is required for item analysis")
+        try:
+            snapshot = analytics.load_snapshot(options['directory'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        names = options['reports'] or ['difficulty', 'discrimination', 'fairness', 'distractors']
+        reports = dict((name, analytics.REPORTS[name](snapshot)) for name in names)
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        self.stdout.write("{} - snapshot of {}".format(
+            snapshot.meta['course_name'], snapshot.meta['taken']))
+        for name in names:
+            self.stdout.write("")
+            getattr(self, 'write_' + name)(reports[name])
+
+    def write_difficulty(self, report):
+        self.stdout.write("Difficulty (proportion correct)")
+        self.stdout.write("{:>8} {:>8} {:>8} {:>8} {:>10}".format(
+            'Quiz', 'Category', 'Question', 'Answered', 'Difficulty'))
+        for row in report:
+            self.stdout.write("{quiz:>8} {category:>8} {question:>8} {answered:>8} "
+                              "{difficulty:>10.3f}".format(**row))
+
+    def write_discrimination(self, report):
+        self.stdout.write("Discrimination (corrected item-total correlation)")
+        self.stdout.write("{:>8} {:>8} {:>14}".format('Question', 'Answered', 'Discrimination'))
+        for row in report:
+            value = row['discrimination']
+            self.stdout.write("{:>8} {:>8} {:>14}".format(
+                row['question'], row['answered'], '-' if value is None else '{:.3f}'.format(value)))
+
+    def write_fairness(self, report):
+        self.stdout.write("Variant fairness (chi-squared across each category's questions)")
+        for pool in report:
+            self.stdout.write("Quiz {quiz}, category {category}: {answered} answers, "
+                              "difficulty {difficulty:.3f}, chi2 {chi2:.2f} on {dof} dof".format(**pool))
+            for row in pool['questions']:
+                self.stdout.write("    question {question:>8} {answered:>8} answers, "
+                                  "difficulty {difficulty:.3f}".format(**row))
+
+    def write_distractors(self, report):
+        self.stdout.write("Distractor usage (the last option is the correct answer)")
+        for row in report:
+            self.stdout.write("Question {:>8}: {}".format(
+                row['question'], ' '.join(str(count) for count in row['counts'])))
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum, Value
+from django.db.models.functions import Coalesce
+
+from quizzes.models import (StudentQuestionResult, ArchivedQuizResult, MarkedQuestion,
+                            QuestionStats)
+from quizzes import attempts
+
+class Command(BaseCommand):
+    """ Recomputes the QuestionStats from every answered StudentQuestionResult,
+        for existing data or after results have been changed by hand. They are
+        otherwise kept up to date by submit_answer. The totals are computed by
+        the database in a single grouped query, which is streamed and written
+        in batches. The answers of archived attempts, which still count, are
+        added from their compressed questions.
+    """
+    help = "Rebuilds the per-question statistics from the quiz results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quiz', type=int, action='append', dest='quizzes',
+            help="Only rebuild the statistics of this quiz (may be repeated)")
+
+    def handle(self, *args, **options):
+        answers = StudentQuestionResult.objects.filter(
+            question__isnull=False, guess_string__isnull=False)
+        stats = QuestionStats.objects.all()
+        archived = ArchivedQuizResult.objects.all()
+        questions = MarkedQuestion.objects.all()
+        if options['quizzes']:
+            answers = answers.filter(question__quiz__pk__in=options['quizzes'])
+            stats = stats.filter(question__quiz__pk__in=options['quizzes'])
+            archived = archived.filter(quiz__pk__in=options['quizzes'])
+            questions = questions.filter(quiz__pk__in=options['quizzes'])
+
+        totals = answers.order_by('question').values('question').annotate(
+            answered=Count('pk'), correct=Sum('score'), attempt_total=Sum(Coalesce('attempt__attempt', Value(1))))
+        archived_totals = self.archived_totals(archived, set(questions.values_list('pk', flat=True)))
+        rebuilt = 0
+        with transaction.atomic():
+            stats.delete()
+            batch = []
+            for row in totals.iterator():
+                more = archived_totals.pop(row['question'], (0, 0, 0))
+                batch.append(QuestionStats(
+                    question_id=row['question'],
+                    answered=row['answered'] + more[0],
+                    correct=(row['correct'] or 0) + more[1],
+                    attempt_total=row['attempt_total'] + more[2]))
+                if len(batch) >= 1000:
+                    QuestionStats.objects.bulk_create(batch)
+                    rebuilt += len(batch)
+                    batch = []
+            # Questions only answered in archived attempts
+            batch.extend(QuestionStats(question_id=question_id, answered=answered,
+                                       correct=correct, attempt_total=attempt_total)
+                         for question_id, (answered, correct, attempt_total)
+                         in archived_totals.items())
+            QuestionStats.objects.bulk_create(batch, batch_size=1000)
+            rebuilt += len(batch)
+
+        self.stdout.write("Rebuilt the statistics of {} questions".format(rebuilt))
+
+    def archived_totals(self, archived, questions):
+        """ The answered, correct and attempt_total of the archived answers to
+            each of questions, by question pk
+        """
+        question, score, guess_string = (attempts.COLUMNS.index(column)
+                                         for column in ('question_id', 'score', 'guess_string'))
+        totals = {}
+        for attempt, data in archived.values_list('attempt', 'questions').iterator():
+            for row in attempts.decompress_rows(data):
+                if row[guess_string] is None or row[question] not in questions:
+                    continue
+                answered, correct, attempt_total = totals.get(row[question], (0, 0, 0))
+                totals[row[question]] = (answered + 1, correct + (row[score] or 0),
+                                         attempt_total + (attempt or 1))
+        return totals
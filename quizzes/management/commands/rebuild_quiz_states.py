@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from quizzes.models import StudentQuizResult, StudentQuizState, ArchivedQuizResult
+
+from heapq import merge
+from itertools import groupby
+
+class Command(BaseCommand):
+    """ Recomputes every StudentQuizState from the StudentQuizResults and
+        ArchivedQuizResults, for existing data or after results have been
+        changed by hand. States are
+        otherwise kept up to date by start_quiz and submit_answer.
+    """
+    help = "Rebuilds the per-student quiz states from the quiz results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quiz', type=int, action='append', dest='quizzes',
+            help="Only rebuild the states of this quiz (may be repeated)")
+
+    def handle(self, *args, **options):
+        results = StudentQuizResult.objects.order_by('student', 'quiz')
+        archived = ArchivedQuizResult.objects.order_by('student', 'quiz')
+        states = StudentQuizState.objects.all()
+        if options['quizzes']:
+            results = results.filter(quiz__pk__in=options['quizzes'])
+            archived = archived.filter(quiz__pk__in=options['quizzes'])
+            states = states.filter(quiz__pk__in=options['quizzes'])
+
+        columns = ('student', 'quiz', 'pk', 'attempt', 'cur_quest', 'score')
+        # Archived attempts have no pk which latest could refer to
+        archived = (row[:2] + (None,) + row[3:]
+                    for row in archived.values_list(*columns).iterator())
+        rows = merge(results.values_list(*columns).iterator(), archived, key=lambda row: row[:2])
+        rebuilt = 0
+        with transaction.atomic():
+            states.delete()
+            batch = []
+            for (student_id, quiz_id), group in groupby(rows, lambda row: row[:2]):
+                batch.append(StudentQuizState.summarize(
+                    student_id, quiz_id, [row[2:] for row in group]))
+                if len(batch) >= 1000:
+                    StudentQuizState.objects.bulk_create(batch)
+                    rebuilt += len(batch)
+                    batch = []
+            StudentQuizState.objects.bulk_create(batch)
+            rebuilt += len(batch)
+
+        self.stdout.write("Rebuilt {} quiz states".format(rebuilt))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quizzes.models import MarkedQuestion
+from quizzes.regrade import regrade_question, CHUNK_SIZE
+
+class Command(BaseCommand):
+    """ Regrades every result generated from a MarkedQuestion against its
+        current answer. See quizzes/regrade.py.
+    """
+    help = "Regrades the answers to a question after it has been corrected"
+
+    def add_arguments(self, parser):
+        parser.add_argument('question', type=int, help="The primary key of the MarkedQuestion")
+        parser.add_argument('--dry-run', action='store_true',
+            help="List what would change without changing it")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+            help="Results to regrade in each transaction (default {})".format(CHUNK_SIZE))
+
+    def handle(self, *args, **options):
+        try:
+            question = MarkedQuestion.objects.select_related('quiz').get(pk=options['question'])
+        except MarkedQuestion.DoesNotExist:
+            raise CommandError("There is no question {}".format(options['question']))
+
+        regrade = regrade_question(question, dry_run=options['dry_run'],
+                                   chunk_size=options['chunk_size'])
+        for change in regrade.changes:
+            self.stdout.write("Attempt {} question {}: answer {!r} -> {!r}, score {} -> {}".format(
+                change.attempt_id, change.number, change.old_answer, change.new_answer,
+                change.old_score, change.new_score))
+        self.stdout.write("{}{}".format("Dry run: " if options['dry_run'] else '', regrade))
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from quizzes import routers
+
+import sqlite3
+import time
+
+class Command(BaseCommand):
+    """ Copies an SQLite 'default' database to the SQLite replica named by
+        REPLICA_DATABASE, so that replica routing can be run without a
+        database server. The copy is made with SQLite's online backup, so
+        the site can keep writing, in a single step, so readers of the
+        replica see either the old copy or the new one. The file is written
+        in place rather than replaced, since open connections would keep
+        reading a replaced file. Other databases should use their own
+        replication instead.
+    """
+    help = "Copies the SQLite database to its replica"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+            help="Keep running, copying every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        alias = routers.replica_alias()
+        if alias is None:
+            raise CommandError("REPLICA_DATABASE is not set to a database alias")
+        source, replica = settings.DATABASES[DEFAULT_DB_ALIAS], settings.DATABASES[alias]
+        for database in (source, replica):
+            if database['ENGINE'] != 'django.db.backends.sqlite3':
+                raise CommandError("Only SQLite databases can be copied")
+
+        while True:
+            started = time.time()
+            self.copy(source['NAME'], replica['NAME'])
+            self.stdout.write("Copied to {} in {:.2f}s".format(replica['NAME'], time.time() - started))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def copy(self, source_name, replica_name):
+        source = sqlite3.connect(source_name)
+        try:
+            replica = sqlite3.connect(replica_name, timeout=30)
+            try:
+                source.backup(replica)
+            finally:
+                replica.close()
+        finally:
+            source.close()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quizzes.models import Course, UserMembership
+
+import csv
+
+class Command(BaseCommand):
+    """ Makes a course's students those of a full roster, such as the
+        registrar's nightly export, changing only the difference. See
+        UserMembership.sync_roster.
+    """
+    help = "Synchronizes a course's students with a roster CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('course', type=int, help="Primary key of the course")
+        parser.add_argument('roster',
+            help="CSV file whose first column is the username of every student")
+        parser.add_argument('--dry-run', action='store_true',
+            help="Only show what would change")
+
+    def handle(self, *args, **options):
+        try:
+            course = Course.objects.get(pk=options['course'])
+        except Course.DoesNotExist:
+            raise CommandError("No course {}".format(options['course']))
+
+        with open(options['roster'], 'rt', encoding='utf-8-sig', newline='') as roster:
+            usernames = [row[0] for row in csv.reader(roster) if row]
+
+        if options['dry_run']:
+            diff = UserMembership.roster_diff(course, usernames)
+        else:
+            diff = UserMembership.sync_roster(course, usernames)
+        self.stdout.write("{}{}: {} added, {} removed, {} unchanged, {} duplicate rows".format(
+            "Would synchronize " if options['dry_run'] else "Synchronized ", course.name,
+            len(diff.add), len(diff.remove), diff.kept, diff.duplicates))
+        if options['verbosity'] > 1:
+            for username in diff.add:
+                self.stdout.write("+ {}".format(username))
+            for username in diff.remove:
+                self.stdout.write("- {}".format(username))
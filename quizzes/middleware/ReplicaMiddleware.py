@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.deprecation import MiddlewareMixin
+
+from quizzes import routers
+
+class ReplicaMiddleware(MiddlewareMixin):
+    """ Keeps a user's reads on the primary database for
+    REPLICA_PIN_TIMEOUT seconds after one of their requests writes, so that
+    the replica's lag never hides their own answers. See quizzes.routers.
+    Must come after AuthenticationMiddleware.
+    """
+
+    def pin_key(self, request):
+        if routers.replica_alias() is None or not request.user.is_authenticated:
+            return None
+        return 'replica_pin:{}'.format(request.user.pk)
+
+    def process_request(self, request):
+        key = self.pin_key(request)
+        routers.reset(pinned=key is not None and cache.get(key) is not None)
+
+    def process_response(self, request, response):
+        if routers.is_pinned():
+            key = self.pin_key(request)
+            if key is not None:
+                cache.set(key, True, settings.REPLICA_PIN_TIMEOUT)
+        return response
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0002_markedquestion_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField()),
+                ('inputs', models.TextField()),
+                ('answer', models.TextField()),
+                ('mc_choices', models.TextField(default='[]')),
+                ('problem', models.TextField()),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='quizzes.MarkedQuestion')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='questionvariant',
+            index_together=set([('question', 'version')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0004_quiz_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentQuestionResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('inputs', models.TextField()),
+                ('answer', models.TextField()),
+                ('guess', models.TextField(null=True)),
+                ('guess_string', models.TextField(null=True)),
+                ('score', models.IntegerField(default=0)),
+                ('q_type', models.CharField(default='D', max_length=2)),
+                ('mc_choices', models.TextField(null=True)),
+                ('attempt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='questions', to='quizzes.StudentQuizResult')),
+                ('question', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='quizzes.MarkedQuestion')),
+            ],
+            options={
+                'verbose_name': 'Question Result',
+                'ordering': ['attempt', 'number'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='studentquestionresult',
+            unique_together=set([('attempt', 'number')]),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import json
+
+BATCH_SIZE = 1000
+
+def backfill(apps, schema_editor):
+    """ Creates a StudentQuestionResult for every question in the legacy
+        StudentQuizResult.result column. Attempts which already have rows are
+        skipped.
+    """
+    StudentQuizResult = apps.get_model('quizzes', 'StudentQuizResult')
+    StudentQuestionResult = apps.get_model('quizzes', 'StudentQuestionResult')
+    MarkedQuestion = apps.get_model('quizzes', 'MarkedQuestion')
+
+    existing_questions = set(MarkedQuestion.objects.values_list('pk', flat=True))
+    done = set(StudentQuestionResult.objects.values_list('attempt_id', flat=True).distinct())
+
+    batch = []
+    for sqr_pk, result in StudentQuizResult.objects.values_list('pk', 'result').iterator():
+        if sqr_pk in done:
+            continue
+        try:
+            result = json.loads(result or '{}')
+        except ValueError:
+            continue
+
+        for number, data in result.items():
+            question_id = int(data['pk']) if data.get('pk') else None
+            batch.append(StudentQuestionResult(
+                attempt_id=sqr_pk,
+                number=int(number),
+                question_id=question_id if question_id in existing_questions else None,
+                inputs=data.get('inputs', ''),
+                answer=json.dumps(data.get('answer')),
+                guess=None if data.get('guess') is None else json.dumps(data['guess']),
+                guess_string=data.get('guess_string'),
+                score=int(data.get('score') or 0),
+                q_type=data.get('type', 'D'),
+                mc_choices=json.dumps(data['mc_choices']) if 'mc_choices' in data else None,
+            ))
+
+        if len(batch) >= BATCH_SIZE:
+            StudentQuestionResult.objects.bulk_create(batch)
+            batch = []
+
+    StudentQuestionResult.objects.bulk_create(batch)
+
+def restore(apps, schema_editor):
+    """ Writes the rows back into the legacy result column """
+    StudentQuizResult = apps.get_model('quizzes', 'StudentQuizResult')
+    StudentQuestionResult = apps.get_model('quizzes', 'StudentQuestionResult')
+
+    results = {}
+    for record in StudentQuestionResult.objects.order_by('attempt', 'number').iterator():
+        data = {
+            'pk': str(record.question_id),
+            'inputs': record.inputs,
+            'score': str(record.score),
+            'answer': json.loads(record.answer),
+            'guess': None if record.guess is None else json.loads(record.guess),
+            'type': record.q_type,
+        }
+        if record.guess_string is not None:
+            data['guess_string'] = record.guess_string
+        if record.mc_choices is not None:
+            data['mc_choices'] = json.loads(record.mc_choices)
+        results.setdefault(record.attempt_id, {})[str(record.number)] = data
+
+    for sqr_pk, result in results.items():
+        StudentQuizResult.objects.filter(pk=sqr_pk).update(result=json.dumps(result))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0005_studentquestionresult'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, restore),
+    ]
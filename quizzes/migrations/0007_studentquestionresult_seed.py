@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0006_backfill_studentquestionresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentquestionresult',
+            name='seed',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='studentquestionresult',
+            name='version',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='studentquestionresult',
+            name='answer',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='studentquestionresult',
+            name='inputs',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0007_studentquestionresult_seed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quiz',
+            name='generate_upfront',
+            field=models.BooleanField(default=False, verbose_name='Generate all questions at start'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:44
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+
+def renumber_duplicates(apps, schema_editor):
+    """ Concurrent starts could create two attempts with the same number.
+        The attempts of each affected student and quiz are renumbered in
+        order of creation, and their StudentQuizState is dropped, to be
+        rebuilt when next used.
+    """
+    StudentQuizResult = apps.get_model('quizzes', 'StudentQuizResult')
+    StudentQuizState = apps.get_model('quizzes', 'StudentQuizState')
+
+    duplicated = (StudentQuizResult.objects.exclude(attempt__isnull=True)
+        .values('student', 'quiz', 'attempt').annotate(count=Count('pk'))
+        .filter(count__gt=1).values_list('student', 'quiz').distinct())
+    for student_id, quiz_id in set(duplicated):
+        results = StudentQuizResult.objects.filter(
+            student_id=student_id, quiz_id=quiz_id).order_by('attempt', 'pk')
+        for number, pk in enumerate(results.values_list('pk', flat=True), 1):
+            StudentQuizResult.objects.filter(pk=pk).update(attempt=number)
+        StudentQuizState.objects.filter(student_id=student_id, quiz_id=quiz_id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('quizzes', '0009_studentquizstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='studentquizresult',
+            unique_together=set([('student', 'quiz', 'attempt')]),
+        ),
+    ]
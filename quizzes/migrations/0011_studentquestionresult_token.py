@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0010_unique_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentquestionresult',
+            name='token',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 04:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0012_questionstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentquizresult',
+            name='finalized',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 05:01
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('quizzes', '0013_studentquizresult_finalized'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedQuizResult',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('attempt', models.IntegerField(null=True)),
+                ('cur_quest', models.IntegerField(null=True)),
+                ('score', models.IntegerField(null=True)),
+                ('finalized', models.BooleanField(default=False)),
+                ('questions', models.BinaryField()),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('quiz', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='quizzes.Quiz')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Quiz Result',
+            },
+        ),
+    ]
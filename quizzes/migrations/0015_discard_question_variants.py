@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def discard_variants(apps, schema_editor):
+    """ Variants were filled by a batch evaluation which could give the wrong
+        sign for powers of negative inputs. They are only a cache, so they are
+        dropped, and fill_variant_pools generates them again.
+    """
+    QuestionVariant = apps.get_model('quizzes', 'QuestionVariant')
+    QuestionVariant.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0014_archivedquizresult'),
+    ]
+
+    operations = [
+        migrations.RunPython(discard_variants, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,9 @@
-from django.db import models
-from django.db.models import Max
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import Max, F, Q, Case, When, Value, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_protect
@@ -7,10 +11,29 @@ from django.views.decorators.csrf import csrf_protect
 # Row based permissions
 from guardian.models import UserObjectPermission
 
+from .programs import get_program, forget_program
+from .workers import evaluate_batch
+from .snapshots import get_snapshot
+from . import attempts
+
+from collections import defaultdict, namedtuple
 import re
 import json
 import random
 
+def save_unversioned(instance, model, *args, **kwargs):
+    """ Saves a Quiz or MarkedQuestion, leaving out its version unless it is
+        being inserted. The version is only changed with an F() UPDATE, so
+        that saving a stale instance cannot undo a concurrent bump, after
+        which two states would share a version and its cached programs or
+        snapshots.
+    """
+    if (not instance._state.adding and not args and not kwargs.get('force_insert')
+            and kwargs.get('update_fields') is None):
+        kwargs['update_fields'] = [field.name for field in model._meta.concrete_fields
+                                   if not field.primary_key and field.name != 'version']
+    super(model, instance).save(*args, **kwargs)
+
 class Course(models.Model):
     """ A container for storing multiple quizzes. Will only be visible to students
         who are enrolled in that course.
@@ -59,14 +82,173 @@ class Course(models.Model):
             ("can_edit_quiz", "Can edit the quiz"),
         )
 
+# The outcome of UserMembership.enroll
+Enrollment = namedtuple('Enrollment', ['added', 'created', 'existing', 'duplicates'])
+# The difference between a course's students and a roster; see
+# UserMembership.roster_diff
+RosterDiff = namedtuple('RosterDiff', ['add', 'remove', 'kept', 'duplicates'])
+
 class UserMembership(models.Model):
     """ Tracks which courses a student/ta can see. General use should be to get
     a UserMembership object according to user, then the um.courses.add(course)
-    command.
+    command. To add many students at once, use enroll, and to match a course
+    to a full roster, sync_roster.
     """
     user = models.ForeignKey(User)
     courses = models.ManyToManyField(Course)
 
+    # Usernames looked up, and rows inserted, per query by enroll
+    ENROLL_CHUNK_SIZE = 500
+
+    @staticmethod
+    def unique_usernames(usernames):
+        """ Returns the distinct usernames, in order and with surrounding
+            whitespace removed, and how many repeated an earlier one. Blank
+            usernames are skipped.
+        """
+        unique, seen, duplicates = [], set(), 0
+        for username in usernames:
+            username = username.strip()
+            if not username:
+                continue
+            if username in seen:
+                duplicates += 1
+                continue
+            seen.add(username)
+            unique.append(username)
+        return unique, duplicates
+
+    @classmethod
+    def resolve(cls, course, usernames, chunk_size=ENROLL_CHUNK_SIZE):
+        """ Looks up the Users with usernames, their memberships and whether
+            they are in course, with three queries per chunk of usernames.
+            <<INPUT>>
+            course (Course)
+            usernames (list) of distinct Strings
+            chunk_size (Integer) how many usernames to look up per query
+            <<OUTPUT>>
+            users (dict) username to User pk, of those which exist
+            memberships (dict) User pk to the pk of their first UserMembership
+            enrolled (set) of the pks of the Users who are in course
+        """
+        users, memberships, enrolled = {}, {}, set()
+        for start in range(0, len(usernames), chunk_size):
+            found = dict(User.objects.filter(
+                username__in=usernames[start:start+chunk_size]).values_list('username', 'pk'))
+            users.update(found)
+            # Latest first, so that the first membership is kept
+            memberships.update(cls.objects.filter(user__in=found.values()).order_by(
+                '-pk').values_list('user', 'pk'))
+            enrolled.update(cls.courses.through.objects.filter(
+                course=course, usermembership__user__in=found.values()).values_list(
+                'usermembership__user', flat=True))
+        return users, memberships, enrolled
+
+    @classmethod
+    def enroll(cls, course, usernames, chunk_size=ENROLL_CHUNK_SIZE):
+        """ Adds the students with usernames to course, creating the accounts
+            and memberships which do not exist yet. The students are looked up
+            in chunks, and the missing accounts, memberships and course links
+            are inserted with bulk_create in one transaction, so enrolling a
+            whole class takes a few queries per chunk rather than several per
+            student. It is retried if a concurrent enrollment added the same
+            student first.
+            <<INPUT>>
+            course (Course)
+            usernames (iterable) of Strings, which may repeat
+            chunk_size (Integer) how many usernames to look up, or rows to
+                insert, per query
+            <<OUTPUT>>
+            (Enrollment) how many students were added to the course, for how
+            many of them an account was created, how many were in the course
+            already, and how many usernames repeated an earlier one
+        """
+        usernames, duplicates = cls.unique_usernames(usernames)
+        for retry in range(3):
+            # Read before the transaction, so that SQLite does not have to
+            # upgrade a read lock
+            users, memberships, enrolled = cls.resolve(course, usernames, chunk_size)
+            try:
+                with transaction.atomic():
+                    created = cls._add_students(course, usernames, users, memberships,
+                                                enrolled, chunk_size)
+                return Enrollment(len(usernames) - len(enrolled), created,
+                                  len(enrolled), duplicates)
+            except IntegrityError:
+                # A concurrent enrollment created one of the students
+                if retry == 2:
+                    raise
+
+    @classmethod
+    def roster_diff(cls, course, usernames):
+        """ Compares the students of course with a full roster, reading the
+            course's members in one query.
+            <<INPUT>>
+            course (Course)
+            usernames (iterable) of Strings, the roster, which may repeat
+            <<OUTPUT>>
+            (RosterDiff) the usernames to add and to remove, sorted, how many
+            students are on both, and how many usernames repeated an earlier
+            one. Staff are never removed.
+        """
+        usernames, duplicates = cls.unique_usernames(usernames)
+        roster = set(usernames)
+        current = dict(User.objects.filter(usermembership__courses=course).values_list(
+            'username', 'is_staff').distinct())
+        add = sorted(roster.difference(current))
+        remove = sorted(username for username, is_staff in current.items()
+                        if username not in roster and not is_staff)
+        return RosterDiff(add, remove, len(roster) - len(add), duplicates)
+
+    @classmethod
+    def sync_roster(cls, course, usernames, chunk_size=ENROLL_CHUNK_SIZE):
+        """ Makes the students of course those of a full roster, adding and
+            removing only the difference, in bulk and in one transaction.
+            Removed students only lose the course; their accounts, attempts
+            and other courses are kept.
+            <<INPUT>>
+            course (Course)
+            usernames (iterable) of Strings, the roster, which may repeat
+            chunk_size (Integer) as for enroll
+            <<OUTPUT>>
+            (RosterDiff) what was changed
+        """
+        diff = cls.roster_diff(course, usernames)
+        through = cls.courses.through
+        with transaction.atomic():
+            for start in range(0, len(diff.remove), chunk_size):
+                through.objects.filter(course=course, usermembership__user__username__in=
+                                       diff.remove[start:start+chunk_size]).delete()
+            if diff.add:
+                cls.enroll(course, diff.add, chunk_size)
+        return diff
+
+    @classmethod
+    def _add_students(cls, course, usernames, users, memberships, enrolled, chunk_size):
+        """ Inserts what resolve found missing, and returns how many accounts
+            were created
+        """
+        new = [username for username in usernames if username not in users]
+        User.objects.bulk_create([User(username=username) for username in new],
+                                 batch_size=chunk_size)
+        for start in range(0, len(new), chunk_size):
+            users.update(User.objects.filter(
+                username__in=new[start:start+chunk_size]).values_list('username', 'pk'))
+
+        lonely = [users[username] for username in usernames if users[username] not in memberships]
+        cls.objects.bulk_create([cls(user_id=user_id) for user_id in lonely],
+                                batch_size=chunk_size)
+        for start in range(0, len(lonely), chunk_size):
+            memberships.update(cls.objects.filter(
+                user__in=lonely[start:start+chunk_size]).values_list('user', 'pk'))
+
+        through = cls.courses.through
+        through.objects.bulk_create([
+            through(usermembership_id=memberships[users[username]], course_id=course.pk)
+            for username in usernames if users[username] not in enrolled
+        ], batch_size=chunk_size)
+        return len(new)
+
     def __str__(self):
         course_string = ''
         for course in self.courses.all():
@@ -87,6 +269,12 @@ class Quiz(models.Model):
             students
         expires - (DateTimeField) The date on which the quiz closes. 
         out_of - (IntegerField) The number of different MarkedQuestion pools. 
+        generate_upfront - (BooleanField) Whether all of the questions of an
+            attempt are generated when it starts, rather than one at a time
+            as they are answered.
+        version - (IntegerField) Incremented whenever the quiz or one of its
+            MarkedQuestions changes, so that cached snapshots of the quiz are
+            replaced.
     """
     course  = models.ForeignKey(Course, related_name='quizzes')
     name    = models.CharField("Name", max_length=200)
@@ -95,6 +283,8 @@ class Quiz(models.Model):
     live    = models.DateTimeField("Live on")
     expires = models.DateTimeField("Expires on")
     out_of  = models.IntegerField("Points", default=1)
+    generate_upfront = models.BooleanField("Generate all questions at start", default=False)
+    version = models.IntegerField(default=1)
 
     class Meta:
         verbose_name = "Quiz"
@@ -108,7 +298,30 @@ class Quiz(models.Model):
         self.out_of = self.markedquestion_set.aggregate(Max('category'))['category__max']
         if not self.out_of: # New quiz, so markedquestion_set is empty
             self.out_of = 0
-        self.save()
+        self.save(update_fields=['out_of'])
+        self.bump_version()
+
+    def save(self, *args, **kwargs):
+        save_unversioned(self, Quiz, *args, **kwargs)
+
+    def bump_version(self):
+        """ Marks the cached snapshots of this quiz as stale """
+        Quiz.objects.filter(pk=self.pk).update(version=F('version') + 1)
+        self.refresh_from_db(fields=['version'])
+
+    def get_snapshot(self):
+        """ Returns the (cached) QuizSnapshot for this version of the quiz """
+        return get_snapshot(self)
+
+    def get_question(self, pk):
+        """ Returns the MarkedQuestion with the given pk from the snapshot of
+            this quiz, falling back to the database for questions which are no
+            longer part of it.
+        """
+        question = self.get_snapshot().get_question(pk)
+        if question is None:
+            question = MarkedQuestion.objects.get(pk=int(pk))
+        return question
 
     def get_random_question(self, category):
         """ Returns a random question with foreign key (self) and the given category
@@ -116,11 +329,14 @@ class Quiz(models.Model):
             Output: (MarkedQuestion) object
         """
         
-        return random.choice(self.markedquestion_set.filter(category=category))
+        return self.get_snapshot().random_question(category)
 
     def __str__(self):
         return self.name
 
+# Number of variants at the head of a pool which pop_variant chooses from
+VARIANT_WINDOW = 16
+
 class MarkedQuestion(models.Model):
     """ An instance of a question within a Quiz object. These are designed to
         have randomized inputs, and additionally can be assigned to a
@@ -145,6 +361,8 @@ class MarkedQuestion(models.Model):
         mc_choices - (TextField) Used only when q_type = 'MC', and includes the
            multiple choice answers. These can include variables {v[i]} as well,
            and are delimited by a semi-colon.
+        version - (IntegerField) Incremented whenever the question is edited,
+           so that compiled versions of the question can be invalidated.
     """
     quiz        = models.ForeignKey("Quiz", Quiz, null=True)
     # Keeps track of the global category, so that multiple questions can be used
@@ -167,6 +385,7 @@ class MarkedQuestion(models.Model):
                     default='D',
                   )
     mc_choices = models.TextField("Multiple Choice", default ='[]', blank=True)
+    version    = models.IntegerField(default=1)
 
     class Meta:
         ordering = ['quiz', 'category']
@@ -179,16 +398,143 @@ class MarkedQuestion(models.Model):
         """
         self.quiz = quiz
         self.num_vars = len(re.findall(r'{v\[\d+\]}', self.problem_str))
-        self.save()
+        if self.pk is None:
+            self.save()
+        else:
+            # Seeded results can only be regenerated from the saved version
+            attempts.materialize_seeded(MarkedQuestion.objects.get(pk=self.pk))
+            # Together, so that the new text is never read under the old
+            # version
+            with transaction.atomic():
+                self.save()
+                MarkedQuestion.objects.filter(pk=self.pk).update(version=F('version') + 1)
+            self.refresh_from_db(fields=['version'])
+            forget_program(self.pk)
         quiz.update_out_of()
 
+    def save(self, *args, **kwargs):
+        save_unversioned(self, MarkedQuestion, *args, **kwargs)
+
+    def get_program(self):
+        """ Returns the compiled QuestionProgram for this version of the
+            question.
+        """
+        return get_program(self)
+
     def get_random_choice(self):
         """ Returns a random choice"""
         return random.choice(self.choices.split(':'))
 
+    def generate_variants(self, count):
+        """ Generates (unsaved) QuestionVariants for the current version of
+            this question. The answers and multiple choice options are
+            evaluated as a single batch.
+            Input: count (Integer) - the number of variants
+            Output: (list) of QuestionVariant objects
+        """
+        program = self.get_program()
+        inputs  = [program.sample_inputs() for k in range(count)]
+        answers, mc_options = evaluate_batch(self, inputs)
+
+        variants = []
+        for index, choices in enumerate(inputs):
+            mc_choices = []
+            if mc_options is not None:
+                mc_choices = mc_options[index] + [str(answers[index])]
+                random.shuffle(mc_choices)
+
+            variants.append(QuestionVariant(
+                question=self,
+                version=self.version,
+                inputs=choices,
+                answer=json.dumps(answers[index]),
+                mc_choices=json.dumps(mc_choices),
+                problem=program.render_problem(choices),
+            ))
+        return variants
+
+    def refill_variants(self, size):
+        """ Tops up the pool of pre-generated variants for this question to
+            the given size, discarding variants of older versions.
+            Input: size (Integer) - the desired number of variants
+            Output: (Integer) the number of variants created
+        """
+        self.variants.exclude(version=self.version).delete()
+        missing = size - self.variants.count()
+        if missing <= 0:
+            return 0
+
+        QuestionVariant.objects.bulk_create(self.generate_variants(missing))
+        return missing
+
+    def pop_variant(self):
+        """ Removes a pre-generated variant of the current version of this
+            question from the pool and returns it. Returns None if the pool is
+            empty, or if pools are not in use (QUESTION_VARIANT_POOLS), in
+            which case the database is not queried at all.
+        """
+        if not getattr(settings, 'QUESTION_VARIANT_POOLS', False):
+            return None
+
+        # A variant is only ours if we are the ones who deleted it. Trying a
+        # few variants in random order, rather than always the first, means
+        # that concurrent requests rarely want the same one.
+        for k in range(2):
+            candidates = list(self.variants.filter(version=self.version)[:VARIANT_WINDOW])
+            if not candidates:
+                return None
+            random.shuffle(candidates)
+            for variant in candidates:
+                deleted, _ = QuestionVariant.objects.filter(pk=variant.pk).delete()
+                if deleted:
+                    return variant
+        return None
+
     def __str__(self):
         return self.problem_str
 
+@receiver(pre_delete, sender=MarkedQuestion)
+def materialize_deleted_question(sender, instance, **kwargs):
+    """ Stores the values of seeded results before they lose their question.
+        A signal, rather than MarkedQuestion.delete, so that queryset
+        deletes, cascades from the quiz and the admin's bulk deletion do it
+        too. See attempts.materialize_seeded
+    """
+    attempts.materialize_seeded(instance)
+
+
+class QuestionVariant(models.Model):
+    """ A pre-generated instance of a MarkedQuestion, so that generating a
+        question for a student does not require evaluating it. Pools of
+        variants are refilled by the fill_variant_pools command.
+        question - (ForeignKey[MarkedQuestion]) The question this is a variant of
+        version - (IntegerField) The version of the question it was generated
+            from. Variants of older versions are never used.
+        inputs - (TextField) The concrete choice, for example '3;-2'
+        answer - (TextField) The JSON serialized answer
+        mc_choices - (TextField) The JSON serialized (shuffled) list of
+            multiple choice options, including the answer
+        problem - (TextField) The rendered problem string
+    """
+    question   = models.ForeignKey(MarkedQuestion, related_name='variants')
+    version    = models.IntegerField()
+    inputs     = models.TextField()
+    answer     = models.TextField()
+    mc_choices = models.TextField(default='[]')
+    problem    = models.TextField()
+
+    class Meta:
+        index_together = [('question', 'version')]
+
+    def get_answer(self):
+        return json.loads(self.answer)
+
+    def get_mc_choices(self):
+        return json.loads(self.mc_choices)
+
+    def __str__(self):
+        return "{} - {}".format(self.question.pk, self.inputs)
+
 
 class StudentQuizResult(models.Model):
     """ When a student starts/writes a quiz, it creates a StudentQuizResult
@@ -199,12 +545,19 @@ class StudentQuizResult(models.Model):
         student - (ForeignKey[User]) The student who wrote the quiz
         quiz    - (ForeignKey[Quiz]) The quiz the student wrote
         attempt - (IntegerField) Which attempt does this StudentQuizResult
-            correspond to.
+            correspond to. Unique for the student and quiz; new attempts are
+            allocated by StudentQuizState.new_attempt.
         cur_quest - (IntegerField) This object is updated each time the student
             completes a question. This tracks which question the student is on,
             allowing the student to leave during a quiz and resume again later.
-        result - (TextField) String serialized as a JSON object. 
+        result - (TextField) String serialized as a JSON object. Legacy: the
+            questions of an attempt are now StudentQuestionResults (see
+            get_result), and this is no longer written.
         score - (IntegerField) The score the student achieved in this question.
+        finalized - (BooleanField) True if the attempt was closed by
+            finalize_expired when its quiz expired, rather than by the student
+            answering the last question. Its unanswered questions are those
+            with no guess.
     
     """
     student   = models.ForeignKey(User)
@@ -213,7 +566,8 @@ class StudentQuizResult(models.Model):
     #track which question the student is on if they leave. If cur_question = 0 then completed
     cur_quest = models.IntegerField(null=True, default=1) 
 
-    # The result is a json string which serializes the question data. For example
+    # Legacy. The result was a json string which serialized the question data,
+    # as get_result still returns it. For example
     # result = {
     #           '1': {
     #                   'pk': '13',
@@ -239,37 +593,78 @@ class StudentQuizResult(models.Model):
     #          this question were v=[1,2,3], and the student got the question wrong with a guess of 15.7
     result  = models.TextField(default='{}')
     score   = models.IntegerField(null=True)
+    finalized = models.BooleanField(default=False)
 
     class Meta:
+        unique_together = [('student', 'quiz', 'attempt')]
         verbose_name = "Quiz Result"
 
-    def update_score(self):
-        """ Adds one to the overall score """
+    def update_score(self, commit=True):
+        """ Adds one to the overall score. If commit is True the row is
+            incremented in the database with an F() expression, so concurrent
+            increments are not lost; otherwise only this instance changes.
+        """
         self.score += 1
-        self.save()
+        if commit:
+            StudentQuizResult.objects.filter(pk=self.pk).update(score=F('score') + 1)
 
-    def update_result(self, result):
-        """ Takes a python dictionary, serializes it, and stores it in the result column.
-            Input: result (dict) - the python dictionary.
-            Output: Void
+    @classmethod
+    def finalize_expired(cls, now=None, chunk_size=1000):
+        """ Closes every attempt which is still in progress at a quiz which has
+            expired: its cur_quest is set to 0 and finalized to True. Its
+            score, the total of the questions answered, is kept, and its
+            unanswered questions are left without a guess. The attempts are
+            closed chunk_size at a time, with a few set-based UPDATEs in one
+            transaction per chunk, which also update the StudentQuizStates.
+            Only attempts which are still open are changed, so it is safe to
+            run again at any time, including after being interrupted.
+            Input: now (datetime) default timezone.now()
+                   chunk_size (Integer)
+            Output: (Integer) the number of attempts finalized
         """
-        self.result = json.dumps(result)
-        self.save()
+        now = now or timezone.now()
+        still_open = cls.objects.filter(quiz__expires__lte=now).exclude(cur_quest=0)
+        finalized = 0
+        while True:
+            chunk = list(still_open.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not chunk:
+                return finalized
+            with transaction.atomic():
+                # A student may have just finished one of them
+                finalized += cls.objects.filter(pk__in=chunk).exclude(cur_quest=0).update(
+                    cur_quest=0, finalized=True)
+                StudentQuizState.objects.filter(latest__in=chunk).update(in_progress=False)
+                # Only the states of these attempts, one quiz at a time
+                students = defaultdict(set)
+                for quiz, student in cls.objects.filter(pk__in=chunk).values_list('quiz', 'student'):
+                    students[quiz].add(student)
+                for quiz, quiz_students in students.items():
+                    StudentQuizState.refresh_best_scores(quiz_students, [quiz])
+
+    def get_state(self):
+        """ Returns the AttemptState of this attempt. It is created once per
+            instance, so its rows are read and decoded at most once.
+        """
+        state = getattr(self, '_attempt_state', None)
+        if state is None:
+            state = self._attempt_state = attempts.AttemptState(self)
+        return state
 
     def get_result(self):
-        """ Returns a python dictionary with the student quiz results
+        """ Returns a python dictionary with the student quiz results, in the
+            format of the legacy result column
             Input: None
             Output: result (dict) - The python dictionay of results
                     attempt (string) - The current attempt, as a string to access in result
         """
-        result = json.loads(self.result)
+        result = self.get_state().as_dict()
         attempt = str(self.cur_quest)
         return result, attempt
 
-    def add_question_number(self):
+    def add_question_number(self, commit=True):
         """ Adds one to the cur_quest field. However, checks if we have surpassed the last question,
             and if so sets cur_quest to 0.
-            Input: None
+            Input: commit (Boolean) - whether to save the change
             Output: is_last (Boolean) - indicated whether the cur_quest field has been set to 0
             TODO: Change this to allow for non-sequential numbering of
                   categories
@@ -281,7 +676,8 @@ class StudentQuizResult(models.Model):
         else:
             is_last = False
             self.cur_quest += 1
-        self.save()
+        if commit:
+            self.save()
         
         return is_last
 
@@ -289,6 +685,357 @@ class StudentQuizResult(models.Model):
         return self.student.username + " - " + self.quiz.name + " - Attempt: " + str(self.attempt)
 
 
+class StudentQuestionResult(models.Model):
+    """ A single question generated within a StudentQuizResult, and how the
+        student answered it.
+        attempt - (ForeignKey[StudentQuizResult]) The quiz attempt
+        number - (IntegerField) The question number within the attempt, which
+            is the MarkedQuestion category
+        question - (ForeignKey[MarkedQuestion]) The question generated
+        inputs - (TextField) The concrete choices for the variables, such as
+            "1;2;3". Null for seeded questions.
+        answer - (TextField) The correct answer, serialized as JSON. Null for
+            seeded questions.
+        guess - (TextField) How the student's answer evaluated, serialized as
+            JSON. Null until the question is answered.
+        guess_string - (TextField) The student's answer as typed. Null until
+            the question is answered.
+        score - (IntegerField) 1 if the answer was correct, otherwise 0
+        q_type - (CharField) The MarkedQuestion q_type
+        mc_choices - (TextField) The shuffled multiple choice options,
+            serialized as JSON. Null for other question types, and for seeded
+            questions.
+        seed - (BigIntegerField) The seed the question was generated from
+            with settings.SEEDED_QUESTION_RESULTS, or null
+        version - (IntegerField) The version of the MarkedQuestion which was
+            generated
+        token - (CharField) The submission token which marked the question,
+            so that a repeated submission can be recognised. See
+            views.submit_answer
+    """
+    attempt      = models.ForeignKey(StudentQuizResult, related_name='questions')
+    number       = models.IntegerField()
+    question     = models.ForeignKey(MarkedQuestion, null=True, on_delete=models.SET_NULL)
+    inputs       = models.TextField(null=True)
+    answer       = models.TextField(null=True)
+    guess        = models.TextField(null=True)
+    guess_string = models.TextField(null=True)
+    score        = models.IntegerField(default=0)
+    q_type       = models.CharField(max_length=2, default='D')
+    mc_choices   = models.TextField(null=True)
+    seed         = models.BigIntegerField(null=True)
+    version      = models.IntegerField(null=True)
+    token        = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        unique_together = [('attempt', 'number')]
+        ordering = ['attempt', 'number']
+        verbose_name = "Question Result"
+
+    def __str__(self):
+        return "{} - Question {}".format(self.attempt, self.number)
+
+
+class StudentQuizState(models.Model):
+    """ A summary of a student's attempts at a quiz, so that starting a quiz
+        does not have to read every StudentQuizResult. It is updated in the
+        same transaction as the attempts it describes; see new_attempt and
+        attempt_finished. rebuild() recomputes it from the StudentQuizResults,
+        as does the rebuild_quiz_states command.
+
+        Concurrent requests (a double clicked "start", a retried request) are
+        safe on every database backend without relying on row locks: the
+        unique constraints on (student, quiz) here and (student, quiz,
+        attempt) on StudentQuizResult make the loser's insert fail, after
+        which it reads the winner's state.
+        student - (ForeignKey[User])
+        quiz - (ForeignKey[Quiz])
+        latest - (ForeignKey[StudentQuizResult]) The most recent attempt, or
+            null if there are none
+        attempts - (IntegerField) The number of attempts used
+        best_score - (IntegerField) The best score of a finished attempt, or
+            null if none is finished
+        in_progress - (BooleanField) Whether the latest attempt is unfinished
+    """
+    student     = models.ForeignKey(User)
+    quiz        = models.ForeignKey(Quiz)
+    latest      = models.ForeignKey(StudentQuizResult, null=True, on_delete=models.SET_NULL,
+                                    related_name='+')
+    attempts    = models.IntegerField(default=0)
+    best_score  = models.IntegerField(null=True)
+    in_progress = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = [('student', 'quiz')]
+        verbose_name = "Quiz State"
+
+    @classmethod
+    def summarize(cls, student_id, quiz_id, results):
+        """ Builds an (unsaved) StudentQuizState.
+            Input: results (list) of (pk, attempt, cur_quest, score) tuples of
+                the student's StudentQuizResults for the quiz, and of their
+                ArchivedQuizResults with a pk of None, since latest can only
+                be a StudentQuizResult
+            Output: (StudentQuizState)
+        """
+        state = cls(student_id=student_id, quiz_id=quiz_id)
+        if results:
+            latest = max(results, key=lambda result: (result[1] or 0, result[0] or 0))
+            state.latest_id = latest[0]
+            state.attempts = latest[1] or 0
+            state.in_progress = latest[2] != 0
+            finished = [result[3] or 0 for result in results if result[2] == 0]
+            state.best_score = max(finished) if finished else None
+        return state
+
+    @classmethod
+    def rebuild(cls, student, quiz):
+        """ Recomputes the state of a student's attempts at a quiz from their
+            StudentQuizResults, replacing the saved state if there is one.
+            Output: (StudentQuizState)
+        """
+        state = cls.summarize(student.pk, quiz.pk, cls._results(student, quiz))
+        try:
+            with transaction.atomic():
+                cls.objects.filter(student=student, quiz=quiz).delete()
+                state.save()
+        except IntegrityError: # Rebuilt by another request
+            state = cls.objects.get(student=student, quiz=quiz)
+        return state
+
+    @staticmethod
+    def _results(student, quiz):
+        # Read outside of any transaction which then writes, so that SQLite
+        # does not have to upgrade a read lock. Archived attempts still count.
+        columns = ('pk', 'attempt', 'cur_quest', 'score')
+        results = list(StudentQuizResult.objects.filter(
+            student=student, quiz=quiz).values_list(*columns))
+        results.extend((None,) + row[1:] for row in ArchivedQuizResult.objects.filter(
+            student=student, quiz=quiz).values_list(*columns))
+        return results
+
+    @classmethod
+    def get_for(cls, student, quiz):
+        """ Returns the state, with its latest attempt, building it if it does
+            not exist yet.
+        """
+        states = cls.objects.select_related('latest').filter(student=student, quiz=quiz)
+        state = states.first()
+        if state is None:
+            state = cls.summarize(student.pk, quiz.pk, cls._results(student, quiz))
+            try:
+                with transaction.atomic():
+                    state.save()
+            except IntegrityError: # Built by another request
+                state = states.get()
+        return state
+
+    @property
+    def high_score(self):
+        """ The best score over every attempt, including one in progress, or
+            -1 if there are no attempts
+        """
+        scores = [score for score in (self.best_score,
+                  self.latest.score if self.latest_id else None) if score is not None]
+        return max(scores) if scores else -1
+
+    def has_tries_left(self):
+        return self.quiz.tries == 0 or self.attempts < self.quiz.tries
+
+    def prepare_attempt(self):
+        """ Returns the next StudentQuizResult, unsaved, so that its first
+            questions can be generated before new_attempt creates it
+        """
+        return StudentQuizResult(
+            student_id=self.student_id,
+            quiz=self.quiz,
+            attempt=self.attempts + 1,
+            score=0,
+            result='{}',
+            cur_quest=1,
+        )
+
+    def new_attempt(self, result=None):
+        """ Creates the next StudentQuizResult and records it as the latest
+            attempt, unless another request already has. The attempt is
+            claimed by inserting it, which the unique (student, quiz,
+            attempt) constraint only lets one request do, and the state is
+            then only updated if it has not changed since it was read. Call
+            it in a transaction to make further work part of creating the
+            attempt.
+            Input: result (StudentQuizResult) from prepare_attempt, by default
+                a new one
+            Output: (StudentQuizResult) the new attempt, or None if another
+                request created one first. The state should then be read
+                again.
+        """
+        result = result or self.prepare_attempt()
+        try:
+            with transaction.atomic():
+                result.save(force_insert=True)
+                updated = StudentQuizState.objects.filter(
+                    pk=self.pk, attempts=self.attempts, in_progress=False
+                ).update(latest=result, attempts=result.attempt, in_progress=True)
+                if not updated:
+                    raise IntegrityError("StudentQuizState {} changed".format(self.pk))
+        except IntegrityError:
+            result.pk = None
+            return None
+
+        self.latest = result
+        self.attempts = result.attempt
+        self.in_progress = True
+        return result
+
+    @classmethod
+    def attempt_finished(cls, result):
+        """ Records that the StudentQuizResult result has been finished.
+            Should be called in the transaction which finishes it.
+        """
+        cls.objects.filter(student_id=result.student_id, quiz_id=result.quiz_id).update(
+            in_progress=Case(When(latest_id=result.pk, then=Value(False)),
+                             default=F('in_progress')),
+            best_score=Case(
+                When(Q(best_score__isnull=True) | Q(best_score__lt=result.score),
+                     then=Value(result.score)),
+                default=F('best_score')),
+        )
+
+    @classmethod
+    def refresh_best_scores(cls, students, quizzes):
+        """ Recomputes best_score from the finished StudentQuizResults and
+            ArchivedQuizResults, in a single UPDATE, for every state of one of
+            students at one of quizzes. Should be called in the transaction
+            which changed the scores, or finished the attempts.
+            Input: students, quizzes (lists or querysets) of primary keys
+        """
+        def best(model):
+            return Subquery(model.objects.filter(
+                student=OuterRef('student'), quiz=OuterRef('quiz'), cur_quest=0
+            ).order_by().values('student').annotate(best=Max('score')).values('best'),
+                output_field=models.IntegerField())
+
+        live, archived = best(StudentQuizResult), best(ArchivedQuizResult)
+        # Greatest is null if either is, on some databases
+        cls.objects.filter(student__in=students, quiz__in=quizzes).update(
+            best_score=Greatest(Coalesce(live, archived), Coalesce(archived, live)))
+
+    def __str__(self):
+        return "{} - {}".format(self.student.username, self.quiz.name)
+
+
+class ArchivedQuizResult(models.Model):
+    """ A finished StudentQuizResult which has been moved out of the quiz
+        result tables by the archive_attempts command, with its questions
+        compressed into a single blob. It keeps the primary key it had, so
+        links to the attempt still work through archive.get_attempt.
+        <<Attributes>>
+        student, quiz, attempt, cur_quest, score, finalized - As they were in
+            the StudentQuizResult
+        questions - (BinaryField) The attempt's StudentQuestionResults, as
+            zlib compressed JSON. See archive.compress_questions
+        archived - (DateTimeField) When the attempt was archived
+    """
+    id        = models.IntegerField(primary_key=True)
+    student   = models.ForeignKey(User)
+    quiz      = models.ForeignKey(Quiz)
+    attempt   = models.IntegerField(null=True)
+    cur_quest = models.IntegerField(null=True)
+    score     = models.IntegerField(null=True)
+    finalized = models.BooleanField(default=False)
+    questions = models.BinaryField()
+    archived  = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Archived Quiz Result"
+
+    def as_result(self):
+        """ Returns the attempt as an unsaved StudentQuizResult, whose
+            AttemptState already holds the questions, so that it can be
+            displayed like any other attempt. It should not be saved.
+        """
+        result = StudentQuizResult(
+            pk=self.pk, student_id=self.student_id, quiz=self.quiz, attempt=self.attempt,
+            cur_quest=self.cur_quest, score=self.score, finalized=self.finalized)
+        result.get_state().restore(attempts.decompress_rows(self.questions))
+        return result
+
+    def __str__(self):
+        return "{} (archived)".format(self.pk)
+
+
+class QuestionStats(models.Model):
+    """ Running totals of how students have answered a MarkedQuestion, so
+        that the quiz statistics page does not read any StudentQuizResults.
+        They are incremented by record_answer in the transaction which marks
+        each answer, and recomputed by the rebuild_question_stats command.
+        <<Attributes>>
+        question - (OneToOneField[MarkedQuestion]) The question
+        answered - (IntegerField) How many answers have been marked
+        correct - (IntegerField) How many of those answers were correct
+        attempt_total - (IntegerField) The sum, over the answers, of the
+            attempt they were given in, for the average number of tries
+    """
+    question      = models.OneToOneField(MarkedQuestion, primary_key=True,
+                                         related_name='stats')
+    answered      = models.IntegerField(default=0)
+    correct       = models.IntegerField(default=0)
+    attempt_total = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Question Statistics"
+        verbose_name_plural = "Question Statistics"
+
+    @classmethod
+    def record_answer(cls, question_id, score, attempt):
+        """ Adds a marked answer to the totals of question question_id with
+            F() increments, creating its row for the first answer. Should be
+            called in the transaction which marks the answer.
+            <<INPUT>>
+            question_id (Integer) The MarkedQuestion, or None if it has been
+                deleted, in which case nothing is recorded
+            score (Integer) 1 if the answer was correct, otherwise 0
+            attempt (Integer) The attempt the answer was given in
+        """
+        if question_id is None:
+            return
+        increments = {
+            'answered': F('answered') + 1,
+            'correct': F('correct') + score,
+            'attempt_total': F('attempt_total') + (attempt or 1),
+        }
+        if cls.objects.filter(question_id=question_id).update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(question_id=question_id, answered=1, correct=score,
+                                   attempt_total=attempt or 1)
+        except IntegrityError:
+            # Created by a concurrent answer, or the question was deleted
+            cls.objects.filter(question_id=question_id).update(**increments)
+
+    @staticmethod
+    def percentage(correct, answered):
+        return round(100.0*correct/answered, 1) if answered else None
+
+    @staticmethod
+    def average(total, answered):
+        return round(float(total)/answered, 2) if answered else None
+
+    @property
+    def percent_correct(self):
+        """ The percentage of answers which were correct, or None """
+        return self.percentage(self.correct, self.answered)
+
+    @property
+    def average_tries(self):
+        """ The average attempt in which the question was answered, or None """
+        return self.average(self.attempt_total, self.answered)
+
+    def __str__(self):
+        return "{} - {} answered".format(self.question_id, self.answered)
+
+
 class CSVFile(models.Model):
     """ Used for storing CSV files.
     """
@@ -0,0 +1,558 @@
+""" Compiled representations of MarkedQuestion templates.
+
+    A MarkedQuestion stores its problem, answer and multiple choice options as
+    text templates which are filled in with str.format, have their
+    @-delimited sub-expressions evaluated, and are then passed to simple_eval.
+    Doing that string work from scratch on every request is wasteful, so a
+    QuestionProgram parses each template once into literal and placeholder
+    segments, pre-parses the expressions into ASTs, and merges the function
+    namespace. Programs are cached per (question pk, question version).
+
+    Whenever a compiled expression cannot be shown to behave exactly like the
+    textual substitution (for example '{v[0]}**2' with a negative input), we
+    fall back to the original render-then-evaluate path.
+"""
+
+from django.conf import settings
+from simpleeval import SimpleEval, NameNotDefined, DEFAULT_NAMES, DEFAULT_FUNCTIONS
+
+from .samplers import compile_choices, draw_choice, sampling_functions
+from .budget import BudgetedEval
+
+from collections import OrderedDict
+import ast
+import builtins
+import math
+import random
+import re
+import string
+import threading
+
+# Same pattern used throughout views.py to detect the presence of variables
+VARIABLE_PATTERN = re.compile(r'{v\[\d+\]}')
+SUB_EXPRESSION_PATTERN = re.compile(r'@(.+?)@')
+FIELD_PATTERN = re.compile(r'v\[(\d+)\]$')
+INT_LITERAL = re.compile(r'-?(0|[1-9][0-9]*)$')
+FLOAT_LITERAL = re.compile(
+    r'-?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))([eE][-+]?[0-9]+)?$')
+
+# Characters which, when adjacent to a placeholder, would merge with the
+# substituted text into a different token (2{v[0]}, {v[0]}.real, ...)
+UNSAFE_BEFORE = set(string.ascii_letters + string.digits + "_.'\"")
+UNSAFE_AFTER  = UNSAFE_BEFORE | set('([')
+
+# The only builtins available to instructor defined functions, both while
+# the text of MarkedQuestion.functions is evaluated and when they are called
+FUNCTION_BUILTINS = {name: getattr(builtins, name) for name in (
+    'abs', 'all', 'any', 'bool', 'complex', 'dict', 'divmod', 'enumerate',
+    'filter', 'float', 'int', 'len', 'list', 'map', 'max', 'min', 'pow',
+    'range', 'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple',
+    'zip', 'True', 'False', 'None')}
+
+# Globals made available to instructor defined functions
+FUNCTION_GLOBALS = {'__builtins__': FUNCTION_BUILTINS, 'math': math, 'random': random}
+
+def eval_sub_expression(string):
+    """ Used to evaluate @-sign delimited subexpressions in sentences which do
+        not totally render. Variables should be passed into the string first,
+        before passing to this function.  For example, if a string is if the
+        form: "What is half of \(@2*{v[0]}@\)" then we should have already
+        substituted {v[0]} into the string, so that eval_sub_expression
+        receives, for example, "What is half of \(@2*3@\)?"
+
+        <<INPUT>>
+        string (String) containing (possibly zero) @-delimited expressions.
+        <<OUTPUT>>
+        That string, but with the @ signs removed and the internal expression
+        evaluated.
+    """
+
+    # If no subexpression can be found, simply return
+    if not "@" in string:
+        return string
+
+    temp_string = string
+    while "@" in temp_string:
+        match = SUB_EXPRESSION_PATTERN.search(temp_string)
+        # Evaluate the expression and substitute it back into the string
+        replacement = round(evaluate(match.group(1)), 4)
+        temp_string = temp_string[:match.start()] + str(replacement) + temp_string[match.end():]
+
+    return temp_string
+
+_local = threading.local()
+
+def evaluate(expr, names=None, functions=None, tree=None):
+    """ Evaluates an expression with simple_eval semantics, within the limits
+        of budget.BudgetedEval. If tree is given, it should be the pre-parsed
+        AST of expr, and parsing is skipped. In that case the namespaces are
+        trusted (see compile_functions), so a single evaluator is reused per
+        thread.
+    """
+    if tree is None:
+        return BudgetedEval(names=names, functions=functions).eval(expr)
+
+    evaluator = getattr(_local, 'evaluator', None)
+    if evaluator is None:
+        evaluator = _local.evaluator = BudgetedEval()
+    evaluator.reset()
+    evaluator.names = DEFAULT_NAMES if names is None else names
+    evaluator.functions = DEFAULT_FUNCTIONS if functions is None else functions
+    evaluator.expr = expr
+    return evaluator._eval(tree)
+
+def compile_functions(functions):
+    """ Evaluates the text of MarkedQuestion.functions and merges it with the
+        predefined functions. Predefined functions take precedence.
+        <<INPUT>>
+        functions (String) A python dictionary literal of functions
+        <<OUTPUT>>
+        (dict) the function namespace used to evaluate answers
+
+        The functions only see FUNCTION_GLOBALS, and names or attributes
+        starting with an underscore are refused, since they lead back to the
+        full builtins (().__class__.__bases__ ...). This keeps mistakes and
+        casual misuse out of the workers, but is still not a sandbox.
+    """
+    tree = ast.parse(functions, mode='eval')
+    for node in ast.walk(tree):
+        name = getattr(node, 'id', None) or getattr(node, 'attr', None) or ''
+        if name.startswith('_'):
+            raise ValueError("'{}' may not be used in functions".format(name))
+    namespace = eval(compile(tree, '<functions>', 'eval'), dict(FUNCTION_GLOBALS))
+    namespace.update(settings.PREDEFINED_FUNCTIONS)
+    # Raises FeatureNotAvailable for disallowed functions
+    SimpleEval(functions=namespace)
+    return namespace
+
+def to_number(value):
+    """ Converts a substituted value into the number that python would parse
+        from the same text, or returns None if that cannot be guaranteed.
+    """
+    if INT_LITERAL.match(value):
+        return int(value)
+    if FLOAT_LITERAL.match(value):
+        return float(value)
+    return None
+
+
+class SubExpression(object):
+    """ An @-delimited expression inside a template. Its value is rounded and
+        substituted back in as text.
+    """
+    def __init__(self, parts):
+        self.expression = Expression(parts)
+
+    def render(self, values):
+        return str(round(self.expression.evaluate(values), 4))
+
+
+class Expression(object):
+    """ A sequence of literal text and variable references which, once
+        substituted, is evaluated by simple_eval. Where it is safe to do so,
+        variables are bound as names in a pre-parsed AST rather than being
+        pasted into the text.
+        parts - (list) containing strings (literal text) and integers (the
+            index i of a variable {v[i]}) or SubExpressions
+        strip_spaces - (Boolean) whether spaces are removed before evaluation
+    """
+    def __init__(self, parts, strip_spaces=False):
+        self.parts = parts
+        self.strip_spaces = strip_spaces
+        self.tree = None
+        self.unparseable = False
+        self.sign_sensitive = set()
+        self._compile()
+
+    def _compile(self):
+        """ Builds the AST with a unique name standing in for each
+            placeholder. Leaves self.tree as None if that would not evaluate
+            identically to textual substitution.
+        """
+        parts = []
+        for part in self.parts:
+            if isinstance(part, str) and self.strip_spaces:
+                part = part.replace(' ', '')
+            parts.append(part)
+
+        text = ''
+        names = []
+        occurrences = 0
+        for index, part in enumerate(parts):
+            if isinstance(part, str):
+                text += part
+                continue
+
+            before = parts[index-1] if index > 0 else ''
+            after  = parts[index+1] if index+1 < len(parts) else ''
+            if not isinstance(before, str) or not isinstance(after, str):
+                return
+            if (before and before[-1] in UNSAFE_BEFORE) or (after and after[0] in UNSAFE_AFTER):
+                return
+
+            name = self._name_for(part)
+            names.append(name)
+            occurrences += 1
+            text += name
+
+        try:
+            module = ast.parse(text.strip())
+        except SyntaxError:
+            # Without placeholders, the text will never parse
+            self.unparseable = not names
+            return
+        if len(module.body) != 1 or not isinstance(module.body[0], ast.Expr):
+            return
+
+        tree = module.body[0].value
+        found = 0
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id in names:
+                found += 1
+            # -3**2 != (-3)**2, so negative values here need the text path.
+            # Parentheses do not survive in the tree, so this is per name:
+            # '({v[0]})**2' falls back too, which is slower but always right
+            if (isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow)
+                    and isinstance(node.left, ast.Name) and node.left.id in names):
+                self.sign_sensitive.add(node.left.id)
+        if found != occurrences:
+            return
+
+        self.tree = tree
+        self.text = text
+
+    def _name_for(self, part):
+        if isinstance(part, SubExpression):
+            return '_s{}_'.format(self.parts.index(part))
+        return '_v{}_'.format(part)
+
+    def render(self, values):
+        """ Returns the text of the expression with values substituted """
+        ret = ''
+        for part in self.parts:
+            if isinstance(part, str):
+                ret += part
+            elif isinstance(part, SubExpression):
+                ret += part.render(values)
+            else:
+                ret += values[part]
+        return ret
+
+    def bind(self, values):
+        """ Returns the names for evaluating self.tree, or None if the
+            compiled tree cannot be used with these values.
+        """
+        if self.tree is None:
+            return None
+
+        bound = {}
+        for part in self.parts:
+            if isinstance(part, str):
+                continue
+            name  = self._name_for(part)
+            value = part.render(values) if isinstance(part, SubExpression) else values[part]
+            number = to_number(value)
+            if number is None:
+                return None
+            if name in self.sign_sensitive and value.startswith('-'):
+                return None
+            bound[name] = number
+        return bound
+
+    def evaluate(self, values, names=None, functions=None):
+        """ Substitutes values and evaluates the expression. names and
+            functions are passed to simple_eval, so None uses its defaults.
+        """
+        bound = self.bind(values)
+        if bound is None:
+            text = self.render(values)
+            if self.strip_spaces:
+                text = text.replace(' ', '')
+            return evaluate(text, names=names, functions=functions)
+
+        bound.update(DEFAULT_NAMES if names is None else names)
+        return evaluate(self.text, names=bound, functions=functions, tree=self.tree)
+
+
+class Template(object):
+    """ A template string which is filled in with str.format(v=values), after
+        which @-delimited sub-expressions are evaluated.
+        source - (String) the raw template
+        substitute - (Boolean) if False, the template is used verbatim, and
+            neither formatting nor sub-expressions are applied.
+    """
+    def __init__(self, source, substitute=True):
+        self.source = source
+        self.substitute = substitute
+        self.parts = [source] if not substitute else self._split(source)
+
+    @staticmethod
+    def _split(source):
+        """ Splits source into literal text, variable indices and
+            SubExpressions. Returns None for templates which should be handled
+            by str.format and eval_sub_expression directly (including ones
+            which will raise errors).
+        """
+        parts = []
+        try:
+            for literal, field, spec, conversion in string.Formatter().parse(source):
+                if literal:
+                    parts.append(literal)
+                if field is None:
+                    continue
+                match = FIELD_PATTERN.match(field)
+                if not match or spec or conversion:
+                    return None
+                parts.append(int(match.group(1)))
+        except ValueError:
+            return None
+
+        # Lay the parts out with a single character for each variable and
+        # find the sub-expressions exactly as eval_sub_expression would.
+        flat = ''
+        owners = []
+        for index, part in enumerate(parts):
+            text = part if isinstance(part, str) else 'x'
+            flat += text
+            owners.extend([index]*len(text))
+
+        if '@' not in flat:
+            return parts
+
+        spans = [m.span() for m in SUB_EXPRESSION_PATTERN.finditer(flat)]
+        outside = ''.join(flat[a:b] for a, b in zip(
+            [0] + [end for _, end in spans], [start for start, _ in spans] + [len(flat)]))
+        if '@' in outside:
+            return None
+
+        def slice_parts(start, end):
+            sliced = []
+            for pos in range(start, end):
+                part = parts[owners[pos]]
+                if isinstance(part, str):
+                    if sliced and isinstance(sliced[-1], str) and pos > start and owners[pos-1] == owners[pos]:
+                        sliced[-1] += flat[pos]
+                    else:
+                        sliced.append(flat[pos])
+                else:
+                    sliced.append(part)
+            return sliced
+
+        ret = []
+        pos = 0
+        for start, end in spans:
+            ret.extend(slice_parts(pos, start))
+            ret.append(SubExpression(slice_parts(start+1, end-1)))
+            pos = end
+        ret.extend(slice_parts(pos, len(flat)))
+        return ret
+
+    def render(self, values):
+        """ Returns the template with values substituted """
+        if not self.substitute:
+            return self.source
+        if self.parts is None or any(
+                not value or '@' in value or '\n' in value for value in values):
+            return eval_sub_expression(self.source.format(v=values))
+
+        ret = ''
+        for part in self.parts:
+            if isinstance(part, str):
+                ret += part
+            elif isinstance(part, SubExpression):
+                ret += part.render(values)
+            else:
+                ret += values[part]
+        return ret
+
+    def expression(self, strip_spaces=True):
+        """ Returns an Expression evaluating the rendered template, or None
+            if the template must be rendered as text first.
+        """
+        if self.parts is None:
+            return None
+        return Expression(self.parts, strip_spaces=strip_spaces)
+
+
+class QuestionProgram(object):
+    """ The compiled form of a MarkedQuestion. Holds the pre-split problem
+        string, the answer and multiple choice expressions, the merged
+        function namespace and the choice samplers, none of which depend on
+        the inputs.
+    """
+    def __init__(self, question):
+        self.pk = question.pk
+        self.version = question.version
+        self.q_type = question.q_type
+
+        self.problem = Template(question.problem_str)
+        self.answer = self._compile_part(question.answer)
+        self.mc_choices = [
+            self._compile_part(part) for part in question.mc_choices.split(';')
+        ]
+        self.choices = compile_choices(question.choices)
+
+        self._functions_source = question.functions
+        self._functions = None
+        self._functions_error = None
+
+    @staticmethod
+    def _compile_part(source):
+        """ Answers and multiple choice options are only formatted when they
+            contain variables.
+        """
+        template = Template(source, substitute=bool(VARIABLE_PATTERN.search(source)))
+        return (template, template.expression())
+
+    @property
+    def functions(self):
+        """ The merged function namespace, evaluated once. Errors are kept so
+            that they are raised (or handled) every time, as before.
+        """
+        if self._functions is None and self._functions_error is None:
+            try:
+                self._functions = compile_functions(self._functions_source)
+            except Exception as e:
+                self._functions_error = e
+        if self._functions_error is not None:
+            raise self._functions_error
+        return self._functions
+
+    @staticmethod
+    def _evaluate_part(part, values, functions):
+        """ Evaluates a compiled answer/option against values, returning the
+            rounded result.
+        """
+        template, expression = part
+        if expression is None:
+            text = template.render(values).replace(' ', '')
+            value = evaluate(text, names=settings.UNIVERSAL_CONSTANTS, functions=functions)
+        else:
+            value = expression.evaluate(
+                values, names=settings.UNIVERSAL_CONSTANTS, functions=functions)
+        return round(value, 4)
+
+    def sample_inputs(self, rng=random):
+        """ Picks one of the question's choices at random and draws concrete
+            values for it. Replaces get_random_choice/parse_abstract_choice.
+            <<INPUT>>
+            rng (random.Random) The random number generator to draw from
+            <<OUTPUT>>
+            (String) A concrete choice, such as "3;-2;0.25"
+        """
+        samplers = rng.choice(self.choices)
+        if isinstance(samplers, Exception):
+            raise samplers
+        return draw_choice(samplers, rng)
+
+    def render_problem(self, choices):
+        """ See views.sub_into_question_string """
+        return self.problem.render(choices.replace(' ', '').split(';'))
+
+    @property
+    def is_reproducible(self):
+        """ Whether generate() always gives the same result for a seed. The
+            instructor's functions may use the random module directly, which
+            cannot be seeded per attempt.
+        """
+        return 'random' not in self._functions_source
+
+    def _seeded_functions(self, functions, rng):
+        """ functions, with the randomizers drawing from rng if it is given """
+        if rng is None:
+            return functions
+        functions = dict(functions)
+        functions.update(sampling_functions(rng))
+        return functions
+
+    def get_answer(self, choices, rng=None):
+        """ See views.get_answer. If rng is given, the randomizers in the
+            answer draw from it.
+        """
+        template, _ = self.answer
+        if choices is None:
+            return template.source
+
+        values = choices.split(';')
+        try:
+            return self._evaluate_part(self.answer, values,
+                                       self._seeded_functions(self.functions, rng))
+        except (SyntaxError, NameNotDefined,):
+            # The answer is not one that can be evaluated, so the answer is
+            # just the answer. Errors in substitution are raised here.
+            return template.render(values)
+
+    def get_mc_option(self, part, values, rng=None):
+        """ Evaluates a single compiled multiple choice option, where values
+            is the split list of inputs.
+        """
+        template, expression = part
+        if expression is not None and expression.unparseable:
+            return template.render(values)
+        try:
+            return str(self._evaluate_part(part, values,
+                self._seeded_functions(settings.PREDEFINED_FUNCTIONS, rng)))
+        except: #If not an exectuable string, then it must be a hardcoded answer
+            return template.render(values)
+
+    def get_mc_options(self, choices, rng=None):
+        """ Evaluates the multiple choice options (without the answer, and
+            unshuffled). See views.get_mc_choices
+        """
+        values = choices.split(';')
+        return [self.get_mc_option(part, values, rng) for part in self.mc_choices]
+
+    def generate(self, seed):
+        """ Generates a question from a seed. Everything random, including
+            the order of the multiple choice options, is drawn from a single
+            generator, so the same seed always gives the same question (see
+            is_reproducible).
+            <<INPUT>>
+            seed (Integer)
+            <<OUTPUT>>
+            (tuple) of the concrete choices (String), the answer, and the
+                shuffled multiple choice options (list), or None if the
+                question is not multiple choice
+        """
+        rng = random.Random(seed)
+        choices = self.sample_inputs(rng)
+        answer = self.get_answer(choices, rng)
+        mc_choices = None
+        if self.q_type == "MC":
+            mc_choices = self.get_mc_options(choices, rng) + [str(answer)]
+            rng.shuffle(mc_choices)
+        return choices, answer, mc_choices
+
+
+# ---------- Program cache ---------- #
+
+_programs = OrderedDict()
+_programs_lock = threading.Lock()
+
+def get_program(question):
+    """ Returns the (cached) QuestionProgram for a MarkedQuestion. Programs are
+        keyed by pk and version, so an edited question is recompiled.
+    """
+    if question.pk is None:
+        return QuestionProgram(question)
+
+    key = (question.pk, question.version)
+    with _programs_lock:
+        program = _programs.get(key)
+        if program is not None:
+            _programs.move_to_end(key)
+            return program
+
+    program = QuestionProgram(question)
+    with _programs_lock:
+        _programs[key] = program
+        while len(_programs) > getattr(settings, 'QUESTION_PROGRAM_CACHE_SIZE', 512):
+            _programs.popitem(last=False)
+    return program
+
+def forget_program(pk):
+    """ Drops every cached program for the MarkedQuestion with primary key pk
+    """
+    with _programs_lock:
+        for key in [key for key in _programs if key[0] == pk]:
+            del _programs[key]
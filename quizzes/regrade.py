@@ -0,0 +1,212 @@
+""" Regrading the answers to a MarkedQuestion after it has been corrected.
+
+    When an instructor fixes the answer or functions of a question, the
+    StudentQuestionResults already generated from it keep the answer they
+    were generated with, and were marked against it. regrade_question
+    recomputes the answer of each of them from its stored inputs, marks the
+    stored guess again, and corrects the attempt's score, the question's
+    QuestionStats and the students' best scores to match. Multiple choice
+    questions which have not been answered yet are given new options, so that
+    the corrected answer is among them; answered ones keep the options the
+    student saw.
+
+    The results are processed in chunks of CHUNK_SIZE, in primary key order.
+    Each chunk is read, and its answers evaluated with
+    workers.evaluate_batch (vectorized, and spread over the worker pool if
+    there is one), outside of any transaction. The changes are then written
+    in one short transaction per chunk, so the table is never locked for
+    long. Each result is only updated if it has not been answered since it
+    was read, so a student answering during a regrade is not overwritten.
+
+    With dry_run, nothing is written, and the Regrade lists what would change.
+"""
+
+from django.db import transaction
+from django.db.models import F
+
+from . import attempts
+from . import workers
+
+from collections import namedtuple
+import random
+
+CHUNK_SIZE = 500
+
+# A result whose answer or score changes
+Change = namedtuple('Change', ['pk', 'attempt_id', 'number', 'old_answer', 'new_answer',
+                               'old_score', 'new_score', 'answered', 'mc_choices'])
+
+COLUMNS = ('pk', 'attempt_id', 'number', 'inputs', 'answer', 'guess', 'guess_string',
+           'score', 'q_type', 'seed', 'version')
+
+class Regrade(object):
+    """ What a regrade found, and did.
+        <<Attributes>>
+        examined (Integer) how many results were read
+        changes (list) of Changes, in primary key order
+        skipped (list) of the primary keys of results which could not be
+            regraded, because their inputs are not stored or their answer
+            could not be evaluated
+        conflicts (Integer) how many changes were not written because the
+            result was answered while the regrade ran
+        complete (Boolean) whether every result was examined, rather than
+            stopping at a limit
+    """
+    def __init__(self, question, dry_run):
+        self.question = question
+        self.dry_run = dry_run
+        self.examined = 0
+        self.changes = []
+        self.skipped = []
+        self.conflicts = 0
+        self.complete = True
+
+    @property
+    def rescored(self):
+        """ The changes which change a score """
+        return [change for change in self.changes if change.old_score != change.new_score]
+
+    def __str__(self):
+        return "{} results examined, {} answers changed, {} rescored, {} skipped{}".format(
+            self.examined, len(self.changes), len(self.rescored), len(self.skipped),
+            ", {} answered during the regrade".format(self.conflicts) if self.conflicts else '')
+
+
+def evaluate_row(question, choices):
+    """ The answer and options of question for one input, as evaluate_answers
+        gives them, evaluated on their own
+    """
+    try:
+        return (workers.get_answer(question, choices),
+                workers.get_mc_options(question, choices) if question.q_type == "MC" else None)
+    except Exception:
+        return None, None
+
+def evaluate_answers(question, inputs):
+    """ The answer of question for each of inputs, and for multiple choice
+        questions the unshuffled options (otherwise None). The answer is
+        None where it could not be evaluated.
+
+        evaluate_batch gives exactly what get_answer gives, but raises if any
+        input cannot be evaluated, so only then is each input evaluated on
+        its own, to find out which.
+    """
+    try:
+        answers, mc_options = workers.evaluate_batch(question, inputs)
+    except Exception:
+        rows = [evaluate_row(question, choices) for choices in inputs]
+        return [row[0] for row in rows], [row[1] for row in rows]
+    return answers, mc_options or [None]*len(inputs)
+
+def regrade_chunk(question, rows, regrade, accuracy):
+    """ Works out the Changes to a chunk of results, as tuples of COLUMNS """
+    current = []
+    for row in rows:
+        values = dict(zip(COLUMNS, row))
+        # Seeded results of the current version are regenerated from it, so
+        # they are already up to date
+        if values['inputs'] is None:
+            if values['seed'] is None or values['version'] != question.version:
+                regrade.skipped.append(values['pk'])
+            continue
+        current.append(values)
+
+    answers, mc_options = evaluate_answers(question, [values['inputs'] for values in current])
+    changes = []
+    for values, answer, options in zip(current, answers, mc_options):
+        if answer is None:
+            regrade.skipped.append(values['pk'])
+            continue
+        old_answer = attempts.loads(values['answer'])
+        answered = values['guess_string'] is not None
+        if not answered:
+            score = values['score']
+        else:
+            guess = (values['guess_string'] if values['q_type'] == "MC"
+                     else attempts.loads(values['guess']))
+            try:
+                score = attempts.score_guess(values['q_type'], answer, guess, accuracy)
+            except (TypeError, ValueError):
+                regrade.skipped.append(values['pk'])
+                continue
+        if answer != old_answer or score != values['score']:
+            mc_choices = None
+            if not answered and values['q_type'] == "MC" and options is not None:
+                mc_choices = options + [str(answer)]
+                random.shuffle(mc_choices)
+            changes.append(Change(values['pk'], values['attempt_id'], values['number'],
+                                  old_answer, answer, values['score'], score, answered,
+                                  mc_choices))
+    return changes
+
+def apply_changes(question, changes):
+    """ Writes a chunk's changes in one transaction, and returns those which
+        were written
+    """
+    from .models import StudentQuestionResult, StudentQuizResult, StudentQuizState, QuestionStats
+
+    written = []
+    with transaction.atomic():
+        for change in changes:
+            # Unless the question has been answered since it was read
+            unchanged = StudentQuestionResult.objects.filter(
+                pk=change.pk, score=change.old_score, guess_string__isnull=not change.answered)
+            fields = {'answer': attempts.dumps(change.new_answer), 'score': change.new_score}
+            if change.mc_choices is not None:
+                fields['mc_choices'] = attempts.dumps(change.mc_choices)
+            if unchanged.update(**fields):
+                written.append(change)
+
+        rescored = [change for change in written if change.old_score != change.new_score]
+        for delta in set(change.new_score - change.old_score for change in rescored):
+            StudentQuizResult.objects.filter(pk__in=[
+                change.attempt_id for change in rescored
+                if change.new_score - change.old_score == delta
+            ]).update(score=F('score') + delta)
+
+        if rescored:
+            QuestionStats.objects.filter(question=question).update(correct=F('correct') + sum(
+                change.new_score - change.old_score for change in rescored if change.answered))
+
+            # Best scores are over finished attempts, so recompute them
+            students = StudentQuizResult.objects.filter(
+                pk__in=[change.attempt_id for change in rescored]).values('student')
+            StudentQuizState.refresh_best_scores(students, [question.quiz_id])
+    return written
+
+def regrade_question(question, dry_run=False, chunk_size=CHUNK_SIZE, accuracy=10e-5,
+                     limit=None):
+    """ Regrades every result generated from question against its current
+        answer.
+        <<INPUT>>
+        question (MarkedQuestion) the corrected question
+        dry_run (Boolean) only work out what would change
+        chunk_size (Integer) how many results to process in each transaction
+        accuracy (float) as for views.mark_question
+        limit (Integer) stop after the chunk in which this many results have
+            been examined, or None for every result
+        <<OUTPUT>>
+        (Regrade)
+    """
+    from .models import StudentQuestionResult
+
+    regrade = Regrade(question, dry_run)
+    results = StudentQuestionResult.objects.filter(question=question).order_by('pk')
+    last = 0
+    while True:
+        if limit is not None and regrade.examined >= limit:
+            regrade.complete = not results.filter(pk__gt=last).exists()
+            break
+        rows = list(results.filter(pk__gt=last).values_list(*COLUMNS)[:chunk_size])
+        if not rows:
+            break
+        last = rows[-1][0]
+        regrade.examined += len(rows)
+
+        changes = regrade_chunk(question, rows, regrade, accuracy)
+        if changes and not dry_run:
+            written = apply_changes(question, changes)
+            regrade.conflicts += len(changes) - len(written)
+            changes = written
+        regrade.changes.extend(changes)
+    return regrade
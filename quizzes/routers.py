@@ -0,0 +1,104 @@
+""" Routing reporting reads to a replica of the database.
+
+    settings.REPLICA_DATABASE names an alias in settings.DATABASES which is
+    a read-only copy of 'default', such as a streaming replica, or an SQLite
+    file kept up to date by the sync_replica command. Queries are only sent
+    to it while reading_replica is in effect, which reporting views turn on
+    with the reads_from_replica decorator; everything else, and every write,
+    uses 'default'.
+
+    The replica lags behind, so once a request writes, the rest of it reads
+    from 'default' (it is pinned), and so do that user's requests for the
+    next REPLICA_PIN_TIMEOUT seconds (see middleware.ReplicaMiddleware), so
+    that they see their own answers.
+"""
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from contextlib import ContextDecorator
+import threading
+
+# Only the tables of these apps are read from the replica. Sessions and
+# permissions are always read from 'default'.
+REPLICA_APP_LABELS = ('quizzes', 'auth')
+
+_state = threading.local()
+
+def replica_alias():
+    """ The alias of the replica, or None if there is none """
+    alias = getattr(settings, 'REPLICA_DATABASE', None)
+    return alias if alias in settings.DATABASES else None
+
+def reset(pinned=False):
+    """ Starts a request's routing: reads go to 'default' until
+        reading_replica, and stay there if pinned
+    """
+    _state.reading = 0
+    _state.pinned = pinned
+
+def is_pinned():
+    """ Whether this thread has written since reset """
+    return getattr(_state, 'pinned', False)
+
+class reading_replica(ContextDecorator):
+    """ Sends the reads of routed models to the replica, unless this thread
+        has written since its request started. May be nested, and used as a
+        decorator.
+    """
+    def __enter__(self):
+        _state.reading = getattr(_state, 'reading', 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        _state.reading -= 1
+        return False
+
+def reads_from_replica(view):
+    """ Decorates a view which only reports, so that it reads from the replica.
+        Put it below login_required and the like, so that permissions are
+        checked against 'default'.
+    """
+    return reading_replica()(view)
+
+def replica_iterator(iterable):
+    """ Iterates over iterable, reading from the replica for each item. Use
+        for the content of a StreamingHttpResponse, which is produced after
+        the view has returned.
+    """
+    iterator = iter(iterable)
+    while True:
+        with reading_replica():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ReplicaRouter(object):
+    """ Database router which reads from the replica while reading_replica
+        is in effect, and pins the thread to 'default' when it writes.
+    """
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if (alias is None or not getattr(_state, 'reading', 0) or is_pinned()
+                or model._meta.app_label not in REPLICA_APP_LABELS
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            # Explicitly, since Django would otherwise read related objects
+            # from the database their instance came from
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in REPLICA_APP_LABELS:
+            _state.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is a copy, so it is never migrated itself
+        return db != replica_alias()
@@ -0,0 +1,214 @@
+""" Compiled forms of the MarkedQuestion.choices field.
+
+    The choices field is a colon-delimited list of choices, each of which is a
+    semi-colon delimited list of parts, one part per variable. A part is either
+    a number or a randomizer:
+        rand(a,b)  - an integer in [a,b]
+        Rand(a,b)  - a non-zero integer in [a,b]
+        uni(a,b,n) - a real number in [a,b] rounded to n decimal places
+    Each part is compiled into a sampler, which can be validated without
+    sampling and which draws directly from a random number generator. Any
+    other expression is still accepted, and is evaluated as before.
+"""
+
+from django.conf import settings
+
+from .budget import BudgetedEval
+
+import ast
+import random
+import re
+
+RAND_PATTERN = re.compile(r'(rand|Rand)\((-?\d+),(-?\d+)\)$')
+UNI_PATTERN  = re.compile(r'uni\((-?\d*\.?\d+),(-?\d*\.?\d+),(\d+)\)$')
+
+class ChoiceError(ValueError):
+    """ Raised when a choice is not correctly formatted """
+    pass
+
+def isnumber(string):
+    try:
+        float(string)
+        return True
+    except:
+        return False
+
+def randint_nonzero(rng, lower, upper):
+    """ Generates a random non-zero number between lower and upper. See
+        settings.NZRandInt
+    """
+    if lower > 0: # Behave like normal if lower>0
+        return rng.randint(lower, upper)
+    if rng.randint(0,1):
+        return rng.randint(lower, -1)
+    return rng.randint(1, upper)
+
+def sampling_functions(rng):
+    """ settings.PREDEFINED_FUNCTIONS, with the randomizers drawing from rng
+    """
+    functions = dict(settings.PREDEFINED_FUNCTIONS)
+    functions.update({
+        "rand": lambda x,y: rng.randint(x,y),
+        "Rand": lambda x,y: randint_nonzero(rng, x, y),
+        "uni": lambda x,y,z: round(rng.uniform(x,y),z),
+    })
+    return functions
+
+
+class Literal(object):
+    """ A hard coded value, used verbatim """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def validate(self):
+        pass
+
+    def draw(self, rng):
+        return self.text
+
+
+class IntegerRange(object):
+    """ rand(lower, upper) """
+    __slots__ = ('lower', 'upper')
+
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+
+    def validate(self):
+        if self.lower > self.upper:
+            raise ChoiceError("Integer range rand({},{}) out of order.".format(
+                self.lower, self.upper))
+
+    def draw(self, rng):
+        return str(rng.randint(self.lower, self.upper))
+
+
+class NonZeroIntegerRange(IntegerRange):
+    """ Rand(lower, upper) """
+    __slots__ = ()
+
+    def validate(self):
+        if self.lower > self.upper:
+            raise ChoiceError("Integer range Rand({},{}) out of order.".format(
+                self.lower, self.upper))
+        # Ranges containing 0 are sampled from both sides of 0
+        if self.lower <= 0 and (self.lower > -1 or self.upper < 1):
+            raise ChoiceError(("Integer range Rand({},{}) must contain non-zero"
+                " integers on both sides of 0.").format(self.lower, self.upper))
+
+    def draw(self, rng):
+        return str(randint_nonzero(rng, self.lower, self.upper))
+
+
+class Uniform(object):
+    """ uni(lower, upper, precision) """
+    __slots__ = ('lower', 'upper', 'precision')
+
+    def __init__(self, lower, upper, precision):
+        self.lower = lower
+        self.upper = upper
+        self.precision = precision
+
+    def validate(self):
+        if self.lower > self.upper:
+            raise ChoiceError("Real range uni({},{},{}) out of order.".format(
+                self.lower, self.upper, self.precision))
+
+    def draw(self, rng):
+        return str(round(rng.uniform(self.lower, self.upper), self.precision))
+
+
+class Expression(object):
+    """ Any other expression, evaluated with the predefined functions """
+    __slots__ = ('text', 'tree')
+
+    def __init__(self, text, tree):
+        self.text = text
+        self.tree = tree
+
+    def validate(self):
+        known = set(settings.UNIVERSAL_CONSTANTS) | set(settings.PREDEFINED_FUNCTIONS)
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Name) and node.id not in known:
+                raise ChoiceError("Unknown name '{}' in {}.".format(node.id, self.text))
+            if isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+                raise ChoiceError("Invalid function call in {}.".format(self.text))
+
+    def draw(self, rng):
+        evaluator = BudgetedEval(
+            names=settings.UNIVERSAL_CONSTANTS,
+            functions=sampling_functions(rng)
+        )
+        evaluator.expr = self.text
+        return str(evaluator._eval(self.tree))
+
+
+def to_number(string):
+    return float(string) if '.' in string else int(string)
+
+def compile_part(part):
+    """ Compiles a single part of a choice (with whitespace removed) into a
+        sampler. Raises ChoiceError if the part cannot be parsed.
+    """
+    if isnumber(part):
+        return Literal(part)
+
+    match = RAND_PATTERN.match(part)
+    if match:
+        kind = NonZeroIntegerRange if match.group(1) == 'Rand' else IntegerRange
+        return kind(int(match.group(2)), int(match.group(3)))
+
+    match = UNI_PATTERN.match(part)
+    if match:
+        return Uniform(to_number(match.group(1)), to_number(match.group(2)),
+                       int(match.group(3)))
+
+    try:
+        module = ast.parse(part)
+    except SyntaxError:
+        raise ChoiceError("Could not parse '{}'.".format(part))
+    if len(module.body) != 1 or not isinstance(module.body[0], ast.Expr):
+        raise ChoiceError("Could not parse '{}'.".format(part))
+    return Expression(part, module.body[0].value)
+
+def compile_choice(choice, num_vars=None, validate=True):
+    """ Compiles and validates a single choice, such as "rand(1,5);3;uni(0,1,2)"
+        <<INPUT>>
+        choice (String) - the choice, with parts separated by ';'
+        num_vars (Integer) - if given, the number of parts required
+        validate (Boolean) - whether to check the ranges of the samplers
+        <<OUTPUT>>
+        (list) of samplers, one per variable
+        Raises ChoiceError if the choice is invalid.
+    """
+    parts = choice.replace(' ', '').split(';')
+    if num_vars is not None and len(parts) != num_vars:
+        raise ChoiceError("Incorrect number of variables. Given {}, expected {}".format(
+            len(parts), num_vars))
+
+    samplers = [compile_part(part) for part in parts]
+    if validate:
+        for sampler in samplers:
+            sampler.validate()
+    return samplers
+
+def compile_choices(choices):
+    """ Compiles the full MarkedQuestion.choices field. Choices which cannot
+        be parsed are kept as their ChoiceError, which is raised only if they
+        are drawn. Ranges are not validated here; that is done when the
+        choices are saved.
+    """
+    rows = []
+    for choice in (choices or '').split(':'):
+        try:
+            rows.append(compile_choice(choice, validate=False))
+        except ChoiceError as e:
+            rows.append(e)
+    return rows
+
+def draw_choice(samplers, rng=random):
+    """ Draws a concrete choice string, such as "3;-2;0.25" """
+    return ';'.join(sampler.draw(rng) for sampler in samplers)
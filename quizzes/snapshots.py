@@ -0,0 +1,119 @@
+""" Immutable snapshots of a quiz's definition.
+
+    While students take a quiz its definition does not change, yet every
+    question used to fetch the whole MarkedQuestion pool of a category and
+    then fetch the chosen question again. A QuizSnapshot holds the quiz
+    metadata and the fields of all of its MarkedQuestions, with the questions
+    of each category indexed by a compact array of primary keys. Snapshots
+    are keyed by (quiz pk, quiz version). Quiz.version is bumped whenever the
+    quiz or any of its questions change, so a snapshot never needs to be
+    invalidated; stale ones simply stop being used.
+
+    Snapshots are kept in a small per-process cache, backed by the Django
+    cache so that other processes do not rebuild them. If a shared question
+    bank is configured (see bank.py) and holds the current version of the
+    quiz, it is used instead.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .bank import get_bank
+
+from array import array
+from collections import OrderedDict
+import random
+import threading
+
+QUIZ_FIELDS = ('pk', 'course_id', 'name', 'tries', 'live', 'expires', 'out_of', 'version')
+QUESTION_FIELDS = ('pk', 'quiz_id', 'category', 'problem_str', 'choices', 'num_vars',
+                   'answer', 'functions', 'q_type', 'mc_choices', 'version')
+
+class QuizSnapshot(object):
+    """ The definition of a quiz at a given version.
+        quiz - (tuple) the values of QUIZ_FIELDS
+        questions - (dict) mapping MarkedQuestion pk to the tuple of values of
+            QUESTION_FIELDS
+        categories - (dict) mapping each category to an array of the primary
+            keys of its MarkedQuestions
+    """
+    __slots__ = ('quiz', 'questions', 'categories')
+
+    def __init__(self, quiz, questions, categories):
+        self.quiz = quiz
+        self.questions = questions
+        self.categories = categories
+
+    @classmethod
+    def build(cls, quiz):
+        """ Reads the quiz and all of its questions from the database """
+        from .models import MarkedQuestion
+
+        rows = MarkedQuestion.objects.filter(quiz_id=quiz.pk).order_by('pk').values_list(
+            *QUESTION_FIELDS)
+        questions = {}
+        categories = {}
+        for row in rows:
+            questions[row[0]] = tuple(row)
+            categories.setdefault(row[2], []).append(row[0])
+
+        return cls(
+            tuple(getattr(quiz, field) for field in QUIZ_FIELDS),
+            questions,
+            {category: array('l', pks) for category, pks in categories.items()},
+        )
+
+    @property
+    def out_of(self):
+        return self.quiz[QUIZ_FIELDS.index('out_of')]
+
+    def get_question(self, pk):
+        """ Returns a MarkedQuestion built from the snapshot, without querying
+            the database, or None if the question is not part of the quiz.
+        """
+        from .models import MarkedQuestion
+
+        values = self.questions.get(int(pk))
+        if values is None:
+            return None
+        return MarkedQuestion(**dict(zip(QUESTION_FIELDS, values)))
+
+    def random_question(self, category, rng=random):
+        """ Returns a random MarkedQuestion from the given category. Raises
+            IndexError if the category is empty.
+        """
+        return self.get_question(rng.choice(self.categories.get(category, ())))
+
+
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+def cache_key(pk, version):
+    return 'quiz-snapshot:{}:{}'.format(pk, version)
+
+def get_snapshot(quiz):
+    """ Returns the QuizSnapshot for the current version of quiz """
+    bank = get_bank()
+    if bank is not None:
+        snapshot = bank.get_snapshot(quiz.pk, quiz.version)
+        if snapshot is not None:
+            return snapshot
+
+    key = (quiz.pk, quiz.version)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+        if snapshot is not None:
+            _snapshots.move_to_end(key)
+            return snapshot
+
+    snapshot = cache.get(cache_key(*key))
+    if snapshot is None:
+        snapshot = QuizSnapshot.build(quiz)
+        cache.set(cache_key(*key), snapshot,
+                  getattr(settings, 'QUIZ_SNAPSHOT_TIMEOUT', 3600))
+
+    with _snapshots_lock:
+        _snapshots[key] = snapshot
+        while len(_snapshots) > getattr(settings, 'QUIZ_SNAPSHOT_CACHE_SIZE', 64):
+            _snapshots.popitem(last=False)
+    return snapshot
@@ -33,6 +33,7 @@ class MarkedQuestionTable(Table):
     problem_str = MathColumn()
     choices = Column(empty_values=())
     test = Column(empty_values=())
+    regrade = Column(empty_values=(), orderable=False)
     class Meta:
         attrs = {'class': 'paleblue'}
         model = MarkedQuestion
@@ -60,6 +61,17 @@ class MarkedQuestionTable(Table):
                 ) 
             )
 
+    def render_regrade(self,value,record):
+        return format_html('<a href={}>Regrade</a>', 
+                reverse('regrade_question', 
+                    kwargs={
+                        'mq_pk':record.pk,
+                        'quiz_pk': record.quiz.pk,
+                        'course_pk': record.quiz.course.pk,
+                    }
+                ) 
+            )
+
 class AllQuizTable(Table):
     class Meta:
         model = Quiz
@@ -92,7 +104,7 @@ class SQRTable(Table):
 
     def render_cur_quest(self, value, record):
         if value == 0:
-            return "Completed"
+            return "Expired" if record.finalized else "Completed"
         else:
             return value
 
@@ -122,3 +134,36 @@ class QuizResultTable(Table):
 
     def render_guess(self, value, record):
         return format_html('<span class="mathrender">{}</span>', value)
+
+class QuestionStatsTable(Table):
+    # Records are dicts; see views.quiz_stats
+    category        = Column(verbose_name="Category")
+    question        = Column(verbose_name="Question")
+    answered        = Column(verbose_name="Answered")
+    percent_correct = Column(verbose_name="% Correct", empty_values=())
+    average_tries   = Column(verbose_name="Average Try", empty_values=())
+
+    class Meta:
+        attrs = {'class': 'paleblue'}
+        orderable = False
+
+    def render_question(self, value, record):
+        return format_html('<span class="mathrender">{}</span>', mark_safe(value))
+
+    def render_percent_correct(self, value, record):
+        return '-' if value is None else value
+
+    def render_average_tries(self, value, record):
+        return '-' if value is None else value
+
+class RegradeTable(Table):
+    # Records are dicts; see views.regrade_question
+    attempt    = Column(verbose_name="Attempt")
+    old_answer = Column(verbose_name="Old Answer")
+    new_answer = Column(verbose_name="New Answer")
+    old_score  = Column(verbose_name="Old Score")
+    new_score  = Column(verbose_name="New Score")
+
+    class Meta:
+        attrs = {'class': 'paleblue'}
+        orderable = False
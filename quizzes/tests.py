@@ -1,3 +1,1465 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test.client import RequestFactory
+from django.utils import timezone
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.contrib.sessions.models import Session
+from django.http import HttpResponse
+
+from .forms import AddStudentsForm
+from .models import *
+from .middleware.ReplicaMiddleware import ReplicaMiddleware
+from . import analytics
+from . import archive
+from . import attempts
+from . import bank
+from . import batch
+from . import regrade
+from . import routers
+from . import samplers
+from . import views
+from . import workers
+from . import programs
+from . import snapshots
+from .budget import BudgetedEval, BudgetExceeded
+from .costs import check_question
+from .programs import eval_sub_expression, Template, Expression
+from .snapshots import QUIZ_FIELDS
+from simpleeval import simple_eval
+from unittest import mock, skipIf
+
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+
+def clear_caches():
+    """ Forgets the compiled programs and snapshots of earlier tests, whose
+        primary keys are reused once their rows are rolled back
+    """
+    cache.clear()
+    programs._programs.clear()
+    snapshots._snapshots.clear()
+
+def text_answer(answer, choices):
+    """ The answer as the original views.get_answer computed it, by
+        substituting the choices into the text and evaluating that
+    """
+    text = eval_sub_expression(answer.format(v=choices.split(';'))).replace(' ', '')
+    return round(simple_eval(text, functions=dict(settings.PREDEFINED_FUNCTIONS),
+                             names=settings.UNIVERSAL_CONSTANTS), 4)
+
+def make_quiz(name='Quiz', **kwargs):
+    """ A course with a quiz which is open now """
+    now = timezone.now()
+    course = Course.objects.create(name='MAT1')
+    fields = dict(course=course, name=name, tries=0,
+                  live=now - datetime.timedelta(days=1),
+                  expires=now + datetime.timedelta(days=1))
+    fields.update(kwargs)
+    return Quiz.objects.create(**fields)
+
+def make_student(username, course):
+    student = User.objects.create_user(username, '{}@example.com'.format(username), 'pw')
+    membership, _ = UserMembership.objects.get_or_create(user=student)
+    membership.courses.add(course)
+    return student
+
+def start_attempt(student, quiz):
+    """ Starts an attempt as start_quiz does, and returns it """
+    sqr = StudentQuizState.get_for(student, quiz).new_attempt()
+    views.generate_first_questions(sqr)
+    return StudentQuizResult.objects.select_related('quiz').get(pk=sqr.pk)
+
+def answer_current(sqr, answer):
+    """ Submits answer(inputs) to the current question of sqr """
+    sqr = StudentQuizResult.objects.select_related('quiz').get(pk=sqr.pk)
+    record = sqr.get_state().get()
+    return views.submit_answer(sqr, str(answer(record)))
+
+def make_question(quiz, answer, choices='rand(-5,5)', problem=None, **kwargs):
+    question = MarkedQuestion(category=kwargs.pop('category', 1), answer=answer, choices=choices,
+                              problem_str=problem or 'Evaluate {}'.format(answer), **kwargs)
+    question.update(quiz)
+    return question
+
+class ConcurrentStartQuizTest(TransactionTestCase):
+    """ Fires many simultaneous start_quiz requests for one student, as a
+        double click or a retrying load balancer would, at a real database.
+        Exactly one attempt must be created, and every request must be shown
+        that attempt.
+    """
+    REQUESTS = 12
+
+    def setUp(self):
+        clear_caches()
+        now = timezone.now()
+        self.course = Course.objects.create(name='MAT1')
+        self.quiz = Quiz.objects.create(
+            course=self.course, name='Quiz', tries=2,
+            live=now - datetime.timedelta(days=1),
+            expires=now + datetime.timedelta(days=1))
+        question = MarkedQuestion(category=1, problem_str='What is {v[0]}+1?',
+                                  answer='{v[0]}+1', choices='rand(1,5)')
+        question.update(self.quiz)
+
+        self.student = User.objects.create_user('student', 's@example.com', 'pw')
+        membership, _ = UserMembership.objects.get_or_create(user=self.student)
+        membership.courses.add(self.course)
+
+        # Logging in writes the session, so it is done before the threads start
+        self.clients = []
+        for k in range(self.REQUESTS):
+            client = Client()
+            client.login(username='student', password='pw')
+            self.clients.append(client)
+
+        self.url = reverse('start_quiz', kwargs={
+            'course_pk': self.course.pk, 'quiz_pk': self.quiz.pk})
+
+    def start_concurrently(self):
+        """ Sends every client's start request at once, and returns the
+            responses and the exceptions raised.
+        """
+        barrier = threading.Barrier(len(self.clients))
+        responses, errors = [], []
+
+        def start(client):
+            try:
+                barrier.wait()
+                responses.append(client.get(self.url))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=start, args=(client,)) for client in self.clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses, errors
+
+    def assert_one_attempt(self, attempt, responses, errors):
+        self.assertEqual(errors, [])
+        results = StudentQuizResult.objects.filter(student=self.student, quiz=self.quiz)
+        self.assertEqual(results.filter(attempt=attempt).count(), 1)
+        self.assertFalse(results.filter(attempt__gt=attempt).exists())
+
+        result = results.get(attempt=attempt)
+        self.assertEqual(result.questions.count(), 1)
+        state = StudentQuizState.objects.get(student=self.student, quiz=self.quiz)
+        self.assertEqual((state.latest_id, state.attempts, state.in_progress),
+                         (result.pk, attempt, True))
+
+        link = reverse('display_question', kwargs={
+            'course_pk': self.course.pk, 'quiz_pk': self.quiz.pk, 'sqr_pk': result.pk})
+        self.assertEqual(len(responses), self.REQUESTS)
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(link, response.content.decode())
+
+    def finish(self, result):
+        result.cur_quest = 0
+        result.save()
+        StudentQuizState.attempt_finished(result)
+
+    def test_first_attempt(self):
+        responses, errors = self.start_concurrently()
+        self.assert_one_attempt(1, responses, errors)
+
+    def test_next_attempt(self):
+        self.clients[0].get(self.url)
+        self.finish(StudentQuizResult.objects.get(student=self.student, attempt=1))
+
+        responses, errors = self.start_concurrently()
+        self.assert_one_attempt(2, responses, errors)
+
+    def test_generated_outside_transaction(self):
+        # Evaluating questions must not hold the database's write lock
+        Quiz.objects.filter(pk=self.quiz.pk).update(generate_upfront=True)
+        question = MarkedQuestion(category=2, problem_str='What is {v[0]}-1?',
+                                  answer='{v[0]}-1', choices='rand(1,5)')
+        question.update(Quiz.objects.get(pk=self.quiz.pk))
+        generate = views.generate_first_questions
+        in_transaction = []
+        def generate_first_questions(sqr, commit=True):
+            in_transaction.append(connection.in_atomic_block)
+            return generate(sqr, commit)
+
+        with mock.patch.object(views, 'generate_first_questions', generate_first_questions):
+            response = self.clients[0].get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(in_transaction, [False])
+        result = StudentQuizResult.objects.get(student=self.student, quiz=self.quiz)
+        self.assertEqual(sorted(result.questions.values_list('number', flat=True)), [1, 2])
+
+    def test_stale_state(self):
+        # Results created without going through the state, as before it
+        # existed
+        StudentQuizState.get_for(self.student, self.quiz)
+        StudentQuizResult.objects.create(student=self.student, quiz=self.quiz,
+                                         attempt=1, score=0, cur_quest=0)
+
+        responses, errors = self.start_concurrently()
+        self.assert_one_attempt(2, responses, errors)
+
+
+class ProgramTest(TestCase):
+    """ Compiled templates and expressions must behave exactly like the
+        original text substitution, including where a negative input changes
+        the meaning of the text.
+    """
+    PROBLEMS = [
+        'What is \\({v[0]}^2\\)? @{v[0]}**2@ or @({v[0]})**2@',
+        'Expand @({v[0]}+{v[1]})**2@ and @-{v[1]}**3@, then {v[0]}{v[1]}',
+        'Plain {v[1]} and {v[0]}',
+    ]
+
+    def setUp(self):
+        clear_caches()
+
+    def test_rendering(self):
+        for problem in self.PROBLEMS:
+            template = Template(problem)
+            for choices in SIGN_INPUTS:
+                values = choices.split(';')
+                self.assertEqual(template.render(values),
+                                 eval_sub_expression(problem.format(v=values)), (problem, choices))
+
+    def test_answers(self):
+        quiz = make_quiz()
+        for answer in SIGN_TEMPLATES + ['@{v[0]}**2@*2', '{v[0]}--{v[1]}', '{v[1]}**-2']:
+            program = make_question(quiz, answer).get_program()
+            for choices in SIGN_INPUTS:
+                try:
+                    expected = text_answer(answer, choices)
+                except ZeroDivisionError:
+                    continue
+                self.assertEqual(program.get_answer(choices), expected, (answer, choices))
+
+    def test_sign_sensitive_fallback(self):
+        # The tree is only used where it gives what the text would
+        for text in ('{v[0]}**2', '({v[0]})**2'):
+            expression = Template(text).expression()
+            self.assertIsNotNone(expression.tree)
+            self.assertEqual(expression.sign_sensitive, {'_v0_'})
+            self.assertEqual(expression.bind(['3']), {'_v0_': 3})
+            self.assertIsNone(expression.bind(['-3']))
+            self.assertIsNone(expression.bind(['-0.0']))
+        self.assertEqual(Template('2**{v[0]}').expression().bind(['-3']), {'_v0_': -3})
+
+
+# Templates in which a negative input changes meaning with the parentheses
+SIGN_TEMPLATES = [
+    '{v[0]}**2',
+    '({v[0]})**2',
+    '({v[0]})**2 + {v[0]}**2',
+    '{v[0]}**3 - 2*{v[0]}',
+    '2**{v[0]} + ({v[1]})**3',
+    '-{v[0]}**2 * {v[1]}',
+]
+SIGN_INPUTS = ['-3;2', '-2;-1', '4;-3', '-1.6;0.5', '0;-2', '-0.0;1', '2.5;-1.5', '-7;3']
+
+@skipIf(batch.np is None, "NumPy is not installed")
+class SamplerTest(TestCase):
+    """ Each part of a choice compiles to the right sampler, which only
+        draws values from its range, and invalid choices are refused with a
+        ChoiceError when they are saved.
+    """
+    def draws(self, choice, count=200):
+        compiled = samplers.compile_choice(choice)
+        rng = random.Random(0)
+        return [samplers.draw_choice(compiled, rng).split(';') for k in range(count)]
+
+    def test_samplers(self):
+        compiled = samplers.compile_choice('3; -2.5 ;rand(-2,2);Rand(-3,3);uni(0,1,2);2*rand(1,3)',
+                                           num_vars=6)
+        self.assertEqual([type(sampler) for sampler in compiled],
+                         [samplers.Literal, samplers.Literal, samplers.IntegerRange,
+                          samplers.NonZeroIntegerRange, samplers.Uniform, samplers.Expression])
+        for literal, literal2, integer, nonzero, real, expression in \
+                self.draws('3;-2.5;rand(-2,2);Rand(-3,3);uni(0,1,2);2*rand(1,3)'):
+            self.assertEqual((literal, literal2), ('3', '-2.5'))
+            self.assertIn(int(integer), range(-2, 3))
+            self.assertIn(int(nonzero), [-3, -2, -1, 1, 2, 3])
+            self.assertTrue(0 <= float(real) <= 1 and len(real.split('.')[-1]) <= 2, real)
+            self.assertIn(int(expression), [2, 4, 6])
+        # Both sides of 0 are drawn
+        self.assertEqual({int(row[0]) > 0 for row in self.draws('Rand(-1,1)')}, {True, False})
+
+    def test_num_vars(self):
+        self.assertEqual(len(samplers.compile_choice('1;2', num_vars=2)), 2)
+        for choice, num_vars in (('1;2', 3), ('1;2;3', 2), ('rand(1,2)', 2)):
+            with self.assertRaises(samplers.ChoiceError):
+                samplers.compile_choice(choice, num_vars=num_vars)
+
+    def test_ranges(self):
+        for choice in ('rand(1,1)', 'rand(-5,-5)', 'uni(-1,-1,2)', 'Rand(1,5)', 'Rand(-4,2)',
+                       'Rand(-1,1)'):
+            samplers.compile_choice(choice)
+        for choice in ('rand(3,1)', 'uni(1,0.5,2)', 'Rand(5,1)',
+                       # Straddling or touching 0 without non-zero integers on both sides
+                       'Rand(0,5)', 'Rand(-5,0)', 'Rand(0,0)', 'Rand(-5,-1)',
+                       # Not an expression
+                       'rand(1,', 'x+1', 'a=1', '().__class__()'):
+            with self.assertRaises(samplers.ChoiceError, msg=choice):
+                samplers.compile_choice(choice)
+        # Out of order ranges are only refused when validating
+        self.assertEqual(len(samplers.compile_choice('rand(3,1)', validate=False)), 1)
+
+    def test_compile_choices(self):
+        rows = samplers.compile_choices('rand(1,2);3:bad(:4;5')
+        self.assertEqual(len(rows[0]), 2)
+        self.assertIsInstance(rows[1], samplers.ChoiceError)
+        self.assertEqual(samplers.draw_choice(rows[2]), '4;5')
+
+
+class BatchEvaluationTest(TestCase):
+    """ evaluate_batch must give exactly what evaluating each input on its
+        own, and the original text substitution, give.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+
+    def test_negative_inputs(self):
+        for answer in SIGN_TEMPLATES:
+            question = make_question(self.quiz, answer)
+            answers, _ = batch.evaluate_batch(question, SIGN_INPUTS)
+            program = question.get_program()
+            for choices, batched in zip(SIGN_INPUTS, answers):
+                expected = text_answer(answer, choices)
+                self.assertEqual(program.get_answer(choices), expected, (answer, choices))
+                self.assertEqual(batched, expected, (answer, choices))
+                self.assertIs(type(batched), type(expected), (answer, choices))
+
+    def test_mc_options(self):
+        question = make_question(self.quiz, '({v[0]})**2', q_type='MC',
+                                 mc_choices='{v[0]}**2;({v[0]})**3;None of the above')
+        answers, options = batch.evaluate_batch(question, SIGN_INPUTS)
+        program = question.get_program()
+        for choices, batched in zip(SIGN_INPUTS, options):
+            self.assertEqual(batched, program.get_mc_options(choices), choices)
+
+
+class BudgetTest(TestCase):
+    """ Every expression is evaluated within its budget, so that an answer
+        like 9**9**9 is refused at once rather than tying up the process.
+    """
+    def evaluate(self, expression, **kwargs):
+        return BudgetedEval(**kwargs).eval(expression)
+
+    @override_settings(EVALUATION_MAX_LENGTH=20)
+    def test_length(self):
+        self.assertEqual(self.evaluate('+'.join(['1']*10)), 10)
+        with self.assertRaises(BudgetExceeded):
+            self.evaluate('+'.join(['1']*11))
+
+    @override_settings(EVALUATION_MAX_OPERATIONS=20)
+    def test_operations(self):
+        # n terms are 2n-1 nodes
+        self.assertEqual(self.evaluate('+'.join(['1']*10)), 10)
+        with self.assertRaises(BudgetExceeded):
+            self.evaluate('+'.join(['1']*11))
+        # The count starts again for each expression
+        evaluator = BudgetedEval()
+        for k in range(3):
+            self.assertEqual(evaluator.eval('+'.join(['1']*10)), 10)
+
+    def test_bits(self):
+        accepted = {'2**9999': 2**9999, '2**5000*2**4000': 2**9000, '1<<9999': 1<<9999,
+                    '(-2)**9999': (-2)**9999, '2.0**1000': 2.0**1000, '9**9': 9**9}
+        for expression, value in accepted.items():
+            self.assertEqual(self.evaluate(expression), value, expression)
+        for expression in ('9**9**9', '2**10001', '99**4000', '2**5001*2**5001', '1<<10001',
+                           '(2**5000)**3', '10**4000'):
+            with self.assertRaises(BudgetExceeded, msg=expression):
+                self.evaluate(expression)
+        with self.assertRaises(BudgetExceeded):
+            self.evaluate('f(2)', functions={'f': lambda x: x**20000})
+
+    def test_student_answer(self):
+        quiz = make_quiz()
+        make_question(quiz, '{v[0]}+1', choices='rand(1,5)')
+        sqr = start_attempt(make_student('student', quiz.course), quiz)
+        # Refused like any answer which cannot be parsed
+        with self.assertRaises(ValueError):
+            answer_current(sqr, lambda record: '9**9**9')
+        record = StudentQuestionResult.objects.get(attempt=sqr)
+        self.assertEqual((record.guess_string, record.score), (None, 0))
+
+
+class CostEstimateTest(TestCase):
+    """ Questions whose expressions can exceed the budget for some of the
+        declared inputs are reported before they are saved, and others are
+        not.
+    """
+    def messages(self, answer, choices, **kwargs):
+        kwargs.setdefault('problem_str', 'Evaluate')
+        return check_question(MarkedQuestion(answer=answer, choices=choices, functions='{}',
+                                             **kwargs))
+
+    def test_accepted(self):
+        for answer, choices in (('{v[0]}**{v[1]}', 'rand(1,9);rand(1,9)'),
+                                ('{v[0]}**100*{v[1]}', 'rand(-50,50);uni(-1,1,2)'),
+                                ('{v[0]}**{v[1]}', 'uni(1,9,2);rand(1,1000000)'),
+                                ('f({v[0]})**{v[0]}', 'rand(1,9)'),
+                                ('2**9999', '1')):
+            self.assertEqual(self.messages(answer, choices), [], answer)
+
+    def test_rejected(self):
+        for answer, choices in (('{v[0]}**{v[1]}**9', 'rand(1,9);rand(1,9)'),
+                                ('9**9**9', '1'),
+                                ('{v[0]}**{v[1]}', 'rand(2,9);rand(1,1000000)'),
+                                ('(2**5001)*(2**5001)', '1')):
+            messages = self.messages(answer, choices)
+            self.assertEqual(len(messages), 1, answer)
+            self.assertIn('The answer can produce', messages[0])
+
+        # Every part of the question is checked
+        messages = self.messages('1', 'rand(1,9)', q_type='MC', problem_str='@9**9**9@',
+                                 mc_choices='1;{v[0]}**9**9')
+        self.assertEqual(len(messages), 2)
+        self.assertIn('The problem', messages[0])
+        self.assertIn('multiple choice option 2', messages[1])
+
+
+@override_settings(QUESTION_VARIANT_POOLS=True)
+class VariantPoolTest(TestCase):
+    """ Pre-generated variants must carry the answer get_answer gives, and
+        only be used for the version of the question they came from.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+        self.question = make_question(self.quiz, '({v[0]})**2 - {v[0]}**2',
+                                      choices='rand(-9,-1)')
+
+    def test_fill(self):
+        self.assertEqual(self.question.refill_variants(20), 20)
+        self.assertEqual(self.question.refill_variants(20), 0)
+        program = self.question.get_program()
+        for variant in self.question.variants.all():
+            self.assertEqual(variant.get_answer(), program.get_answer(variant.inputs))
+            self.assertEqual(variant.problem, program.render_problem(variant.inputs))
+
+    def test_pop(self):
+        self.question.refill_variants(3)
+        popped = [self.question.pop_variant() for k in range(4)]
+        self.assertIsNone(popped[-1])
+        self.assertEqual(len(set(variant.pk for variant in popped[:3])), 3)
+        self.assertFalse(self.question.variants.exists())
+
+    def test_version_invalidation(self):
+        self.question.refill_variants(5)
+        self.question.update(self.quiz)
+        self.assertIsNone(self.question.pop_variant())
+        self.assertEqual(self.question.refill_variants(5), 5)
+        self.assertEqual(set(self.question.variants.values_list('version', flat=True)),
+                         {self.question.version})
+
+    def test_disabled(self):
+        self.question.refill_variants(3)
+        with override_settings(QUESTION_VARIANT_POOLS=False):
+            with self.assertNumQueries(0):
+                self.assertIsNone(self.question.pop_variant())
+        self.assertEqual(self.question.variants.count(), 3)
+
+
+class QuestionBankTest(TestCase):
+    """ The shared question bank must give back exactly the questions it was
+        built from, and a process attached to it must only ever see a
+        complete bank.
+    """
+    def setUp(self):
+        clear_caches()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'bank')
+        self.quiz = make_quiz()
+        self.questions = [
+            make_question(self.quiz, '{v[0]}+1', problem='Évaluez \\({v[0]}+1\\)'),
+            make_question(self.quiz, 'f({v[0]})', functions="{'f': lambda x: x*2}"),
+            make_question(self.quiz, '{v[0]}**2', category=2, q_type='MC',
+                          mc_choices='{v[0]};None of the above'),
+        ]
+        self.other = make_quiz('Other')
+        self.other_question = make_question(self.other, '1', choices='1')
+
+    def fresh(self, quiz):
+        return Quiz.objects.get(pk=quiz.pk)
+
+    def fields(self, question):
+        return [getattr(question, field) for field in
+                ('pk', 'quiz_id', 'category', 'version', 'num_vars', 'q_type') + bank.TEXT_FIELDS]
+
+    def test_round_trip(self):
+        self.assertEqual(bank.build_bank(self.path, [self.fresh(self.other), self.fresh(self.quiz)]), 1)
+        shared = bank.QuestionBank(self.path)
+        quiz = self.fresh(self.quiz)
+        snapshot = shared.get_snapshot(quiz.pk, quiz.version)
+        self.assertEqual((snapshot.pk, snapshot.out_of), (quiz.pk, 2))
+        for question in self.questions:
+            self.assertEqual(self.fields(snapshot.get_question(question.pk)),
+                             self.fields(MarkedQuestion.objects.get(pk=question.pk)))
+        self.assertIsNone(snapshot.get_question(self.other_question.pk))
+        self.assertEqual(snapshot.random_question(2).pk, self.questions[2].pk)
+        self.assertIn(snapshot.random_question(1).pk, [q.pk for q in self.questions[:2]])
+        with self.assertRaises(IndexError):
+            snapshot.random_question(3)
+
+        # Other versions of the quiz, and other quizzes, are not in the bank
+        self.assertIsNone(shared.get_snapshot(quiz.pk, quiz.version + 1))
+        self.assertIsNone(shared.get_snapshot(quiz.pk + self.other.pk, 1))
+        with override_settings(QUESTION_BANK_PATH=self.path):
+            self.assertIsInstance(snapshots.get_snapshot(quiz), bank.BankSnapshot)
+
+    def test_new_version(self):
+        bank.build_bank(self.path, [self.fresh(self.quiz)])
+        shared = bank.QuestionBank(self.path)
+        old = shared.get_snapshot(self.quiz.pk, self.fresh(self.quiz).version)
+
+        question = self.questions[0]
+        question.answer = '{v[0]}+2'
+        question.update(self.quiz)
+        quiz = self.fresh(self.quiz)
+        self.assertEqual(bank.build_bank(self.path, [quiz]), 2)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['bank', 'bank.2'])
+
+        # The same attachment sees the new bank
+        snapshot = shared.get_snapshot(quiz.pk, quiz.version)
+        self.assertEqual(snapshot.get_question(question.pk).answer, '{v[0]}+2')
+        self.assertEqual(shared.current().version, 2)
+        # and a snapshot of the old one can still be read after its file is gone
+        self.assertEqual(old.get_question(question.pk).answer, '{v[0]}+1')
+
+    def test_never_half_written(self):
+        bank.build_bank(self.path, [self.fresh(self.quiz)])
+        shared = bank.QuestionBank(self.path)
+        version = self.fresh(self.quiz).version
+        fsync, seen = os.fsync, []
+
+        def read_while_writing(fd):
+            # Whichever bank a reader attaches to is complete
+            seen.append(shared.current().version)
+            self.assertIsNotNone(shared.get_snapshot(self.quiz.pk, version))
+            fsync(fd)
+
+        with mock.patch.object(bank.os, 'fsync', read_while_writing):
+            bank.build_bank(self.path, [self.fresh(self.quiz)])
+        # The old bank while the new file is written, and the new one only
+        # once the control file names it
+        self.assertEqual(seen, [1, 2])
+        self.assertEqual(shared.current().version, 2)
+
+        # A version whose file is missing or not a bank is ignored
+        with open(self.path, 'r+b') as f:
+            f.write(bank.CONTROL.pack(bank.MAGIC, 3))
+        self.assertIsNone(shared.get_snapshot(self.quiz.pk, version))
+        with open(self.path + '.3', 'wb') as f:
+            f.write(b'\0'*bank.HEADER.size)
+        self.assertIsNone(shared.get_snapshot(self.quiz.pk, version))
+
+
+class RegradeTest(TestCase):
+    """ Corrects the answer of a question which read '{v[0]}**2' for negative
+        inputs, and regrades the students who answered it.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz(tries=0)
+        self.question = make_question(self.quiz, '{v[0]}**2', choices='rand(-5,-1)')
+        self.key = make_student('key', self.quiz.course)
+        self.right = make_student('right', self.quiz.course)
+        self.open = make_student('open', self.quiz.course)
+
+        # Matched the wrong key, which is -(x**2)
+        self.key_attempt = start_attempt(self.key, self.quiz)
+        answer_current(self.key_attempt, lambda record: -int(record.inputs)**2)
+        # Answered what was meant
+        self.right_attempt = start_attempt(self.right, self.quiz)
+        answer_current(self.right_attempt, lambda record: int(record.inputs)**2)
+        # Has not answered yet
+        self.open_attempt = start_attempt(self.open, self.quiz)
+
+        self.question.answer = '({v[0]})**2'
+        self.question.update(self.quiz)
+
+    def scores(self):
+        return [StudentQuizResult.objects.get(pk=sqr.pk).score
+                for sqr in (self.key_attempt, self.right_attempt, self.open_attempt)]
+
+    def best_scores(self):
+        return [StudentQuizState.objects.get(student=student, quiz=self.quiz).best_score
+                for student in (self.key, self.right)]
+
+    def test_dry_run(self):
+        result = regrade.regrade_question(self.question, dry_run=True)
+        self.assertEqual((result.examined, len(result.changes), len(result.rescored)), (3, 3, 2))
+        self.assertEqual(self.scores(), [1, 0, 0])
+        self.assertEqual(self.best_scores(), [1, 0])
+        self.assertIn("3 results examined, 3 answers changed, 2 rescored", str(result))
+
+    def test_regrade(self):
+        result = regrade.regrade_question(self.question, chunk_size=2)
+        self.assertEqual((len(result.changes), len(result.rescored), result.conflicts), (3, 2, 0))
+        self.assertEqual(self.scores(), [0, 1, 0])
+        self.assertEqual(self.best_scores(), [0, 1])
+        stats = QuestionStats.objects.get(question=self.question)
+        self.assertEqual((stats.answered, stats.correct), (2, 1))
+        for record in StudentQuestionResult.objects.filter(question=self.question):
+            self.assertEqual(attempts.loads(record.answer), int(record.inputs)**2)
+
+        # Nothing is left to change
+        again = regrade.regrade_question(self.question)
+        self.assertEqual((again.examined, len(again.changes)), (3, 0))
+
+    def test_limit(self):
+        preview = regrade.regrade_question(self.question, dry_run=True, chunk_size=2, limit=2)
+        self.assertEqual((preview.examined, preview.complete), (2, False))
+        whole = regrade.regrade_question(self.question, dry_run=True, chunk_size=3, limit=3)
+        self.assertEqual((whole.examined, whole.complete), (3, True))
+
+    def test_view(self):
+        self.quiz.course.add_admin('staff')
+        staff = User.objects.get(username='staff')
+        staff.set_password('pw')
+        staff.save()
+        self.client.login(username='staff', password='pw')
+        url = reverse('regrade_question', args=(self.quiz.course.pk, self.quiz.pk, self.question.pk))
+
+        # Too many results for one chunk: only previewed, even on a POST
+        with mock.patch.object(regrade, 'CHUNK_SIZE', 2):
+            response = self.client.get(url)
+            self.assertEqual((response.context['regrade'].examined, response.context['results']), (2, 3))
+            self.assertContains(response, 'manage.py regrade_question {}'.format(self.question.pk))
+            self.client.post(url)
+        self.assertEqual(self.scores(), [1, 0, 0])
+
+        response = self.client.get(url)
+        self.assertContains(response, 'value="Regrade"')
+        response = self.client.post(url)
+        self.assertFalse(response.context['regrade'].dry_run)
+        self.assertEqual(self.scores(), [0, 1, 0])
+
+    def test_conflict(self):
+        # The open attempt is answered after the regrade read it
+        rows = list(StudentQuestionResult.objects.filter(question=self.question)
+                    .order_by('pk').values_list(*regrade.COLUMNS))
+        changes = regrade.regrade_chunk(self.question, rows,
+                                        regrade.Regrade(self.question, False), 10e-5)
+        answer_current(self.open_attempt, lambda record: int(record.inputs)**2)
+
+        written = regrade.apply_changes(self.question, changes)
+        self.assertEqual(len(written), 2)
+        self.assertNotIn(self.open_attempt.pk, [change.attempt_id for change in written])
+        open_result = StudentQuestionResult.objects.get(attempt=self.open_attempt)
+        self.assertEqual(open_result.guess_string, str(int(open_result.inputs)**2))
+
+
+class ArchiveTest(TestCase):
+    """ Archived attempts must still count, and still be shown, everywhere
+        the attempts are read.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz(tries=0)
+        self.course = self.quiz.course
+        make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+        self.student = make_student('student', self.course)
+        self.best = start_attempt(self.student, self.quiz)
+        answer_current(self.best, lambda record: int(record.inputs) + 1)
+        self.worst = start_attempt(self.student, self.quiz)
+        answer_current(self.worst, lambda record: 0)
+
+        self.course.add_admin('staff')
+        staff = User.objects.get(username='staff')
+        staff.set_password('pw')
+        staff.save()
+
+    def state(self):
+        return StudentQuizState.objects.get(student=self.student, quiz=self.quiz)
+
+    def details(self, sqr):
+        client = Client()
+        client.login(username='student', password='pw')
+        return client.get(reverse('quiz_details', kwargs={
+            'course_pk': self.course.pk, 'quiz_pk': self.quiz.pk, 'sqr_pk': sqr.pk}))
+
+    def gradebook(self, **params):
+        client = Client()
+        client.login(username='staff', password='pw')
+        response = client.get(reverse('gradebook', kwargs={'course_pk': self.course.pk}), params)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_archived_attempts_still_count(self):
+        details = self.details(self.best).content
+        gradebook, attempt_rows = self.gradebook(), self.gradebook(attempts=1)
+        self.assertEqual(gradebook[1].split(',')[-1], '1')
+        self.assertEqual(len(attempt_rows), 3)
+
+        self.assertEqual(archive.archive_attempts(
+            StudentQuizResult.objects.filter(pk=self.best.pk)), 1)
+        # As after a regrade or finalize_expired
+        StudentQuizState.refresh_best_scores([self.student.pk], [self.quiz.pk])
+        self.assertEqual(self.state().best_score, 1)
+
+        self.assertEqual(archive.archive_attempts(StudentQuizResult.objects.all()), 1)
+        StudentQuizState.refresh_best_scores([self.student.pk], [self.quiz.pk])
+        self.assertEqual((self.state().best_score, self.state().attempts), (1, 2))
+        self.assertFalse(StudentQuizResult.objects.exists())
+
+        self.assertEqual(self.gradebook(), gradebook)
+        self.assertEqual(self.gradebook(attempts=1), attempt_rows)
+        response = self.details(self.best)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, details)
+
+        StudentQuizState.objects.all().delete()
+        call_command('rebuild_quiz_states', stdout=open(os.devnull, 'w'))
+        state = self.state()
+        self.assertEqual((state.best_score, state.attempts, state.latest_id, state.in_progress),
+                         (1, 2, None, False))
+        self.assertEqual(StudentQuizState.rebuild(self.student, self.quiz).best_score, 1)
+
+
+class FinalizeExpiredTest(TestCase):
+    """ Closing the attempts at expired quizzes keeps what was answered,
+        updates only the states of those attempts, and never closes an
+        attempt twice.
+    """
+    def setUp(self):
+        clear_caches()
+        self.now = timezone.now() + datetime.timedelta(days=2)
+        self.expired = make_quiz('Expired')
+        self.single = make_quiz('Single')
+        self.later = make_quiz('Later', expires=self.now + datetime.timedelta(days=1))
+        for quiz in (self.expired, self.later):
+            make_question(quiz, '{v[0]}+1', choices='rand(1,5)')
+            make_question(quiz, '{v[0]}+2', choices='rand(1,5)', category=2)
+        make_question(self.single, '{v[0]}+1', choices='rand(1,5)')
+
+        self.a, self.b, self.c = (make_student(username, self.expired.course)
+                                  for username in ('a', 'b', 'c'))
+        # a has answered one question of two
+        self.a_open = start_attempt(self.a, self.expired)
+        answer_current(self.a_open, lambda record: int(record.inputs) + 1)
+        self.b_single = start_attempt(self.b, self.single)
+        self.b_open = start_attempt(self.b, self.expired)
+        # a has finished an attempt at the other expired quiz
+        answer_current(start_attempt(self.a, self.single), lambda record: 0)
+        self.c_open = start_attempt(self.c, self.later)
+
+    def attempts(self):
+        return list(StudentQuizResult.objects.order_by('pk').values_list(
+            'pk', 'cur_quest', 'finalized', 'score'))
+
+    def states(self):
+        return {(state.student_id, state.quiz_id): (state.in_progress, state.best_score)
+                for state in StudentQuizState.objects.all()}
+
+    def test_finalize(self):
+        refresh = mock.patch.object(StudentQuizState, 'refresh_best_scores',
+                                    wraps=StudentQuizState.refresh_best_scores)
+        with refresh as refreshed:
+            # Three open attempts, so the second chunk has one
+            self.assertEqual(StudentQuizResult.finalize_expired(self.now, chunk_size=2), 3)
+        # The first chunk is a at one quiz and b at the other, which must not
+        # refresh a's finished attempt at the other quiz
+        self.assertEqual(refreshed.call_count, 3)
+        self.assertEqual({(quiz, student) for (students, (quiz,)), _ in refreshed.call_args_list
+                          for student in students},
+                         {(self.expired.pk, self.a.pk), (self.expired.pk, self.b.pk),
+                          (self.single.pk, self.b.pk)})
+
+        closed = StudentQuizResult.objects.filter(
+            pk__in=[self.a_open.pk, self.b_open.pk, self.b_single.pk])
+        self.assertEqual(set(closed.values_list('cur_quest', 'finalized')), {(0, True)})
+        self.assertEqual(StudentQuizResult.objects.get(pk=self.a_open.pk).score, 1)
+        self.assertEqual(StudentQuizResult.objects.get(pk=self.c_open.pk).cur_quest, 1)
+        states = self.states()
+        self.assertEqual(states[self.a.pk, self.expired.pk], (False, 1))
+        self.assertEqual(states[self.b.pk, self.expired.pk], (False, 0))
+        self.assertEqual(states[self.b.pk, self.single.pk], (False, 0))
+        self.assertEqual(states[self.c.pk, self.later.pk], (True, None))
+
+        # Running again changes nothing
+        attempts, states = self.attempts(), self.states()
+        self.assertEqual(StudentQuizResult.finalize_expired(self.now, chunk_size=2), 0)
+        self.assertEqual((self.attempts(), self.states()), (attempts, states))
+
+    def test_finished_meanwhile(self):
+        # b finishes between the chunk being read and being closed
+        atomic, finished = transaction.atomic, []
+        def finish_first(*args, **kwargs):
+            if not finished:
+                finished.append(True)
+                answer_current(self.b_single, lambda record: int(record.inputs) + 1)
+            return atomic(*args, **kwargs)
+
+        with mock.patch.object(transaction, 'atomic', finish_first):
+            self.assertEqual(StudentQuizResult.finalize_expired(self.now), 2)
+        b_single = StudentQuizResult.objects.get(pk=self.b_single.pk)
+        self.assertEqual((b_single.cur_quest, b_single.finalized, b_single.score), (0, False, 1))
+        self.assertEqual(self.states()[self.b.pk, self.single.pk], (False, 1))
+
+
+@override_settings(EVALUATION_WORKERS=1, EVALUATION_TIMEOUT=0.5, EVALUATION_QUEUE_WAIT=0.1)
+class WorkerPoolTest(TestCase):
+    """ A question which cannot be evaluated in time, or while every worker
+        is busy, must fail like an invalid question, not take the site down.
+    """
+    def setUp(self):
+        clear_caches()
+        workers._pool = None
+        self.quiz = make_quiz()
+        self.question = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+        self.slow = make_question(self.quiz, 'spin({v[0]})', category=2,
+                                  functions="{'spin': lambda x: sum(range(10**10)) + x}")
+
+    def tearDown(self):
+        while not workers._pool.idle.empty():
+            workers._pool.idle.get().kill()
+        workers._pool = None
+        clear_caches()
+
+    def test_timeout(self):
+        with self.assertRaises(workers.EvaluationTimeout):
+            workers.get_answer(self.slow, '3')
+        # The worker was replaced
+        self.assertEqual(workers._pool.idle.qsize(), 1)
+        self.assertEqual(workers.get_answer(self.question, '3'), 4)
+
+    def test_restricted_builtins(self):
+        allowed = make_question(self.quiz, 'f({v[0]})', category=3,
+                                functions="{'f': lambda x: max(abs(x), math.floor(2.5))}")
+        self.assertEqual(workers.get_answer(allowed, '-3'), 3)
+        for functions in ("{'f': lambda x: open('/etc/passwd') and x}",
+                          "{'f': lambda x: __import__('os').getpid() + x}",
+                          "{'f': lambda x: ().__class__.__bases__[0] and x}",
+                          "{'f': lambda x: random._os and x}"):
+            question = make_question(self.quiz, 'f({v[0]})', category=4, functions=functions)
+            with self.assertRaises(Exception, msg=functions):
+                workers.get_answer(question, '3')
+        # The worker survived
+        self.assertEqual(workers.get_answer(self.question, '3'), 4)
+
+    def test_saturated(self):
+        worker = workers.get_pool().acquire()
+        try:
+            with self.assertRaises(workers.PoolSaturated):
+                workers.get_answer(self.question, '3')
+        finally:
+            workers._pool.release(worker)
+        self.assertEqual(workers.get_answer(self.question, '3'), 4)
+
+    def test_view(self):
+        student = make_student('student', self.quiz.course)
+        sqr = start_attempt(student, self.quiz)
+        client = Client()
+        client.login(username='student', password='pw')
+        url = reverse('display_question', kwargs={'course_pk': self.quiz.course.pk,
+            'quiz_pk': self.quiz.pk, 'sqr_pk': sqr.pk, 'submit': 'submit'})
+
+        worker = workers.get_pool().acquire()
+        try:
+            response = client.post(url, {'problem': 'Evaluate', 'answer': '0'})
+        finally:
+            workers._pool.release(worker)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'could not be marked', response.content)
+        sqr.refresh_from_db()
+        self.assertEqual((sqr.cur_quest, sqr.score), (1, 0))
+
+
+@override_settings(SEEDED_QUESTION_RESULTS=True)
+class SeededResultTest(TestCase):
+    """ Seeded questions must still be shown once their question is deleted
+        or can no longer regenerate them.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+        self.question = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+        self.student = make_student('student', self.quiz.course)
+        self.sqr = start_attempt(self.student, self.quiz)
+        answer_current(self.sqr, lambda record: int(record.inputs) + 1)
+
+    def details(self):
+        client = Client()
+        client.login(username='student', password='pw')
+        return client.get(reverse('quiz_details', kwargs={
+            'course_pk': self.quiz.course.pk, 'quiz_pk': self.quiz.pk, 'sqr_pk': self.sqr.pk}))
+
+    def test_queryset_delete(self):
+        row = StudentQuestionResult.objects.get(attempt=self.sqr)
+        self.assertIsNone(row.inputs)
+        MarkedQuestion.objects.filter(pk=self.question.pk).delete()
+        clear_caches()
+
+        row.refresh_from_db()
+        self.assertIsNone(row.question_id)
+        self.assertEqual(attempts.loads(row.answer), int(row.inputs) + 1)
+        response = self.details()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Correct Answer</b>: <span class="mathrender">{}<'.format(
+            int(row.inputs) + 1), response.content.decode())
+
+    def test_cannot_regenerate(self):
+        # As an edit which bypassed MarkedQuestion.update
+        MarkedQuestion.objects.filter(pk=self.question.pk).update(version=F('version') + 1)
+        clear_caches()
+        response = self.details()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'no longer available', response.content)
+        self.assertIn(b'Unavailable', response.content)
+
+
+class SubmissionTest(TestCase):
+    """ A submission repeated with the same token, by a retry or a double
+        click, must be marked once and shown what the first one was.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+        self.question = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+        make_question(self.quiz, '{v[0]}+2', choices='rand(1,5)', category=2)
+        student = make_student('student', self.quiz.course)
+        self.sqr = start_attempt(student, self.quiz)
+        self.client.login(username='student', password='pw')
+
+    def submit(self, token):
+        record = self.sqr.get_state().get(1)
+        url = reverse('display_question', kwargs={'course_pk': self.quiz.course.pk,
+            'quiz_pk': self.quiz.pk, 'sqr_pk': self.sqr.pk, 'submit': 'submit'})
+        return self.client.post(url, {'problem': 'Evaluate', 'token': token,
+                                      'answer': str(int(record.inputs) + 1)})
+
+    def check_repeated(self, forget_outcome):
+        token = views.submission_token(self.sqr)
+        first = self.submit(token)
+        if forget_outcome:
+            # As when the retry reaches a process whose cache does not have it
+            cache.clear()
+        second = self.submit(token)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.context['question'], first.context['question'])
+        self.assertEqual(second.context['error_message'], '')
+        sqr = StudentQuizResult.objects.get(pk=self.sqr.pk)
+        self.assertEqual((sqr.cur_quest, sqr.score), (2, 1))
+        stats = QuestionStats.objects.get(question=self.question)
+        self.assertEqual((stats.answered, stats.correct), (1, 1))
+
+    def test_cached_outcome(self):
+        self.check_repeated(forget_outcome=False)
+
+    def test_stored_token(self):
+        self.check_repeated(forget_outcome=True)
+
+    def test_invalid_tokens(self):
+        other = start_attempt(make_student('other', self.quiz.course), self.quiz)
+        for token in ('{}:1:nonce'.format(self.sqr.pk),
+                      views.submission_token(self.sqr)[:-1] + 'x',
+                      views.submission_token(other)):
+            self.assertEqual(self.submit(token).status_code, 400, token)
+        self.assertEqual(StudentQuizResult.objects.get(pk=self.sqr.pk).cur_quest, 1)
+
+        # Nor may an attempt be answered by another student
+        self.client.login(username='other', password='pw')
+        self.assertEqual(self.submit(views.submission_token(self.sqr)).status_code, 403)
+        self.assertEqual(StudentQuizResult.objects.get(pk=self.sqr.pk).cur_quest, 1)
+
+
+class BackfillMigrationTest(TransactionTestCase):
+    """ Migration 0006 moves the legacy result column into
+        StudentQuestionResults, and back again when it is reversed.
+    """
+    BEFORE = [('quizzes', '0005_studentquestionresult')]
+    AFTER = [('quizzes', '0006_backfill_studentquestionresult')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_backfill(self):
+        apps = self.migrate(self.BEFORE)
+        Course, Quiz, MarkedQuestion, StudentQuizResult = (apps.get_model('quizzes', name)
+            for name in ('Course', 'Quiz', 'MarkedQuestion', 'StudentQuizResult'))
+        student = apps.get_model('auth', 'User').objects.create(username='student')
+        now = timezone.now()
+        quiz = Quiz.objects.create(course=Course.objects.create(name='MAT1'), name='Quiz',
+                                   live=now, expires=now)
+        direct = MarkedQuestion.objects.create(quiz=quiz, problem_str='{v[0]}+1',
+                                               answer='{v[0]}+1', choices='rand(1,5)')
+        choice = MarkedQuestion.objects.create(quiz=quiz, problem_str='{v[0]}**2', q_type='MC',
+                                               answer='{v[0]}**2', choices='rand(1,5)')
+        legacy = {
+            '1': {'pk': str(direct.pk), 'inputs': '3', 'score': '1', 'answer': 4,
+                  'guess': 4, 'guess_string': '2+2', 'type': 'D'},
+            '2': {'pk': str(choice.pk), 'inputs': '2', 'score': '0', 'answer': 2,
+                  'guess': 1, 'guess_string': '1', 'type': 'MC',
+                  'mc_choices': ['8', '2', 'None of the above']},
+            '3': {'pk': str(direct.pk), 'inputs': '5', 'score': '0', 'answer': 6,
+                  'guess': None, 'type': 'D'},
+        }
+        attempt = StudentQuizResult.objects.create(student=student, quiz=quiz, cur_quest=3,
+                                                   result=json.dumps(legacy))
+        unparseable = StudentQuizResult.objects.create(student=student, quiz=quiz, attempt=2,
+                                                       result='not json')
+
+        apps = self.migrate(self.AFTER)
+        StudentQuestionResult = apps.get_model('quizzes', 'StudentQuestionResult')
+        rows = {row.number: row for row in StudentQuestionResult.objects.filter(attempt=attempt.pk)}
+        self.assertEqual(sorted(rows), [1, 2, 3])
+        self.assertEqual((rows[1].question_id, rows[1].inputs, json.loads(rows[1].answer),
+                          json.loads(rows[1].guess), rows[1].guess_string, rows[1].score,
+                          rows[1].q_type, rows[1].mc_choices),
+                         (direct.pk, '3', 4, 4, '2+2', 1, 'D', None))
+        self.assertEqual((rows[2].q_type, rows[2].score, json.loads(rows[2].mc_choices)),
+                         ('MC', 0, ['8', '2', 'None of the above']))
+        self.assertEqual((rows[3].guess, rows[3].guess_string), (None, None))
+        self.assertFalse(StudentQuestionResult.objects.filter(attempt=unparseable.pk).exists())
+
+        # Reversing rebuilds the column from the rows alone
+        StudentQuizResult = apps.get_model('quizzes', 'StudentQuizResult')
+        StudentQuizResult.objects.filter(pk=attempt.pk).update(result='{}')
+        self.migrate(self.BEFORE)
+        self.assertEqual(json.loads(StudentQuizResult.objects.get(pk=attempt.pk).result), legacy)
+
+        # Migrating forward again skips the attempts which already have rows
+        self.migrate(self.AFTER)
+        self.assertEqual(StudentQuestionResult.objects.filter(attempt=attempt.pk).count(), 3)
+
+
+class RosterTest(TestCase):
+    """ Synchronizing a course with a roster changes only the difference,
+        never removes staff, and can be confirmed by any process.
+    """
+    def setUp(self):
+        clear_caches()
+        self.course = Course.objects.create(name='MAT1')
+        self.course.add_admin('staff')
+        staff = User.objects.get(username='staff')
+        staff.set_password('pw')
+        staff.save()
+        for username in ('a', 'b'):
+            make_student(username, self.course)
+        self.roster = ['b', ' c', 'c', '', 'd', 'b']
+
+    def students(self):
+        return set(User.objects.filter(usermembership__courses=self.course).values_list(
+            'username', flat=True))
+
+    def test_roster_diff(self):
+        diff = UserMembership.roster_diff(self.course, self.roster)
+        self.assertEqual(diff, RosterDiff(['c', 'd'], ['a'], 1, 2))
+
+    def test_dry_run(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as roster:
+            roster.write('\n'.join(self.roster))
+        self.addCleanup(os.remove, roster.name)
+        out = io.StringIO()
+        call_command('sync_roster', self.course.pk, roster.name, dry_run=True, stdout=out)
+        self.assertIn('Would synchronize MAT1: 2 added, 1 removed, 1 unchanged, 2 duplicate rows',
+                      out.getvalue())
+        self.assertEqual(self.students(), {'staff', 'a', 'b'})
+
+        call_command('sync_roster', self.course.pk, roster.name, stdout=io.StringIO())
+        self.assertEqual(self.students(), {'staff', 'b', 'c', 'd'})
+
+    def upload(self, url):
+        upload = SimpleUploadedFile('roster.csv', '\n'.join(self.roster).encode())
+        return self.client.post(url, {'course': self.course.pk, 'doc_file': upload})
+
+    def test_preview(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.client.login(username='staff', password='pw')
+        url = reverse('sync_roster')
+        with override_settings(MEDIA_ROOT=media):
+            response = self.upload(url)
+            self.assertEqual(response.context['diff'], RosterDiff(['c', 'd'], ['a'], 1, 2))
+            self.assertEqual(self.students(), {'staff', 'a', 'b'})
+            # Only the saved roster's pk is kept in the session
+            token = response.context['token']
+            pending = self.client.session['roster_sync'][token]
+            self.assertEqual(sorted(pending), ['course', 'expires', 'roster'])
+            roster = CSVFile.objects.get(pk=pending['roster'])
+            self.assertTrue(os.path.exists(roster.doc_file.path))
+
+            # As when the confirmation reaches another process
+            cache.clear()
+            response = self.client.post(url, {'token': token})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.students(), {'staff', 'b', 'c', 'd'})
+            self.assertFalse(CSVFile.objects.exists())
+            self.assertFalse(os.path.exists(roster.doc_file.path))
+            # A preview is only applied once
+            response = self.client.post(url, {'token': token})
+            self.assertEqual(response.status_code, 400)
+
+            # An expired preview is refused, and its roster deleted
+            token = self.upload(url).context['token']
+            with mock.patch.object(views.time, 'time',
+                                   return_value=time.time() + settings.ROSTER_PREVIEW_TIMEOUT + 1):
+                response = self.client.post(url, {'token': token})
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(CSVFile.objects.exists())
+            self.assertEqual(self.client.session['roster_sync'], {})
+
+
+class QuestionStatsTest(TestCase):
+    """ The running totals must count every marked answer once, and agree
+        with the rebuild_question_stats command.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+        self.first = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+        self.second = make_question(self.quiz, '{v[0]}*2', choices='rand(1,5)', category=2)
+
+    def totals(self):
+        return {stats.question_id: (stats.answered, stats.correct, stats.attempt_total)
+                for stats in QuestionStats.objects.all()}
+
+    def test_record_answer(self):
+        QuestionStats.record_answer(self.first.pk, 1, 1)
+        QuestionStats.record_answer(self.first.pk, 0, 2)
+        QuestionStats.record_answer(self.first.pk, 1, None)
+        QuestionStats.record_answer(None, 1, 1)
+        stats = QuestionStats.objects.get(question=self.first)
+        self.assertEqual((stats.answered, stats.correct, stats.attempt_total), (3, 2, 4))
+        self.assertEqual((stats.percent_correct, stats.average_tries), (66.7, 1.33))
+        self.assertFalse(QuestionStats.objects.filter(question=self.second).exists())
+
+    def test_rebuild(self):
+        right = {self.first.pk: lambda x: x + 1, self.second.pk: lambda x: x*2}
+        for username, attempts_correct in (('s1', [True, False]), ('s2', [False, True, True])):
+            student = make_student(username, self.quiz.course)
+            for correct in attempts_correct:
+                sqr = start_attempt(student, self.quiz)
+                for question in range(2):
+                    answer_current(sqr, lambda record: right[record.question_id](
+                        int(record.inputs)) if correct else 0)
+        archive.archive_attempts(StudentQuizResult.objects.filter(student__username='s1'))
+        totals = self.totals()
+        self.assertEqual(totals, {self.first.pk: (5, 3, 9), self.second.pk: (5, 3, 9)})
+
+        QuestionStats.objects.all().delete()
+        call_command('rebuild_question_stats', stdout=io.StringIO())
+        self.assertEqual(self.totals(), totals)
+
+
+@skipIf(analytics.np is None, "NumPy is not installed")
+class AnalyticsSnapshotTest(TestCase):
+    """ A snapshot must hold exactly the course's attempts and answers, with
+        the unshuffled option of each multiple choice answer.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz()
+        self.mc = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)', q_type='MC',
+                                mc_choices='{v[0]};{v[0]}+2')
+        self.numeric = make_question(self.quiz, '{v[0]}*2', choices='rand(1,5)', category=2)
+        # Choices of the multiple choice question: the answer, the first
+        # option, then the second
+        for username, picks in (('s1', [0, 1]), ('s2', [0, 2]), ('s3', [0])):
+            student = make_student(username, self.quiz.course)
+            for pick in picks:
+                sqr = start_attempt(student, self.quiz)
+                answer_current(sqr, lambda record: int(record.inputs) + (1, 0, 2)[pick])
+                answer_current(sqr, lambda record: int(record.inputs)*2 if pick == 0 else 0)
+        # s3 has an unfinished attempt
+        start_attempt(User.objects.get(username='s3'), self.quiz)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.meta = analytics.build_snapshot(self.quiz.course, self.directory)
+        self.snapshot = analytics.load_snapshot(self.directory)
+
+    def test_round_trip(self):
+        attempts_rows = list(StudentQuizResult.objects.order_by('pk').values_list(
+            'pk', 'student', 'quiz', 'attempt', 'score', 'cur_quest'))
+        self.assertEqual((self.meta['attempts'], self.meta['answers']), (6, 11))
+        self.assertEqual(self.meta['unrecovered_options'], 0)
+        self.assertEqual([tuple(row) for row in zip(*(
+            self.snapshot.attempts[name].tolist() for name, dtype in analytics.ATTEMPT_COLUMNS))],
+            [row[:5] + (row[5] == 0,) for row in attempts_rows])
+
+        answers = self.snapshot.answers
+        rows = StudentQuestionResult.objects.order_by('attempt', 'number').values_list(
+            'attempt', 'number', 'question', 'score', 'guess_string', 'inputs')
+        self.assertEqual(len(rows), len(answers['attempt']))
+        for k, (attempt, number, question, score, guess_string, inputs) in enumerate(rows):
+            self.assertEqual((answers['attempt'][k], answers['number'][k], answers['question'][k],
+                              answers['score'][k], answers['answered'][k]),
+                             (attempt, number, question, score, guess_string is not None))
+            if question == self.mc.pk and guess_string is not None:
+                value = int(inputs)
+                options = [str(value), str(value + 2), str(value + 1)]
+                self.assertEqual(answers['options'][k], 3)
+                self.assertEqual(options[answers['option'][k]], guess_string)
+            else:
+                self.assertEqual((answers['option'][k], answers['options'][k]),
+                                 (analytics.NO_VALUE, 0))
+
+    def test_archived(self):
+        # As for a past term's quiz
+        self.assertEqual(archive.archive_attempts(StudentQuizResult.objects.all()), 5)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        meta = analytics.build_snapshot(self.quiz.course, directory)
+        self.assertEqual((meta['attempts'], meta['answers'], meta['unrecovered_options']),
+                         (6, 11, 0))
+        snapshot = analytics.load_snapshot(directory)
+        for table in ('attempts', 'answers'):
+            for name, values in getattr(self.snapshot, table).items():
+                self.assertEqual(getattr(snapshot, table)[name].tolist(), values.tolist(),
+                                 (table, name))
+
+    def test_item_analysis(self):
+        difficulty = {row['question']: (row['answered'], row['difficulty'])
+                      for row in analytics.question_difficulty(self.snapshot)}
+        self.assertEqual(difficulty, {self.mc.pk: (5, 0.6), self.numeric.pk: (5, 0.6)})
+        self.assertEqual(analytics.distractor_usage(self.snapshot), [
+            {'question': self.mc.pk, 'answered': 5, 'counts': [1, 1, 3]}])
+        # Only correct answers, or only wrong ones, in every attempt
+        self.assertEqual([row['discrimination'] for row in
+                          analytics.question_discrimination(self.snapshot)], [1.0, 1.0])
+
+
+REPLICA_DATABASES = dict(settings.DATABASES, replica={
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.join(settings.BASE_DIR, 'replica.sqlite3'),
+})
+
+@override_settings(DATABASES=REPLICA_DATABASES, REPLICA_DATABASE='replica')
+class ReplicaRouterTest(TransactionTestCase):
+    """ Reads are only sent to the replica inside reads_from_replica, and
+        never once the request has written or inside a transaction. Only the
+        routing is checked: nothing is read from the replica.
+        A TransactionTestCase, since TestCase wraps every test in a
+        transaction.
+    """
+    @classmethod
+    def setUpClass(cls):
+        # The replica is never connected to
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'Overriding setting DATABASES')
+            super(ReplicaRouterTest, cls).setUpClass()
+
+    def setUp(self):
+        clear_caches()
+        routers.reset()
+        self.addCleanup(routers.reset)
+
+    def test_reads(self):
+        self.assertEqual(Quiz.objects.all().db, 'default')
+        with routers.reading_replica():
+            self.assertEqual(Quiz.objects.all().db, 'replica')
+            self.assertEqual(User.objects.all().db, 'replica')
+            # Sessions and the like are always read from 'default'
+            self.assertEqual(Session.objects.all().db, 'default')
+        self.assertEqual(Quiz.objects.all().db, 'default')
+
+        @routers.reads_from_replica
+        def view():
+            return Quiz.objects.all().db
+        self.assertEqual(view(), 'replica')
+
+    def test_write_pins(self):
+        with routers.reading_replica():
+            Course.objects.create(name='MAT1')
+            self.assertTrue(routers.is_pinned())
+            self.assertEqual(Quiz.objects.all().db, 'default')
+        with routers.reading_replica():
+            self.assertEqual(Quiz.objects.all().db, 'default')
+        routers.reset()
+        with routers.reading_replica():
+            self.assertEqual(Quiz.objects.all().db, 'replica')
+
+    def test_atomic(self):
+        with routers.reading_replica():
+            with transaction.atomic():
+                self.assertEqual(Quiz.objects.all().db, 'default')
+            self.assertEqual(Quiz.objects.all().db, 'replica')
+            self.assertFalse(routers.is_pinned())
+
+    def test_replica_iterator(self):
+        def databases():
+            for k in range(3):
+                yield Quiz.objects.all().db
+        # As a StreamingHttpResponse reads it, after its view has returned
+        self.assertEqual(list(routers.replica_iterator(databases())), ['replica']*3)
+        self.assertEqual(Quiz.objects.all().db, 'default')
+
+    def test_middleware(self):
+        user = User.objects.create_user('student', 's@example.com', 'pw')
+        request = RequestFactory().get('/')
+        request.user = user
+        middleware = ReplicaMiddleware()
+
+        middleware.process_request(request)
+        self.assertFalse(routers.is_pinned())
+        Course.objects.create(name='MAT1')
+        middleware.process_response(request, HttpResponse())
+        # The user's next request, perhaps in another process, stays pinned
+        middleware.process_request(request)
+        self.assertTrue(routers.is_pinned())
+        with routers.reading_replica():
+            self.assertEqual(Quiz.objects.all().db, 'default')
+
+
+class EnrollTest(TestCase):
+    """ Enrolling a list of students adds each of them once, whatever they
+        already had, in chunks small enough for the database.
+    """
+    def setUp(self):
+        clear_caches()
+        self.course = Course.objects.create(name='MAT1')
+        other = Course.objects.create(name='MAT2')
+        make_student('enrolled', self.course)
+        make_student('elsewhere', other)
+        User.objects.create_user('lonely')
+
+    def students(self, course=None):
+        return sorted(User.objects.filter(usermembership__courses=course or self.course)
+                      .values_list('username', flat=True))
+
+    def test_enroll(self):
+        enrollment = UserMembership.enroll(self.course, [
+            'enrolled', 'elsewhere', ' lonely', 'new', 'lonely', '', 'new ', 'other'])
+        self.assertEqual(enrollment, Enrollment(4, 2, 1, 2))
+        self.assertEqual(self.students(),
+                         ['elsewhere', 'enrolled', 'lonely', 'new', 'other'])
+        self.assertEqual(self.students(Course.objects.get(name='MAT2')), ['elsewhere'])
+        # Nobody was given a second membership
+        self.assertEqual(UserMembership.objects.count(), 5)
+
+        self.assertEqual(UserMembership.enroll(self.course, ['new', 'other']),
+                         Enrollment(0, 0, 2, 0))
+
+    def test_chunks(self):
+        # More usernames than SQLite allows parameters in a query
+        usernames = ['student{}'.format(k) for k in range(1200)] + ['enrolled', 'lonely']
+        enrollment = UserMembership.enroll(self.course, usernames)
+        self.assertEqual(enrollment, Enrollment(1201, 1200, 1, 0))
+        self.assertEqual(len(self.students()), 1202)
+
+        enrollment = UserMembership.enroll(self.course, usernames[::-1], chunk_size=7)
+        self.assertEqual(enrollment, Enrollment(0, 0, 1202, 0))
+
+    def test_retry(self):
+        resolve = UserMembership.resolve
+        calls = []
+        def concurrent(*args):
+            # Another enrollment creates 'new' once it has been looked up
+            calls.append(args)
+            found = resolve(*args)
+            if len(calls) == 1:
+                User.objects.create_user('new')
+            return found
+
+        with mock.patch.object(UserMembership, 'resolve', side_effect=concurrent):
+            enrollment = UserMembership.enroll(self.course, ['new', 'enrolled'])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(enrollment, Enrollment(1, 0, 1, 0))
+        self.assertEqual(self.students(), ['enrolled', 'new'])
+
+    def test_form(self):
+        self.course.add_admin('staff')
+        staff = User.objects.get(username='staff')
+        staff.set_password('pw')
+        staff.save()
+        courses = Course.objects.filter(pk=self.course.pk)
+        other = Course.objects.get(name='MAT2')
+
+        upload = SimpleUploadedFile('students.csv', b'a\n')
+        form = AddStudentsForm({'course': other.pk}, {'doc_file': upload}, queryset=courses)
+        self.assertFalse(form.is_valid())
+        self.assertIn('course', form.errors)
+
+        self.client.login(username='staff', password='pw')
+        upload = SimpleUploadedFile('students.csv', '\ufeffnew,Name\r\nenrolled\r\nnew\r\n'.encode())
+        response = self.client.post(reverse('add_students'),
+                                    {'course': self.course.pk, 'doc_file': upload})
+        self.assertContains(response, '1 added (1 new accounts), 1 already enrolled, '
+                                      '1 duplicate rows skipped')
+        self.assertEqual(self.students(), ['enrolled', 'new', 'staff'])
+
+
+class QuizVersionTest(TestCase):
+    """ Editing a quiz or one of its questions must replace its cached
+        snapshot and programs, even when a stale copy is saved concurrently.
+    """
+    def setUp(self):
+        clear_caches()
+        self.quiz = make_quiz(tries=1)
+        self.question = make_question(self.quiz, '{v[0]}+1', choices='rand(1,5)')
+
+    def snapshot(self):
+        return Quiz.objects.get(pk=self.quiz.pk).get_snapshot()
+
+    def test_edit_quiz(self):
+        self.assertEqual(self.snapshot().quiz[QUIZ_FIELDS.index('tries')], 1)
+        self.quiz.course.add_admin('staff')
+        staff = User.objects.get(username='staff')
+        staff.set_password('pw')
+        staff.save()
+        self.client.login(username='staff', password='pw')
+
+        response = self.client.post(reverse('edit_quiz', kwargs={
+            'course_pk': self.quiz.course.pk, 'quiz_pk': self.quiz.pk}), {
+            'course': self.quiz.course.pk, 'name': 'Quiz', 'tries': 3,
+            'live': self.quiz.live.strftime('%Y-%m-%d %H:%M:%S'),
+            'expires': self.quiz.expires.strftime('%Y-%m-%d %H:%M:%S')})
+        self.assertEqual(response.status_code, 302)
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.quiz[QUIZ_FIELDS.index('tries')], 3)
+        self.assertEqual(snapshot.quiz[QUIZ_FIELDS.index('version')],
+                         Quiz.objects.get(pk=self.quiz.pk).version)
+
+    def test_stale_save(self):
+        stale = Quiz.objects.get(pk=self.quiz.pk)
+        self.quiz.bump_version()
+        stale.tries = 5
+        stale.save()
+        stale.update_out_of()
+        self.assertEqual(Quiz.objects.get(pk=self.quiz.pk).version, self.quiz.version + 1)
+        self.assertEqual(stale.version, self.quiz.version + 1)
+
+    def test_edit_question(self):
+        self.assertEqual(self.snapshot().get_question(self.question.pk).answer, '{v[0]}+1')
+        self.assertEqual(self.question.get_program().get_answer('3'), 4)
+        first, second = (MarkedQuestion.objects.get(pk=self.question.pk) for k in range(2))
+        first.answer = '{v[0]}+2'
+        first.update(self.quiz)
+        # Edited at the same time, from the same version
+        second.answer = '{v[0]}+3'
+        second.update(self.quiz)
+
+        question = MarkedQuestion.objects.get(pk=self.question.pk)
+        self.assertEqual(question.version, self.question.version + 2)
+        self.assertEqual(second.version, question.version)
+        self.assertEqual(self.snapshot().get_question(question.pk).answer, '{v[0]}+3')
+        self.assertEqual(question.get_program().get_answer('3'), 6)
@@ -25,6 +25,10 @@ urlpatterns = [
         views.add_students, 
         name='add_students'
     ),
+    url(r'^administrative/sync_roster/$',
+        views.sync_roster,
+        name='sync_roster'
+    ),
     url(r'^course_search/$', 
         views.course_search, 
         name='course_search'
@@ -53,6 +57,10 @@ urlpatterns = [
        views.list_quizzes,
        name='list_quizzes'
     ),
+    url(r'^course/(?P<course_pk>\d+)/gradebook/$',
+       views.gradebook,
+       name='gradebook'
+    ),
     url(r'^course/(?P<course_pk>\d+)/start/(?P<quiz_pk>\d+)/$',
        views.start_quiz,
        name='start_quiz'
@@ -69,6 +77,10 @@ urlpatterns = [
        views.quiz_admin,
        name='quiz_admin'
     ),
+    url(r'^course/(?P<course_pk>\d+)/quiz/(?P<quiz_pk>\d+)/stats/$',
+       views.quiz_stats,
+       name='quiz_stats'
+    ),
     url(r'^course/(?P<course_pk>\d+)/quiz/(?P<quiz_pk>\d+)/edit_question/$',
        views.edit_quiz_question,
        name='edit_quiz_question'
@@ -85,6 +97,10 @@ urlpatterns = [
        views.test_quiz_question,
        name='test_quiz_question'
     ),
+    url(r'^course/(?P<course_pk>\d+)/quiz/(?P<quiz_pk>\d+)/edit_question/(?P<mq_pk>\d+)/regrade/$',
+       views.regrade_question,
+       name='regrade_question'
+    ),
     url(r'^course/(?P<course_pk>\d+)/quiz/(?P<quiz_pk>\d+)/details/(?P<sqr_pk>\d+)/$',
        views.quiz_details,
        name='quiz_details'
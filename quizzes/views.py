@@ -3,21 +3,48 @@ from django.utils import timezone
 from django.utils.html import mark_safe, format_html
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
-from django.http import HttpResponse, Http404, HttpResponseForbidden
+from django.http import HttpResponse, Http404, HttpResponseForbidden, HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.core.cache import cache
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.utils.crypto import get_random_string
+from django.utils.text import slugify
 from django.db import transaction, IntegrityError
 from django.db.models import Max, Q, F
 
 from .models import *
 from .forms import *
 from .tables import *
+from .programs import eval_sub_expression, evaluate
+from . import workers
+from . import attempts
+from . import regrade
+from . import archive
+from .routers import reads_from_replica, replica_iterator
+from .samplers import compile_choice, draw_choice, ChoiceError
+from .costs import check_question
 from guardian.shortcuts import get_objects_for_user
-from simpleeval import simple_eval, NameNotDefined
+from simpleeval import NameNotDefined
+from collections import OrderedDict
+from itertools import groupby
+import heapq
 import random
 import json
 import csv
+import codecs
 import re
+import time
+
+# Signs submission tokens. See submission_token
+SUBMISSION_SIGNER = signing.Signer(salt='quizzes.submission')
+
+# Most changes listed on the regrade page
+REGRADE_SHOWN = 200
+# Usernames listed of each side of a roster preview
+ROSTER_SHOWN = 200
 
 def staff_required(login_url=settings.LOGIN_URL):
     return user_passes_test(lambda u:u.is_staff, login_url=login_url)
@@ -55,6 +82,9 @@ def delete_item(request, objectStr, pk):
 
         if request.method == "POST":
             theObj.delete()
+            # Removing a question may change the number of pools
+            if objectStr == "markedquestion":
+                theObj.quiz.update_out_of()
             return return_view
         else:
             return render(request, 'quizzes/delete_item.html', 
@@ -152,8 +182,8 @@ def edit_quiz(request, course_pk, quiz_pk):
             quiz.update_out_of()
             # Since we might have changed the quiz's score, we also need to fix the
             # exemption score
-            exemption, created = ExemptionType.objects.get_or_create(name=quiz.name)
-            exemption.quiz_update_out_of(quiz)
+            # exemption, created = ExemptionType.objects.get_or_create(name=quiz.name)
+            # exemption.quiz_update_out_of(quiz)
             return redirect('quiz_admin', course_pk=course_pk, quiz_pk=quiz.pk)
     else:
         form = QuizForm(instance=quiz)
@@ -167,6 +197,7 @@ def edit_quiz(request, course_pk, quiz_pk):
         )
 
 @login_required
+@reads_from_replica
 def list_quizzes(request, course_pk, message=''):
     """ Show the list of all quizzes, including the live ones. Includes an adminstrative
     portion for staff. Can be redirected to when max-attempts on a live quiz is reached
@@ -183,7 +214,13 @@ def list_quizzes(request, course_pk, message=''):
     else:
         all_quizzes_table = ''
 
-    live_quiz   = all_quizzes.filter(live__lte=timezone.now(), expires__gt=timezone.now())
+    live_quiz   = list(all_quizzes.filter(live__lte=timezone.now(), expires__gt=timezone.now()))
+
+    # The student's progress on each live quiz
+    states = StudentQuizState.objects.filter(student=request.user, quiz__in=live_quiz)
+    states = {state.quiz_id: state for state in states}
+    for quiz in live_quiz:
+        quiz.student_state = states.get(quiz.pk)
 
     # Get this specific user's previous quiz results
     student_quizzes = SQRTable(
@@ -201,6 +238,108 @@ def list_quizzes(request, course_pk, message=''):
              'course': course,
             });
 
+class Echo(object):
+    """ A file-like object whose write returns what was written, so that
+        csv.writer can produce one line at a time for a streaming response
+    """
+    def write(self, value):
+        return value
+
+def best_scores(quiz):
+    """ Generates (student pk, best score) over the finished attempts at quiz,
+        archived or not, in student order, with one grouped aggregate over
+        each table
+    """
+    cursors = [
+        model.objects.filter(quiz=quiz, cur_quest=0).order_by('student').values_list(
+            'student').annotate(best=Max('score')).iterator()
+        for model in (StudentQuizResult, ArchivedQuizResult)]
+    for student, group in groupby(heapq.merge(*cursors), key=lambda row: row[0]):
+        yield student, max((row[1] for row in group if row[1] is not None), default=None)
+
+def gradebook_rows(course, quizzes):
+    """ Generates the rows of a course's gradebook: each enrolled student,
+        with their best score on each quiz over completed attempts, archived
+        or not. The students, and the best scores at each quiz (see
+        best_scores), are read with iterator() in student order and merged as
+        they go, so memory does not grow with the number of students.
+        <<INPUT>>
+        course (Course)
+        quizzes (list) of the course's Quizzes, in column order
+        <<OUTPUT>>
+        generator of lists, starting with the header
+    """
+    yield (['Username', 'First Name', 'Last Name', 'Email']
+           + ['{} (/{})'.format(quiz.name, quiz.out_of) for quiz in quizzes])
+
+    students = User.objects.filter(usermembership__courses=course).distinct().order_by(
+        'pk').values_list('pk', 'username', 'first_name', 'last_name', 'email')
+    cursors = [best_scores(quiz) for quiz in quizzes]
+    heads = [next(cursor, None) for cursor in cursors]
+
+    for student in students.iterator():
+        row = list(student[1:])
+        for k, cursor in enumerate(cursors):
+            # Skip the scores of students who are no longer enrolled
+            while heads[k] is not None and heads[k][0] < student[0]:
+                heads[k] = next(cursor, None)
+            if heads[k] is not None and heads[k][0] == student[0]:
+                row.append(heads[k][1])
+            else:
+                row.append('')
+        yield row
+
+def gradebook_attempt_rows(course):
+    """ Generates a row for every attempt at a course's quizzes, archived or
+        not, starting with the header. See gradebook_rows.
+    """
+    yield ['Username', 'First Name', 'Last Name', 'Quiz', 'Attempt', 'Score',
+           'Out Of', 'Completed']
+
+    results = [
+        model.objects.filter(quiz__course=course).order_by(
+            'student', 'quiz', 'attempt').values_list(
+            'student', 'quiz', 'student__username', 'student__first_name',
+            'student__last_name', 'quiz__name', 'attempt', 'score', 'quiz__out_of',
+            'cur_quest').iterator()
+        for model in (StudentQuizResult, ArchivedQuizResult)]
+    rows = heapq.merge(*results, key=lambda row: (row[0], row[1], row[6] or 0))
+    for _, _, username, first, last, quiz, attempt, score, out_of, cur_quest in rows:
+        yield [username, first, last, quiz, attempt, score, out_of,
+               'Yes' if cur_quest == 0 else 'No']
+
+@staff_required()
+@reads_from_replica
+def gradebook(request, course_pk):
+    """ Streams the course's gradebook as a CSV file: a row for every
+        enrolled student and a column for every quiz, holding their best
+        score. With ?attempts=1, a row for every attempt instead.
+        <<Input>>
+        course_pk (Integer) Primary key for the course
+        <<Output>>
+        StreamingHttpResponse of the CSV file
+
+        Depends on: gradebook_rows, gradebook_attempt_rows
+    """
+    course = get_object_or_404(Course, pk=course_pk)
+    if not request.user.has_perm('quizzes.can_edit_quiz', course):
+        return HttpResponseForbidden('You are not authorized to see this gradebook')
+
+    if request.GET.get('attempts'):
+        rows = gradebook_attempt_rows(course)
+        name = '{}-attempts.csv'.format(slugify(course.name))
+    else:
+        quizzes = list(Quiz.objects.filter(course=course).order_by('live', 'pk'))
+        rows = gradebook_rows(course, quizzes)
+        name = '{}-gradebook.csv'.format(slugify(course.name))
+
+    # The rows are read as the response is sent, after the view returns
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in replica_iterator(rows)),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(name)
+    return response
+
 @staff_required()
 def quiz_admin(request, course_pk, quiz_pk):
     """ Generates the quiz administration page.
@@ -221,6 +360,51 @@ def quiz_admin(request, course_pk, quiz_pk):
         }
     )
 
+@staff_required()
+@reads_from_replica
+def quiz_stats(request, course_pk, quiz_pk):
+    """ Shows how students have answered each question of a quiz, and each
+        category, from the QuestionStats. The time taken does not depend on
+        how many students have written the quiz.
+        <<Input>>
+        course_pk, quiz_pk (Integers) The primary keys for the course and quiz
+        respectively.
+    """
+    quiz      = get_object_or_404(Quiz.objects.select_related('course'), pk=quiz_pk)
+    questions = quiz.markedquestion_set.order_by('category', 'pk')
+    stats     = dict((record.pk, record) for record in
+                     QuestionStats.objects.filter(question__quiz=quiz))
+
+    question_data = []
+    categories = OrderedDict()
+    for question in questions:
+        record = stats.get(question.pk) or QuestionStats(question=question)
+        question_data.append({
+            'category': question.category,
+            'question': question.problem_str,
+            'answered': record.answered,
+            'percent_correct': record.percent_correct,
+            'average_tries': record.average_tries,
+        })
+        totals = categories.setdefault(question.category, [0, 0, 0])
+        totals[0] += record.answered
+        totals[1] += record.correct
+        totals[2] += record.attempt_total
+
+    category_data = [
+        {'category': category,
+         'answered': answered,
+         'percent_correct': QuestionStats.percentage(correct, answered),
+         'average_tries': QuestionStats.average(attempt_total, answered),
+        } for category, (answered, correct, attempt_total) in categories.items()]
+
+    return render(request, 'quizzes/quiz_stats.html',
+        { 'quiz': quiz,
+          'question_stats': QuestionStatsTable(question_data),
+          'category_stats': QuestionStatsTable(category_data, exclude=['question']),
+        }
+    )
+
 @staff_required()
 def edit_quiz_question(request, course_pk, quiz_pk, mq_pk=None):
     """ View designed to add/edit a question. If mq_pk is None then we make the
@@ -298,49 +482,20 @@ def deserialize(s_str):
     return choices
 
 def choice_is_valid(string, num_vars):
-    """ Determine whether input string is a valid choice; that is, either an integer or
-        a correctly formatted randomization string.
+    """ Determine whether input string is a valid choice; that is, each part is
+        either a number or a correctly formatted randomization string with a
+        valid range. The choice is compiled, but not sampled.
         Input: string (String) - to be validated
                num_vars - (Integer) - necessary number of variables
         Output: Boolean - indicating whether the string is valid
                 err_msg - error message
     """
-    parts = string.replace(' ', '').split(';')
-    return_value = True
-    error_message = "Choice is valid"
-
-    if len(parts) != num_vars:
-        return False, "Incorrect number of variables. Given {}, expected {}".format(len(parts), num_vars)
-
-    # We run the function parse_abstract_choice. If it works then the input is valid, otherwise it's not
     try:
-        parse_abstract_choice(string)
-    except:
-        error_message = "Invalid input. Please insert the current number of variables, with appropriate range."
-        return_value = False
-
-#    for part in parts:
-#        match = re.match(r'[zZ](-?\d+),(-?\d+)',part)
-#        if isnumber(part):
-#            return_value*= True
-#        elif match:
-#            if int(match.group(1))<int(match.group(2)):
-#                return_value*= True
-#            else:
-#                return_value*= False
-#                error_message = "Integer range out of order."
-#        else:
-#            error_message = "Invalid input. Please insert the current number of variables, with appropriate range."
-#            return_value*= False
-    return return_value, error_message
-
-
-def isnumber(string):
-    try:
-        float(string)
-        return True
-    except:
-        return False
+        compile_choice(string, num_vars)
+    except ChoiceError as e:
+        return False, str(e)
+
+    return True, "Choice is valid"
 
 def edit_choices(request, course_pk, quiz_pk, mq_pk):
     """ After adding/editing a MarkedQuestion object, we need to specify the
@@ -383,8 +538,13 @@ def edit_choices(request, course_pk, quiz_pk, mq_pk):
                     else:
                         raise Exception(msg)
 
-            mquestion.choices = updated_choices
-            mquestion.save()
+            # The new ranges must not make any expression too expensive
+            previous_choices, mquestion.choices = mquestion.choices, updated_choices
+            messages = check_question(mquestion)
+            if messages:
+                mquestion.choices = previous_choices
+                raise Exception(" ".join(messages))
+            mquestion.update(mquestion.quiz)
         except Exception as e:
             error_message = e
             print(e)
@@ -414,68 +574,54 @@ def start_quiz(request, course_pk, quiz_pk):
         HttpResponse object. Renders quizzes/start_quiz.html or redirects 
                                      to display_question
 
-        Depends on: generate_next_question
+        Depends on: StudentQuizState, generate_first_questions
     """
 
     this_quiz = get_object_or_404(
-            Quiz, 
+            Quiz.objects.select_related('course'), 
             pk=quiz_pk, 
             live__lte=timezone.now(), 
             expires__gt=timezone.now())
     
-    # Get the StudentQuizResults corresponding to this student. If there are
-    # none, this is the first try. If there are some, we need to find the most
-    # current one (ie the one with the largest `attempt' attribute. Then we need
-    # to check if that StudentQuizResult is still in progress, or if a new
-    # attempt needs to be created. In the latter, we also need to check that the
-    # student has not surpassed the number of attempts permitted
+    # The student's StudentQuizState records their most recent attempt, and
+    # whether it is still in progress. If it is, the student resumes it.
+    # Otherwise a new attempt is created, as long as the student has not
+    # used up the number of attempts permitted.
     student = request.user
-    quiz_results = StudentQuizResult.objects.filter(
-            student=student, quiz=this_quiz).select_related(
-                'quiz', 'quiz__course')
-    high_score = -1
-   
-    # The user may be allowed several attempts. We need to determine what attempt the 
-    # user is on, and whether they are in the middle of a quiz
-    is_new = False;
-    if len(quiz_results) == 0: # First attempt
-        # Should be made into an SQR manager method
-        cur_quiz_res = StudentQuizResult(
-                student=student, 
-                quiz=this_quiz, 
-                attempt=1, 
-                score=0, 
-                result='{}',
-                cur_quest = 1
-                )
-        cur_quiz_res.save()
-        generate_next_question(cur_quiz_res)
-        is_new = True
-    else: 
-        # Determine the most recent attempt by finding the max 'attempt'
-        quiz_aggregate = quiz_results.aggregate(Max('attempt'), Max('score'))
-        most_recent_attempt = quiz_aggregate['attempt__max']
-        high_score = quiz_aggregate['score__max']
-        cur_quiz_res = quiz_results.get(attempt=most_recent_attempt)
-        # Now we need to check if this attempt was finished. Recall that if cur_quest = 0
-        # then all questions are finished. If all questions are finished, we must also check
-        # if the student is allowed any more attempts
-        if (cur_quiz_res.cur_quest == 0): # Current attempt is over.
-            if (most_recent_attempt < this_quiz.tries or this_quiz.tries == 0): # Allowed more tries
-                # Should be made into an SQR manager method
-                cur_quiz_res = StudentQuizResult(
-                    student=student, 
-                    quiz=this_quiz, 
-                    attempt=most_recent_attempt+1,
-                    score=0,
-                    result='{}',
-                    cur_quest=1)
-                cur_quiz_res.save()
-                generate_next_question(cur_quiz_res) #Should make this a model method
-                is_new = True
-            else: # No more tries allowed
-                message = "Maximum number of attempts reached for {quiz_name}.".format(quiz_name=this_quiz.name)
-                return list_quizzes(request, course_pk=course_pk, message=message) # Returns a view
+    state = StudentQuizState.get_for(student, this_quiz)
+    state.quiz = this_quiz
+
+    for retry in range(2):
+        if state.in_progress or not state.has_tries_left():
+            break
+        # The first questions are generated before the transaction, so that
+        # it only holds the database for the inserts. The attempt and its
+        # questions are then created together.
+        new_attempt = state.prepare_attempt()
+        generate_first_questions(new_attempt, commit=False)
+        with transaction.atomic():
+            if state.new_attempt(new_attempt) is not None:
+                new_attempt.get_state().save()
+            else:
+                new_attempt = None
+        if new_attempt is not None:
+            break
+
+        # Another request created the attempt first, in which case it is
+        # resumed. Otherwise the state had fallen behind the results.
+        previous = state.attempts
+        state = StudentQuizState.get_for(student, this_quiz)
+        if not state.in_progress and state.attempts == previous:
+            state = StudentQuizState.rebuild(student, this_quiz)
+        state.quiz = this_quiz
+
+    if not state.in_progress: # No more tries allowed
+        message = "Maximum number of attempts reached for {quiz_name}.".format(quiz_name=this_quiz.name)
+        return list_quizzes(request, course_pk=course_pk, message=message) # Returns a view
+
+    cur_quiz_res = state.latest
+    cur_quiz_res.quiz = this_quiz
+    high_score = state.high_score
 
     # Need to genererate the first question
     return render(request, 'quizzes/start_quiz.html', 
@@ -484,39 +630,6 @@ def start_quiz(request, course_pk, quiz_pk):
              'high_score': high_score,
              })
 
-def eval_sub_expression(string):
-    """ Used to evaluate @-sign delimited subexpressions in sentences which do
-        not totally render. Variables should be passed into the string first,
-        before passing to this function.  For example, if a string is if the
-        form: "What is half of \(@2*{v[0]}@\)" then we should have already
-        substituted {v[0]} into the string, so that eval_sub_expression
-        receives, for example, "What is half of \(@2*3@\)?"
-    
-        <<INPUT>>
-        string (String) containing (possibly zero) @-delimited expressions.
-        <<OUTPUT>>
-        That string, but with the @ signs removed and the internal expression
-        evaluated.
-    """
-
-    # If no subexpression can be found, simply return
-    if not "@" in string:
-        return string
-
-    temp_string = string
-    pattern = re.compile(r'@(.+?)@')
-    try:
-        while "@" in temp_string:
-            match = pattern.search(temp_string)
-            # Evaluate the expression and substitute it back into the string
-            replacement = round(simple_eval(match.group(1)),4)
-            temp_string = temp_string[:match.start()] + str(replacement) + temp_string[match.end():]
-
-    except Exception as e: # Should expand the error handling here. What can go wrong?
-        raise e
-
-    return temp_string
-
 def sub_into_question_string(question, choices):
     """ Given a MarkedQuestion object and a particular choice set for the
         variables {v[0]}=5, {v[1]}=-10, etc, substitute tese into the problem
@@ -530,91 +643,87 @@ def sub_into_question_string(question, choices):
         <<OUTPUT>> 
         A string rendered correctly.
 
-        Depends on: eval_sub_expression 
+        Depends on: QuestionProgram.render_problem
     """
-    problem = question.problem_str # Grab the question string
-    # Remove any troublesome white space, and split the choices (delimited by a
-    # semi-colon). Then substitute them into the sring.
-    problem = problem.format(v=choices.replace(' ', '').split(';'))
-
-    # Pass the string through the sub-expression generator
-    problem = eval_sub_expression(problem)
-    return problem
-
-def mark_question(sqr, string_answer, accuracy=10e-5):
-    """ Helper question to check if the answers are the same. Updates SQR
-        internally and returns a boolean flag indicating whether this is the
-        last question.
+    return question.get_program().render_problem(choices)
+
+def mark_question(sqr, string_answer, accuracy=10e-5, commit=True, token=None):
+    """ Helper question to check if the answers are the same. Marks the
+        current question of the SQR's AttemptState and updates the SQR, and
+        returns a boolean flag indicating whether this is the last question.
         <<INPUT>>
         sqr (StudentQuizResult) - the quiz record
         string_answer (string) - the correct answer
         accuracy (float) - The desired accuracy. Default is 10e-5;
             that is, four decimal places.
+        commit (Boolean) - whether to save sqr and its state, and record the
+            answer in the QuestionStats. See submit_answer
+        token (String) - the submission token of the answer, recorded with
+            the question
         <<OUTPUT>>
         is_last (Boolean) - indicates if the last question has been marked
     """
-    # Result is a python dict, qnum is the attempt of the quiz
-    result, qnum = sqr.get_result() 
-
     # Already the last question, so don't check anything and return true
-    if qnum == '0':
+    if sqr.cur_quest == 0:
         return True
 
-    correct = result[qnum]['answer']
+    # Only the current question is needed
+    state   = sqr.get_state()
+    record  = state.get()
+    correct = record.answer
 
     # For multiple choice questions, we do not want to evaluate, just compare strings
-    if result[qnum]['type'] == "MC":
-        if str(correct) == string_answer:
-            result[qnum]['score']='1'
-            sqr.update_score()
-        else:
-            result[qnum]['score']='0'
+    if record.q_type == "MC":
+        score = attempts.score_guess(record.q_type, correct, string_answer)
+        if score:
+            sqr.update_score(commit)
 
-        result[qnum]['guess']        = string_answer 
-        result[qnum]['guess_string'] = string_answer 
+        record.mark(string_answer, string_answer, score, token)
 
     else:
         correct = float(correct) # Recast to float for numeric comparison
         
         try:
+            # Student input is evaluated within the same budget as answers
             guess = round(
-                simple_eval(
+                evaluate(
                     string_answer, 
                     names=settings.UNIVERSAL_CONSTANTS, 
                     functions=settings.PREDEFINED_FUNCTIONS
                 ),
             4) #numeric input, rounds to 4 decimal places
-            result[qnum]['guess'] = guess
-            result[qnum]['guess_string'] = string_answer
         except Exception as e:
             raise ValueError('Input could not be mathematically parsed.')
 
-        if (abs(correct-guess)<accuracy): # Correct answer
-            result[qnum]['score']='1'
-            sqr.update_score()
-        else:
-            result[qnum]['score']='0'
+        score = attempts.score_guess(record.q_type, correct, guess, accuracy)
+        if score: # Correct answer
+            sqr.update_score(commit)
+
+        record.mark(guess, string_answer, score, token)
 
-    sqr.update_result(result)
-    is_last = sqr.add_question_number()
+    if commit:
+        state.save()
+        QuestionStats.record_answer(record.question_id, score, sqr.attempt)
+    is_last = sqr.add_question_number(commit)
     return is_last
 
-def generate_next_question(sqr):
+def generate_next_question(sqr, commit=True):
     """ Given a StudentQuizResult, creates a new question. Most often this
         function will be called after a question has been marked and a new one
         needs to be created. However, it is also used to instantiate the first
-        question of a quiz.  
+        question of a quiz. The question is added to the SQR's AttemptState.
         <<INPUT>>
         sqr (StudentQuizResult) contains all the appropriate information for
             generating a new question 
+        commit (Boolean) whether to save the state. See submit_answer
         <<OUTPUT>>
         q_string (String)  The generated question, formated in a math renderable
             way 
         mc_choices (String) The multiple choice options
 
-        Depends on: get_mc_choices, sub_into_question_string
+        Depends on: MarkedQuestion.pop_variant, get_mc_choices,
+            sub_into_question_string, workers.generate
     """
-    result, qnum = sqr.get_result()
     # The following is defined so it can be returned, but is only ever used if
     # question type is MC
     mc_choices = ''
@@ -626,34 +735,220 @@ def generate_next_question(sqr):
     # choices are also random
     question = sqr.quiz.get_random_question(sqr.cur_quest)
 
-    # From this question, we now choose a random input choice
-    a_choice = question.get_random_choice()
-
-    # This choice could either be a tuple of numbers, a randomizer, or a mix. We
-    # need to parse these into actual numbers
-    choices = parse_abstract_choice(a_choice)
-    answer = get_answer(question, choices)
-
-    #Feed this into the result dictionary, and pass it back to the model
-    result[qnum] = {
-            'pk': str(question.pk),
-            'inputs': choices,
-            'score': '0',
-            'answer': answer,
-            'guess': None,
-            'type': question.q_type
-            }
-    
-    # If the question we grabbed is multiple choice, then we must also generate
-    # the multiple choice options.
-    if question.q_type == "MC":
-        mc_choices = get_mc_choices(question, choices, answer)
-        result[qnum].update({'mc_choices': mc_choices})
+    # In seeded mode only a seed is stored, and everything random, including
+    # the order of the multiple choice options, is drawn from it so that the
+    # question can be regenerated later
+    seed = None
+    variant = None
+    if (getattr(settings, 'SEEDED_QUESTION_RESULTS', False)
+            and question.get_program().is_reproducible):
+        seed = sqr.get_state().new_seed()
+        choices, answer, seeded_choices = workers.generate(question, seed)
+        mc_choices = seeded_choices or mc_choices
+    else:
+        # Use a pre-generated variant of the question if there is one.
+        # Otherwise, from this question we now choose a random input choice.
+        # This choice could either be a tuple of numbers, a randomizer, or a
+        # mix, so the compiled samplers draw actual numbers from it.
+        variant = question.pop_variant()
+        if variant is not None:
+            choices = variant.inputs
+            answer  = variant.get_answer()
+        else:
+            choices = question.get_program().sample_inputs()
+            answer  = get_answer(question, choices)
+
+        # If the question we grabbed is multiple choice, then we must also generate
+        # the multiple choice options.
+        if question.q_type == "MC":
+            if variant is not None:
+                mc_choices = variant.get_mc_choices()
+            else:
+                mc_choices = get_mc_choices(question, choices, answer)
     
-    sqr.update_result(result)
-
+    state = sqr.get_state()
+    state.add(question, choices, answer,
+        mc_choices if question.q_type == "MC" else None, seed=seed)
+    if commit:
+        state.save()
+
+    if variant is not None:
+        return variant.problem, mc_choices
     return sub_into_question_string(question,choices), mc_choices
 
+def generate_all_questions(sqr, commit=True):
+    """ Generates every question of a new attempt at once, for quizzes with
+        generate_upfront. Each question is generated from its own seed, so the
+        whole attempt is evaluated in one round on the worker pool and written
+        with a single insert. The seeds are only stored in seeded mode.
+        <<INPUT>>
+        sqr (StudentQuizResult) the new attempt
+        commit (Boolean) whether to save the state. See start_quiz
+
+        Depends on: workers.generate_many
+    """
+    quiz = sqr.quiz
+    state = sqr.get_state()
+    calls = [(quiz.get_random_question(number), state.new_seed())
+             for number in range(1, quiz.out_of + 1)]
+    seeded = getattr(settings, 'SEEDED_QUESTION_RESULTS', False)
+
+    for number, (call, generated) in enumerate(zip(calls, workers.generate_many(calls)), 1):
+        question, seed = call
+        choices, answer, mc_choices = generated
+        if not (seeded and question.get_program().is_reproducible):
+            seed = None
+        state.add(question, choices, answer, mc_choices, seed=seed, number=number)
+    if commit:
+        state.save()
+
+def generate_first_questions(sqr, commit=True):
+    """ Generates the first question of a new attempt, or all of them if the
+        quiz generates them upfront. Without commit, nothing is written, and
+        sqr need not have been saved yet.
+    """
+    if sqr.quiz.generate_upfront:
+        generate_all_questions(sqr, commit)
+    else:
+        generate_next_question(sqr, commit)
+
+def render_question_record(sqr, record):
+    """ Renders a question which has already been generated.
+        <<INPUT>>
+        sqr (StudentQuizResult) the attempt, with its quiz loaded
+        record (attempts.QuestionState) the question
+        <<OUTPUT>>
+        q_string, mc_choices as generate_next_question returns them
+    """
+    question = sqr.quiz.get_question(record.question_id)
+    q_string = sub_into_question_string(question, record.inputs)
+    mc_choices = record.mc_choices if record.q_type == "MC" else ''
+    return q_string, mc_choices
+
+def submission_token(sqr):
+    """ Returns a new submission token for the current question of sqr. Every
+        rendered question carries one, so that submit_answer can recognise a
+        repeated submission. The nonce makes each rendering's token distinct,
+        and the signature keeps tokens from being forged, or moved to another
+        attempt or question.
+        <<OUTPUT>>
+        (String) of the form '<sqr pk>:<question number>:<nonce>:<signature>'
+    """
+    return SUBMISSION_SIGNER.sign('{}:{}:{}'.format(sqr.pk, sqr.cur_quest, get_random_string(12)))
+
+def parse_submission_token(token):
+    """ Returns the (sqr pk, question number) of a submission token. Raises
+        ValueError if it is malformed or was not signed by submission_token.
+    """
+    try:
+        value = SUBMISSION_SIGNER.unsign(token)
+    except signing.BadSignature:
+        raise ValueError("Invalid submission token signature")
+    pk, number, nonce = value.split(':')
+    return int(pk), int(number)
+
+def submission_key(token):
+    return 'submission:{}'.format(token)
+
+def repeated_submission(sqr, number, token):
+    """ The outcome of a submission for question number, which has already
+        been answered: the current question, or the end of the quiz. Nothing
+        is marked.
+        <<OUTPUT>>
+        is_last, q_string, mc_choices, notice as submit_answer returns them.
+            The notice is empty if the question was answered by this very
+            token, so that a retried request looks like the original.
+    """
+    if sqr.cur_quest == 0:
+        is_last, q_string, mc_choices = True, None, None
+    else:
+        is_last = False
+        q_string, mc_choices = render_question_record(sqr, sqr.get_state().get())
+
+    if token is not None and sqr.questions.filter(number=number, token=token).exists():
+        notice = ''
+    else:
+        notice = "Question {} had already been answered.".format(number)
+    return is_last, q_string, mc_choices, notice
+
+def submit_answer(sqr, string_answer, token=None):
+    """ Marks the student's answer and, unless the quiz is over, generates
+        the next question. Submissions are idempotent: an answer is only
+        marked if its question is still the current one, and the token is
+        stored with it, so that a retry is shown what the original was. The
+        outcome is also cached under the token, in the shared cache, so a
+        retried request is usually answered without reading the attempt.
+
+        Marking and generating happen before the transaction. The transaction
+        then moves the attempt on with a single conditional UPDATE, adding to
+        the score with F(), and only the request which made that UPDATE saves
+        the AttemptState, updating the marked question and inserting the next
+        one, and adds the answer to the QuestionStats. If the next question
+        was generated upfront, it is only read.
+        <<INPUT>>
+        sqr (StudentQuizResult) - the quiz record, with its quiz loaded
+        string_answer (String) - the student's answer
+        token (String) - the submission token rendered with the question, or
+            None. See submission_token
+        <<OUTPUT>>
+        is_last (Boolean) - indicates if the last question has been marked
+        q_string, mc_choices - the next question, as returned by
+            generate_next_question, or None if is_last
+        notice (String) - a message for the student if the question had
+            already been answered by another submission, otherwise empty
+
+        Depends on: mark_question, generate_next_question,
+            render_question_record, repeated_submission,
+            StudentQuizState.attempt_finished, QuestionStats.record_answer
+    """
+    if token is not None:
+        number = parse_submission_token(token)[1]
+        outcome = cache.get(submission_key(token))
+        if outcome is not None:
+            return tuple(outcome) + ('',)
+    else:
+        number = sqr.cur_quest
+    if number != sqr.cur_quest or sqr.cur_quest == 0:
+        return repeated_submission(sqr, number, token)
+
+    # Read the question being answered, and the next one if it was generated
+    # upfront, together
+    state = sqr.get_state()
+    state.load([number, number + 1])
+    score = sqr.score
+    is_last = mark_question(sqr, string_answer, commit=False, token=token)
+
+    q_string, mc_choices = None, None
+    if not is_last:
+        record = state.peek(sqr.cur_quest)
+        if record is not None:
+            q_string, mc_choices = render_question_record(sqr, record)
+        else:
+            q_string, mc_choices = generate_next_question(sqr, commit=False)
+
+    with transaction.atomic():
+        # Only one submission can move the attempt on from this question
+        claimed = StudentQuizResult.objects.filter(pk=sqr.pk, cur_quest=number).update(
+            cur_quest=sqr.cur_quest, score=F('score') + (sqr.score - score))
+        if claimed:
+            state.save()
+            if is_last:
+                StudentQuizState.attempt_finished(sqr)
+            # Last, as every answer to the question updates this row
+            marked = state.peek(number)
+            QuestionStats.record_answer(marked.question_id, marked.score, sqr.attempt)
+
+    if not claimed:
+        # Another submission answered the question first, so forget ours
+        sqr.refresh_from_db(fields=['score', 'cur_quest'])
+        sqr._attempt_state = None
+        return repeated_submission(sqr, number, token)
+
+    if token is not None:
+        cache.set(submission_key(token), (is_last, q_string, mc_choices),
+                  getattr(settings, 'SUBMISSION_OUTCOME_TIMEOUT', 600))
+    return is_last, q_string, mc_choices, ''
+
 def get_mc_choices(question, choices, answer):
     """ Given a question and a choice for the variable inputs, get the multiple
         choice options.
@@ -668,33 +963,13 @@ def get_mc_choices(question, choices, answer):
         ToDo: Allow for @-sign based delimeter expressions. May want to do this
         based on the exception raised on simple_eval
     """
-    split_choices = choices.split(';')
-    mc_choices = []
-
-    for part in question.mc_choices.split(';'):
-        """ Internal flow: See if variables are present. If so, substitute the
-            variables. If not, it's hard coded.  If we do not find variables but
-            cannot evaluate, the answer is a sentence/word. So just append it.
-        """
-        if re.findall(r'{v\[\d+\]}', part): # matches no variables
-            part = part.format(v=split_choices)
-            part = eval_sub_expression(part)
-
-        try:
-            # Remove troublesome whitespace as well
-            eval_string = part.replace(' ','')
-            value = round(
-                simple_eval(
-                    eval_string, 
-                    functions=settings.PREDEFINED_FUNCTIONS,
-                    names=settings.UNIVERSAL_CONSTANTS
-                ),
-            4)
-                
-            mc_choices.append(str(value))
-        except: #If not an exectuable string, then it must be a hardcoded answer
-            mc_choices.append(part)
+    mc_choices = workers.get_mc_options(question, choices)
+    return shuffle_mc_choices(mc_choices, answer)
 
+def shuffle_mc_choices(mc_choices, answer):
+    """ Adds the answer to a list of multiple choice options and shuffles
+        them in place.
+    """
     mc_choices.append(str(answer))
 
     # Now shuffle them.
@@ -704,38 +979,14 @@ def get_mc_choices(question, choices, answer):
 
 def parse_abstract_choice(abstract_choice):
     """ Parses an abstract choice into a concrete choice. Expects a single
-        choice input. Currently can only handle integer ranges.
+        choice input.
         <<INPUT>>
         abstract_choice (String) - Used to indicate an abstract choice,
             separated by ';'
         <<OUTPUT>>
         (String) A concrete choice 
     """
-    choice = ''
-    for part in abstract_choice.replace(' ', '').split(';'):
-        if isnumber(part): # If already a number
-            choice += part + ";"
-        else: # it must be a command, one of 'rand' or 'uni'
-            pre_choice = simple_eval(
-                part, 
-                names=settings.UNIVERSAL_CONSTANTS,
-                functions=settings.PREDEFINED_FUNCTIONS
-            )
-            choice += str(pre_choice)+";"
-
-#        elif part[0] in 'zZ':
-#            lower, upper = [int(x) for x in part[1:].split(',')]
-#            if upper==lower: # Ensures we can't accidentally enter an infinite loop on Z0,0
-#                concrete = str(upper) + ";"
-#            else:
-#                concrete = random.randint(lower,upper)
-#                if part[0].istitle(): # Range specifies non-zero number using capital letter
-#                    while concrete == 0:
-#                        concrete = random.randint(lower,upper)
-#            choice += str(concrete) + ";"
-
-    # At the end, we need to cut off the trailing semi-colon
-    return choice[0:-1]
+    return draw_choice(compile_choice(abstract_choice, validate=False))
 
 def get_answer(question, choices):
     """ Evaluates the mathematical expression to compute the answer.
@@ -745,41 +996,9 @@ def get_answer(question, choices):
         <<OUTPUT>>
         (Integer)  The answer, to be saved
 
-        Depends: simpleeval.simple_eval
+        Depends: workers.get_answer
     """
-    answer = question.answer
-    if choices is None:
-        return answer
-    if re.findall(r'{v\[\d+\]}', answer): # matches no variables
-        answer = answer.format(v=choices.split(';'))
-        answer = eval_sub_expression(answer)
-
-    try:
-        # Substitute the variables into the string and evaluate the functions dictionary
-#        eval_string = answer.format(v=choices.split(';'))
-        # Remove whitespace before evaluating
-        eval_string = answer.replace(' ', '')
-        functions = eval(question.functions)
-        functions.update(settings.PREDEFINED_FUNCTIONS)
-
-        return round(
-            simple_eval(
-                eval_string, 
-                functions=functions, 
-                names=settings.UNIVERSAL_CONSTANTS
-            ),
-        4)
-    except (SyntaxError, NameNotDefined,) as e:
-        # Enter this exception if the answer is not one that can be evaluated.
-        # In that case, the answer is just the answer
-#        if question.q_type == "MC":
-#            return answer
-#        else:
-#            raise e
-        return answer
-
-    except Exception as e: 
-        raise e
+    return workers.get_answer(question, choices)
 
 @login_required
 def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
@@ -795,7 +1014,7 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
         <<OUTPUT>>
         HttpResponse - renders the quiz question
 
-        Depends: sub_into_question_string, mark_question, generate_next_question
+        Depends: render_question_record, submit_answer, submission_token
     """
     sqr = StudentQuizResult.objects.select_related('quiz','quiz__course').get(pk=sqr_pk)
     string_answer = ''
@@ -804,17 +1023,16 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
     # Start by doing some validation to make sure only the correct student has
     # access to this page
     if sqr.student != request.user:
-        raise HttpResponseForbidden(
+        return HttpResponseForbidden(
             'You are not authorized to see this question')
 
     # submit=None means the student is just viewing the question and hasn't
     # submitted a solution. In this case, simply render the question.
     if submit is None:
-        result, qnum = sqr.get_result()
-        # If qnum is 0, then the quiz is finished. In this case, render the
-        # results page.
-        if qnum == '0':
-            result_table = get_result_table(sqr.result)
+        # If cur_quest is 0, then the quiz is finished. In this case, render
+        # the results page.
+        if sqr.cur_quest == 0:
+            result_table = get_result_table(sqr)
             return render(request, 'quizzes/completed_quiz.html', 
                 { 'sqr': sqr,
                   'result_table': result_table,
@@ -823,22 +1041,17 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
          
         # Otherwise, pick out the current question and its multiple choice
         # answers (if applicable).
-        # result[qnum] has fields (MarkedQuestion) pk, inputs, score, type,
-        # (mc_choices)
-        question = MarkedQuestion.objects.get(pk=int(result[qnum]['pk']))
-        choices  = result[qnum]['inputs']
-        # Input the choices into the question string
-        q_string = sub_into_question_string(question, choices)
-        
-        if result[qnum]['type'] == "MC":
-            mc_choices = result[qnum]['mc_choices']
+        try:
+            q_string, mc_choices = render_question_record(sqr, sqr.get_state().get())
+        except workers.EvaluationError:
+            return evaluation_unavailable()
     # Information was submitted, so verify that the input is correctly
     # formmated, mark the question, and either return the results page (if done)
     # or generate the next question.
     else: 
         # The page was either refreshed or the table with the results was sorted
         if request.method == "GET": 
-            result_table = get_result_table(sqr.result)
+            result_table = get_result_table(sqr)
             RequestConfig(request, paginate={'per_page', 10}).configure(result_table)
             return render(request, 'quizzes/completed_quiz.html', 
                 { 'sqr': sqr,
@@ -851,20 +1064,33 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
         # sometimes throws an error for some reason. Also need to track down
         # this bug
         q_string = request.POST['problem'] 
+
+        # Each rendered question carries a token, so that a retried
+        # submission is not marked twice
+        token = request.POST.get('token') or None
+        if token is not None:
+            try:
+                token_pk = parse_submission_token(token)[0]
+            except ValueError:
+                token_pk = None
+            if token_pk != sqr.pk:
+                return HttpResponseBadRequest('Invalid submission token')
+
         try:
             string_answer = request.POST['answer'] #string input
-            # Mark the question. If it's the last question, is_last = True and
-            # we generate the results page
-            is_last = mark_question(sqr, string_answer)
+            # Mark the question and, if there are more questions, generate
+            # the next one. If it's the last question, is_last = True and we
+            # generate the results page
+            is_last, next_string, next_choices, error_message = submit_answer(
+                sqr, string_answer, token)
 
             if not is_last: 
-                # There are more questions, so generate the next one
-                q_string, mc_choices = generate_next_question(sqr)
+                q_string, mc_choices = next_string, next_choices
                 string_answer = ''
             else: 
                 # The quiz is over, so generate the result table. Also, update
                 # the student mark
-                result_table = get_result_table(sqr.result)
+                result_table = get_result_table(sqr)
                 # We are not tracking marks, so this is commented out
 #                update_marks(sqr) # Call a helper method for updating the student's marks 
                 RequestConfig(request, paginate={'per_page', 10}).configure(result_table)
@@ -881,6 +1107,13 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
 #                    return_data = 
 #                return HttpResponse(json.dumps(return_data))
 
+        except workers.EvaluationError:
+            # Nothing was saved, but the attempt may have been moved on in
+            # memory
+            sqr.refresh_from_db(fields=['score', 'cur_quest'])
+            sqr._attempt_state = None
+            error_message = ("Your answer could not be marked just now. Please"
+                " submit it again")
         except ValueError as e:
             error_message =  ("The expression '{}' did not parse to a valid"
                 " mathematical expression. Please try"
@@ -896,24 +1129,40 @@ def display_question(request, course_pk, quiz_pk, sqr_pk, submit=None):
           'error_message': error_message,
           'string_answer': string_answer,
           'mc_choices': mc_choices,
+          'token': submission_token(sqr),
          }
     )
 
-def get_result_table(result):
-    """ Turns the string StudentQuizResults.results and generated a table.
+def evaluation_unavailable():
+    """ The response to a request whose question could not be evaluated in
+        time (see workers.EvaluationTimeout and workers.PoolSaturated)
+    """
+    return HttpResponse("This question could not be loaded just now. Please"
+        " reload the page.", status=503)
+
+def record_answer(record):
+    """ The answer of an attempt's question, or 'Unavailable' if it was
+        seeded and can no longer be regenerated (see attempts.regenerate)
+    """
+    try:
+        return record.answer
+    except LookupError:
+        return 'Unavailable'
+
+def get_result_table(sqr):
+    """ Generates a table of the questions of a StudentQuizResult.
         <<INPUT>>
-        result (string) serialized JSON object to be converted to a table
+        sqr (StudentQuizResult) the attempt to be converted to a table
         <<OUTPUT>
         QuizResulTable populated with the data.
     """
     
     ret_data = []
-    res_dict = json.loads(result)
-    for field, data in res_dict.items():
-        part = {'q_num': field, 
-                'correct': str(data['answer']), 
-                'guess': str(data['guess']),
-                'score': data['score']}
+    for record in sqr.get_state().questions():
+        part = {'q_num': str(record.number), 
+                'correct': str(record_answer(record)), 
+                'guess': str(record.guess) if record.is_answered else 'Unanswered',
+                'score': str(record.score)}
         ret_data.append(part)
     
     return QuizResultTable(ret_data)
@@ -923,7 +1172,8 @@ def test_quiz_question(request, course_pk, quiz_pk, mq_pk):
     """ Generates many examples of the given question for testing purpose.
         Input: mpk (Integer) MarkedQuestion primary key
 
-        Depends on: sub_into_question_string, render_html_for_question
+        Depends on: workers.evaluate_batch, sub_into_question_string,
+            render_html_for_question
     """
     mquestion = get_object_or_404(
             MarkedQuestion.objects.select_related('quiz', 'quiz__course'), 
@@ -939,12 +1189,17 @@ def test_quiz_question(request, course_pk, quiz_pk, mq_pk):
         html = ''
 
         try:
-            for k in range(0,int(num_tests)):
-                choice = parse_abstract_choice(mquestion.get_random_choice())
-                answer = get_answer(mquestion, choice)
+            # Sample every input first, so that the answers and multiple
+            # choice options can be evaluated as a batch
+            program = mquestion.get_program()
+            inputs  = [program.sample_inputs() for k in range(0,int(num_tests))]
+            answers, mc_options = workers.evaluate_batch(mquestion, inputs)
+
+            for index, choice in enumerate(inputs):
+                answer = answers[index]
 
-                if mquestion.q_type == "MC":
-                    mc_choices = get_mc_choices(mquestion, choice, answer)
+                if mc_options is not None:
+                    mc_choices = shuffle_mc_choices(mc_options[index], answer)
                 else:
                     mc_choices = ''
 
@@ -966,6 +1221,46 @@ def test_quiz_question(request, course_pk, quiz_pk, mq_pk):
                 {'mquestion':mquestion,
                 })
 
+@staff_required()
+def regrade_question(request, course_pk, quiz_pk, mq_pk):
+    """ Regrades the results generated from a question after its answer has
+        been corrected. A GET shows what would change for the first chunk of
+        results (a dry run), and how many results there are. If that chunk
+        holds every result, a POST makes the changes; otherwise the page
+        asks for the regrade_question command, which regrades any number of
+        results chunk by chunk.
+        Input: mq_pk (Integer) MarkedQuestion primary key
+
+        Depends on: regrade.regrade_question
+    """
+    mquestion = get_object_or_404(
+            MarkedQuestion.objects.select_related('quiz', 'quiz__course'),
+            pk=mq_pk)
+
+    if not request.user.has_perm('quizzes.can_edit_quiz',
+            mquestion.quiz.course):
+        return HttpResponseForbidden('You are not authorized to regrade this.')
+
+    result = regrade.regrade_question(mquestion, dry_run=True, chunk_size=regrade.CHUNK_SIZE,
+                                      limit=regrade.CHUNK_SIZE)
+    if request.method == "POST" and result.complete:
+        result = regrade.regrade_question(mquestion)
+    changes = RegradeTable([
+        {'attempt': change.attempt_id,
+         'old_answer': change.old_answer,
+         'new_answer': change.new_answer,
+         'old_score': change.old_score if change.answered else '-',
+         'new_score': change.new_score if change.answered else '-',
+        } for change in result.changes[:REGRADE_SHOWN]])
+
+    return render(request, 'quizzes/regrade_question.html',
+            {'mquestion': mquestion,
+             'regrade': result,
+             'changes': changes,
+             'shown': min(len(result.changes), REGRADE_SHOWN),
+             'results': mquestion.studentquestionresult_set.count(),
+            })
+
 def render_html_for_question(problem, answer, choice, mc_choices):
     """ Takes in question elements and returns the corresponding html.
         Input: problem (String) The problem 
@@ -994,19 +1289,23 @@ def render_html_for_question(problem, answer, choice, mc_choices):
     return template
 
 @login_required
+@reads_from_replica
 def quiz_details(request, course_pk, quiz_pk, sqr_pk):
     """ A view which allows students to see the details of a
         completed/in-progress quiz.  
 
-    Depends on: sub_into_question_string
+    Depends on: sub_into_question_string, record_answer
     """
 
-    quiz_results = get_object_or_404(StudentQuizResult, pk=sqr_pk)
+    # Old attempts may have been archived
+    try:
+        quiz_results = archive.get_attempt(sqr_pk)
+    except StudentQuizResult.DoesNotExist:
+        raise Http404("No such attempt")
 
     if request.user != quiz_results.student:
         raise HttpResponseForbidden()
 
-    result_dict = quiz_results.get_result()[0]
     template = """
     <li> 
         <div class = "mathrender question-detail">
@@ -1021,27 +1320,26 @@ def quiz_details(request, course_pk, quiz_pk, sqr_pk):
 
     #Generate the return html
     return_html = ""
-    for qnum in range(1,len(result_dict)+1):
-        temp_dict = result_dict[str(qnum)]
-
-        #Check to see if the question has been answered. If not, skip it
-        if 'guess_string' not in temp_dict:
-            continue
-
-        mquestion = MarkedQuestion.objects.get(pk = temp_dict['pk'])
-
-        problem = sub_into_question_string(mquestion, temp_dict['inputs'])
-
-        if int(temp_dict['score']):
+    # Only the questions which have been answered are shown
+    for record in quiz_results.get_state().answered():
+        try:
+            if record.question_id is None:
+                raise LookupError("The question has been deleted")
+            mquestion = quiz_results.quiz.get_question(record.question_id)
+            problem = sub_into_question_string(mquestion, record.inputs)
+        except (LookupError, MarkedQuestion.DoesNotExist):
+            problem = "This question is no longer available."
+
+        if record.score:
             correct = "<p style='color:green'>Correct</p>"
         else:
             correct = "<p style='color:red'>Incorrect</p>"
         
         return_html += template.format(problem=problem, 
                                        correct=correct,
-                                       answer=temp_dict['answer'],
-                                       guess_string=temp_dict['guess_string'],
-                                       guess=temp_dict['guess'])
+                                       answer=record_answer(record),
+                                       guess_string=record.guess_string,
+                                       guess=record.guess)
 
     # return_html only has body. Need to wrap on ordered-list
     return_html = "<ol> {} </ol>".format(return_html)
@@ -1133,6 +1431,32 @@ def add_staff_member(request):
             }
         )
 
+def read_usernames(upload):
+    """ Generates the username in the first column of each row of an uploaded
+        CSV file, reading it as it arrives rather than from a saved copy.
+        <<INPUT>>
+        upload (UploadedFile) in memory or streamed to a temporary file
+    """
+    for row in csv.reader(codecs.iterdecode(upload, 'utf-8-sig')):
+        if row:
+            yield row[0]
+
+def claim_roster(pk):
+    """ Reads the usernames of a roster saved by sync_roster and deletes it.
+        Only one caller can claim each roster; the others get None.
+    """
+    roster = CSVFile.objects.filter(pk=pk).first()
+    if roster is None:
+        return None
+    try:
+        with roster.doc_file.storage.open(roster.doc_file.name, 'rb') as f:
+            usernames = list(read_usernames(f))
+    except (IOError, OSError):
+        usernames = None
+    claimed = CSVFile.objects.filter(pk=pk).delete()[0]
+    roster.doc_file.delete(save=False)
+    return usernames if claimed else None
+
 def add_students(request):
     # Populate the form with list of courses 
     courses = get_objects_for_user(request.user, 'quizzes.can_edit_quiz')
@@ -1142,25 +1466,16 @@ def add_students(request):
         form = AddStudentsForm(request.POST, request.FILES, queryset=courses)
 
         if form.is_valid():
-            # Get the course
-            course_pk = int(request.POST['course'])
-            course = Course.objects.get(pk=course_pk)
-            # Save the file to make it easier to read from later
-            csv_file = form.save()
-
-            # Read through the CSV file 
-            with open(csv_file.doc_file.path, 'rt') as the_file:
-                for row in csv.reader(the_file):
-                    username = row[0]
-                    user, _ = User.objects.get_or_create(username=username)
-                    # Get the membership and add this course to that
-                    membership, _ = UserMembership.objects.get_or_create(user=user)
-                    membership.courses.add(course)
+            course = form.cleaned_data['course']
+            enrollment = UserMembership.enroll(
+                course, read_usernames(form.cleaned_data['doc_file']))
 
             redirect_string = generate_redirect_string(
                 'Administrative', reverse('administrative') )
-            success_string = "Students successfully added to course {} ".format(
-                   course.name)
+            success_string = ("Students successfully added to course {}: {} added "
+                "({} new accounts), {} already enrolled, {} duplicate rows skipped").format(
+                course.name, enrollment.added, enrollment.created, enrollment.existing,
+                enrollment.duplicates)
 
             return render(request, 'quizzes/success.html',
                 { 'success_string': success_string,
@@ -1183,6 +1498,84 @@ def add_students(request):
             }
         )
 
+@staff_required()
+def sync_roster(request):
+    """ Makes a course's students those of a full roster, such as the
+        registrar's. Uploading the roster shows what would be added and
+        removed; confirming applies it (see UserMembership.sync_roster). The
+        uploaded usernames are saved as a CSVFile for ROSTER_PREVIEW_TIMEOUT
+        seconds in between, with only its pk kept in the session, so that any
+        process can confirm them, and the difference is worked out again when
+        it is applied.
+    """
+    courses = get_objects_for_user(request.user, 'quizzes.can_edit_quiz')
+    sidenote = ("Upload a csv file whose rows are the UTORid's of every "
+        "student in the course. Students who are not in it will be removed "
+        "from the course. You will be shown the changes before they are made.")
+    header = "Synchronize Course Roster"
+
+    # Unexpired previews, by token. The rosters of expired ones are deleted.
+    saved = request.session.get('roster_sync', {})
+    previews = {token: pending for token, pending in saved.items()
+                if pending['expires'] > time.time()}
+    if len(previews) < len(saved):
+        for token in set(saved) - set(previews):
+            claim_roster(saved[token]['roster'])
+        request.session['roster_sync'] = previews
+
+    if request.method == "POST" and 'token' in request.POST:
+        pending = previews.pop(request.POST['token'], None)
+        request.session['roster_sync'] = previews
+        usernames = None if pending is None else claim_roster(pending['roster'])
+        if usernames is None:
+            return HttpResponseBadRequest("This preview has expired. Please upload the roster again.")
+        course = get_object_or_404(courses, pk=pending['course'])
+        diff = UserMembership.sync_roster(course, usernames)
+
+        redirect_string = generate_redirect_string(
+            'Administrative', reverse('administrative') )
+        success_string = ("Roster of course {} synchronized: {} students added, "
+            "{} removed, {} unchanged").format(
+            course.name, len(diff.add), len(diff.remove), diff.kept)
+        return render(request, 'quizzes/success.html',
+            { 'success_string': success_string,
+              'redirect_string': redirect_string,
+            }
+        )
+
+    if request.method == "POST":
+        form = AddStudentsForm(request.POST, request.FILES, queryset=courses)
+        if form.is_valid():
+            course = form.cleaned_data['course']
+            rows = list(read_usernames(form.cleaned_data['doc_file']))
+            diff = UserMembership.roster_diff(course, rows)
+            usernames, _ = UserMembership.unique_usernames(rows)
+
+            roster = CSVFile()
+            roster.doc_file.save('roster.csv', ContentFile('\n'.join(usernames).encode()))
+            token = get_random_string(32)
+            previews[token] = {'course': course.pk, 'roster': roster.pk,
+                               'expires': time.time() + settings.ROSTER_PREVIEW_TIMEOUT}
+            request.session['roster_sync'] = previews
+            return render(request, 'quizzes/sync_roster.html',
+                { 'course': course,
+                  'diff': diff,
+                  'token': token,
+                  'shown': ROSTER_SHOWN,
+                  'add': diff.add[:ROSTER_SHOWN],
+                  'remove': diff.remove[:ROSTER_SHOWN],
+                }
+            )
+    else:
+        form = AddStudentsForm(queryset=courses)
+
+    return render(request, 'quizzes/generic_form.html',
+        { 'form': form,
+          'header': header,
+          'sidenote': sidenote,
+        }
+    )
+
 @login_required
 def course_search(request):
     """ AJAX view for searching for open enrollment courses. GET should contain
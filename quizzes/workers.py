@@ -0,0 +1,332 @@
+""" A pool of long lived worker processes for evaluating MarkedQuestions.
+
+    Answers are evaluated with the instructor's functions, which are arbitrary
+    python. Rather than running them on the request thread, where a single
+    slow function stalls the web worker, they can be sent to a pool of
+    pre-forked processes. Each worker keeps its own cache of compiled
+    QuestionPrograms (and so of the instructor's functions), keyed by question
+    version. Calls which take longer than EVALUATION_TIMEOUT kill the worker,
+    which is replaced, and raise EvaluationTimeout. When every worker is busy
+    callers wait up to EVALUATION_QUEUE_WAIT seconds and then receive
+    PoolSaturated, rather than queueing without bound.
+
+    The pool is only used when settings.EVALUATION_WORKERS is non-zero.
+    Otherwise everything is evaluated in the calling process, as before.
+
+    The workers are not a sandbox. They protect the web workers from slow or
+    crashing functions, and the functions only get the restricted builtins of
+    programs.compile_functions, but they still run as the user the site runs
+    as, in a process with its files, database settings and network. The
+    other limits are EVALUATION_TIMEOUT and, where the platform supports it,
+    the address space limit EVALUATION_MEMORY_LIMIT. Only trusted
+    instructors should be able to write functions.
+
+    EvaluationError is a ValueError, like the errors of evaluating in the
+    calling process, so callers which treat a question that cannot be
+    evaluated as invalid also handle a timeout or a saturated pool.
+"""
+
+from django.conf import settings
+
+from .programs import get_program
+from . import batch
+
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+# Batches smaller than this are not split between workers
+MIN_CHUNK_SIZE = 50
+
+class EvaluationError(ValueError):
+    """ Raised when a worker could not evaluate a question """
+    pass
+
+class EvaluationTimeout(EvaluationError):
+    """ Raised when an evaluation took longer than its time limit """
+    pass
+
+class PoolSaturated(EvaluationError):
+    """ Raised when no worker became free in time """
+    pass
+
+
+class QuestionSpec(object):
+    """ The fields of a MarkedQuestion needed to compile it. Unlike the model
+        instance, this is cheap to send to a worker.
+    """
+    __slots__ = ('pk', 'version', 'q_type', 'problem_str', 'answer',
+                 'mc_choices', 'choices', 'functions')
+
+    def __init__(self, question):
+        for field in self.__slots__:
+            setattr(self, field, getattr(question, field))
+
+    def get_program(self):
+        return get_program(self)
+
+
+# ---------- Worker side ---------- #
+
+def _get_answer(question, choices):
+    return question.get_program().get_answer(choices)
+
+def _get_mc_options(question, choices):
+    return question.get_program().get_mc_options(choices)
+
+def _evaluate_batch(question, inputs):
+    return batch.evaluate_batch(question, inputs)
+
+def _generate(question, seed):
+    return question.get_program().generate(seed)
+
+TASKS = {
+    'answer': _get_answer,
+    'mc_options': _get_mc_options,
+    'batch': _evaluate_batch,
+    'generate': _generate,
+}
+
+def _limit_resources():
+    """ Restricts the memory available to the worker, if configured """
+    limit = getattr(settings, 'EVALUATION_MEMORY_LIMIT', None)
+    if resource is not None and limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _work(conn):
+    """ The main loop of a worker process. Receives (task, question, argument)
+        tuples and replies with ('ok', result) or ('error', exception).
+    """
+    _limit_resources()
+    while True:
+        try:
+            task, question, argument = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        try:
+            reply = ('ok', TASKS[task](question, argument))
+        except Exception as e:
+            reply = ('error', e)
+
+        # Exceptions must survive the round trip to be re-raised by the caller
+        try:
+            pickle.loads(pickle.dumps(reply))
+        except Exception:
+            reply = ('error', EvaluationError(repr(reply[1])))
+        conn.send(reply)
+
+
+# ---------- Request side ---------- #
+
+class Worker(object):
+    """ A single worker process and the pipe used to talk to it """
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_work, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def send(self, task, question, argument):
+        self.conn.send((task, question, argument))
+
+    def receive(self, timeout):
+        """ Waits up to timeout seconds for the reply to the last task.
+            Returns ('ok', result) or ('error', exception).
+        """
+        if not self.conn.poll(max(timeout, 0)):
+            raise EvaluationTimeout("Evaluation did not finish in time")
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """ A fixed number of warm workers.
+        size - (Integer) The number of worker processes
+        timeout - (Float) Seconds allowed for a single evaluation
+        batch_timeout - (Float) Seconds allowed for a whole batch
+        wait - (Float) Seconds to wait for a free worker
+    """
+    def __init__(self, size, timeout, batch_timeout, wait):
+        self.timeout = timeout
+        self.batch_timeout = batch_timeout
+        self.wait = wait
+        self.pid = os.getpid()
+        # Forking keeps the workers warm: settings and modules are already
+        # loaded
+        self.context = multiprocessing.get_context('fork')
+        self.idle = queue.LifoQueue()
+        for k in range(size):
+            self.idle.put(Worker(self.context))
+
+    def acquire(self):
+        """ Takes a free worker, waiting up to self.wait seconds """
+        try:
+            return self.idle.get(timeout=self.wait)
+        except queue.Empty:
+            raise PoolSaturated("All evaluation workers are busy")
+
+    def acquire_more(self, count):
+        """ Takes up to count further workers, without waiting """
+        workers = []
+        while len(workers) < count:
+            try:
+                workers.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        return workers
+
+    def release(self, worker, healthy=True):
+        """ Returns a worker to the pool. Workers which timed out or died are
+            replaced.
+        """
+        if not healthy:
+            worker.kill()
+            worker = Worker(self.context)
+        self.idle.put(worker)
+
+    def call(self, workers, task, question, arguments, timeout):
+        """ Sends one argument to each worker, and collects the results in
+            order. Every worker is released.
+        """
+        return self.call_each(workers, task,
+                              [(question, argument) for argument in arguments], timeout)
+
+    def call_each(self, workers, task, calls, timeout):
+        """ Sends one (question, argument) pair to each worker, and collects
+            the results in order. Every worker is released.
+        """
+        deadline = time.time() + timeout
+        replies = []
+        healthy = [False]*len(workers)
+        try:
+            for worker, (question, argument) in zip(workers, calls):
+                worker.send(task, question, argument)
+            for index, worker in enumerate(workers):
+                replies.append(worker.receive(deadline - time.time()))
+                healthy[index] = True
+        except (EOFError, OSError) as e:
+            raise EvaluationError("Evaluation worker failed: {}".format(e))
+        finally:
+            for worker, is_healthy in zip(workers, healthy):
+                self.release(worker, is_healthy)
+
+        results = []
+        for status, value in replies:
+            if status == 'error':
+                raise value
+            results.append(value)
+        return results
+
+    def submit(self, task, question, argument):
+        """ Evaluates a single task """
+        worker = self.acquire()
+        return self.call([worker], task, question, [argument], self.timeout)[0]
+
+    def map(self, task, calls):
+        """ Evaluates a list of (question, argument) pairs, as many at a time
+            as there are free workers, and returns the results in order.
+        """
+        results = []
+        while len(results) < len(calls):
+            remaining = calls[len(results):]
+            workers = [self.acquire()] + self.acquire_more(len(remaining) - 1)
+            results.extend(self.call_each(workers, task, remaining[:len(workers)],
+                                          self.batch_timeout))
+        return results
+
+    def evaluate_batch(self, question, inputs):
+        """ Splits a batch between as many free workers as are available """
+        workers = [self.acquire()]
+        workers += self.acquire_more(len(inputs)//MIN_CHUNK_SIZE - 1)
+
+        size = -(-len(inputs)//len(workers))
+        chunks = [inputs[k:k+size] for k in range(0, len(inputs), size)] or [[]]
+        # Fewer chunks than workers if the batch divided unevenly
+        for worker in workers[len(chunks):]:
+            self.release(worker)
+        workers = workers[:len(chunks)]
+
+        results = self.call(workers, 'batch', question, chunks, self.batch_timeout)
+
+        answers = []
+        mc_options = None if question.q_type != "MC" else []
+        for chunk_answers, chunk_options in results:
+            answers.extend(chunk_answers)
+            if mc_options is not None:
+                mc_options.extend(chunk_options)
+        return answers, mc_options
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """ Returns the worker pool of this process, starting it if necessary, or
+        None if settings.EVALUATION_WORKERS is 0.
+    """
+    global _pool
+    size = getattr(settings, 'EVALUATION_WORKERS', 0)
+    if not size:
+        return None
+
+    with _pool_lock:
+        # A pool inherited from a parent process cannot be used
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = WorkerPool(
+                size,
+                timeout=getattr(settings, 'EVALUATION_TIMEOUT', 2),
+                batch_timeout=getattr(settings, 'EVALUATION_BATCH_TIMEOUT', 30),
+                wait=getattr(settings, 'EVALUATION_QUEUE_WAIT', 5),
+            )
+        return _pool
+
+def get_answer(question, choices):
+    """ QuestionProgram.get_answer, evaluated in the pool if there is one """
+    pool = get_pool()
+    if pool is None or choices is None:
+        return question.get_program().get_answer(choices)
+    return pool.submit('answer', QuestionSpec(question), choices)
+
+def get_mc_options(question, choices):
+    """ QuestionProgram.get_mc_options, evaluated in the pool if there is one
+    """
+    pool = get_pool()
+    if pool is None:
+        return question.get_program().get_mc_options(choices)
+    return pool.submit('mc_options', QuestionSpec(question), choices)
+
+def evaluate_batch(question, inputs):
+    """ batch.evaluate_batch, spread over the pool if there is one """
+    pool = get_pool()
+    if pool is None:
+        return batch.evaluate_batch(question, inputs)
+    return pool.evaluate_batch(QuestionSpec(question), list(inputs))
+
+def generate(question, seed):
+    """ QuestionProgram.generate, evaluated in the pool if there is one """
+    pool = get_pool()
+    if pool is None:
+        return question.get_program().generate(seed)
+    return pool.submit('generate', QuestionSpec(question), seed)
+
+def generate_many(calls):
+    """ QuestionProgram.generate for a list of (question, seed) pairs, in
+        parallel if there is a pool
+    """
+    pool = get_pool()
+    if pool is None:
+        return [question.get_program().generate(seed) for question, seed in calls]
+    return pool.map('generate', [(QuestionSpec(question), seed) for question, seed in calls])